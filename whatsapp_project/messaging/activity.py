@@ -0,0 +1,54 @@
+"""
+Session activity tracking used by the idle session timeout.
+
+The time of the user's last activity is kept in the session under `last_activity`, as epoch seconds (sessions written
+by older versions hold an ISO 8601 string, which is still understood). Every write marks the session as modified, and
+with a database-backed session engine each modified session costs a row UPDATE. Activity updates are therefore
+coalesced: the stored value is only rewritten once it is older than `SESSION_ACTIVITY_GRANULARITY` seconds (a
+setting, 60 by default). The idle timeout can then fire at most that many seconds early.
+
+Functions:
+    - `get_last_activity(session)`: Returns the stored last activity as epoch seconds, or None.
+    - `touch_activity(session, now=None, force=False)`: Records activity at `now`, unless the stored value is recent
+      enough. Returns True when the session was written.
+    - `is_idle_expired(session, timeout, now=None)`: True when more than `timeout` seconds passed since the last activity.
+"""
+
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+SESSION_ACTIVITY_KEY = 'last_activity'
+
+
+def _granularity():
+    return getattr(settings, 'SESSION_ACTIVITY_GRANULARITY', 60)
+
+
+def get_last_activity(session):
+    value = session.get(SESSION_ACTIVITY_KEY)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return value
+
+
+def touch_activity(session, now=None, force=False):
+    now = time.time() if now is None else now
+    last_activity = get_last_activity(session)
+    if not force and last_activity is not None and now - last_activity < _granularity():
+        return False
+
+    session[SESSION_ACTIVITY_KEY] = int(now)
+    return True
+
+
+def is_idle_expired(session, timeout, now=None):
+    now = time.time() if now is None else now
+    last_activity = get_last_activity(session)
+    return last_activity is not None and now - last_activity > timeout
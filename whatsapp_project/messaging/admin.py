@@ -1,35 +1,75 @@
 """
 Custom admin configuration for the `User` and `Message` models in the Django admin interface.
 
-This module customizes the admin interface to ensure that when a `User` is deleted, all associated messages sent or received by the user are also deleted.
+This module customizes the admin interface so that deleting a `User` also deletes every thread they take part in,
+without loading their messages into memory (see `messaging.deletion`).
 
 Classes:
 1. **CustomUserAdmin** (extends `UserAdmin`)
     - Customizes the Django admin interface for the `User` model.
-    - Overrides the `delete_model` method to:
-        - Delete all messages where the user is the sender.
-        - Delete all messages where the user is the recipient.
-        - Delete the user after their messages are removed.
+    - Deletes users through `delete_user`, which removes their threads in fixed-size batches with set-based SQL.
 
     Methods:
+        - `get_deleted_objects(self, objs, request)`:
+            - Summarizes what the deletion confirmation page lists as the users and a count of their messages,
+              instead of collecting every related object.
         - `delete_model(self, request, obj)`:
-            - Deletes all messages sent or received by the `obj` user before deleting the user.
-            - This method ensures that message-related data is cleaned up when a user is deleted.
+            - Deletes the `obj` user and their threads in batches.
+        - `delete_queryset(self, request, queryset)`:
+            - Deletes the selected users one after the other in batches (the "Delete selected users" action).
+
+    Actions:
+        - `delete_in_background`:
+            - Deactivates the selected users and enqueues a `messaging.delete_user` job for each, for users with
+              too many messages to delete within a request. Without a worker (`MESSAGING_JOBS_EAGER`), the jobs run
+              inline and the message says so.
 
 Model Registration:
 - The `User` model is registered with the custom `CustomUserAdmin` to use the custom delete logic.
 - The `Message` model is registered to appear in the Django admin without customizations.
 """
 
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import Q
+from .deletion import delete_user
+from .jobs import enqueue_on_commit
 from .models import User, Message
 
 class CustomUserAdmin(UserAdmin):
+    actions = ['delete_in_background']
+
+    def get_deleted_objects(self, objs, request):
+        users = list(objs)
+        message_count = Message.objects.filter(Q(sender__in=users) | Q(recipient__in=users)).count()
+        deleted_objects = [f'{User._meta.verbose_name.capitalize()}: {user}' for user in users]
+        model_count = {
+            User._meta.verbose_name_plural: len(users),
+            Message._meta.verbose_name_plural: message_count,
+        }
+        perms_needed = set() if self.has_delete_permission(request) else {User._meta.verbose_name}
+        return deleted_objects, model_count, perms_needed, []
+
     def delete_model(self, request, obj):
-        Message.objects.filter(sender=obj).delete()
-        Message.objects.filter(recipient=obj).delete()
-        obj.delete()
+        delete_user(obj)
+
+    def delete_queryset(self, request, queryset):
+        for user in queryset.iterator():
+            delete_user(user)
+
+    @admin.action(permissions=['delete'], description='Delete selected users in the background')
+    def delete_in_background(self, request, queryset):
+        user_ids = list(queryset.values_list('id', flat=True))
+        queryset.update(is_active=False)
+        for user_id in user_ids:
+            enqueue_on_commit('messaging.delete_user', {'user_id': user_id}, idempotency_key=f'delete-user:{user_id}')
+        if settings.MESSAGING_JOBS_EAGER:
+            self.message_user(request, f'{len(user_ids)} users deleted. No background worker is configured '
+                                       '(WHATSAPP_JOBS_EAGER=0), so the deletion ran within this request.',
+                              messages.WARNING)
+        else:
+            self.message_user(request, f'{len(user_ids)} users deactivated and queued for deletion.', messages.SUCCESS)
 
 admin.site.register(User, CustomUserAdmin)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
@@ -11,11 +11,23 @@ Class:
         - `default_auto_field`: Specifies the type of primary key to use for models within this app. Set to `'django.db.models.BigAutoField'`, which will use a `BigInt` field for primary keys by default.
         - `name`: The name of the application, which is `'messaging'`.
 
+    Methods:
+        - `ready(self)`: Installs the query tracking of `messaging.instrumentation` on every new database connection, registers the background tasks of `messaging.tasks` and exports the job queue depth on `/metrics/`.
+
 """
 
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MessegingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messaging'
+
+    def ready(self):
+        from . import tasks  # noqa: F401 (registers the tasks)
+        from .instrumentation import get_registry, install_query_tracking
+        from .jobs import queue_metrics
+
+        connection_created.connect(install_query_tracking, dispatch_uid='messaging.install_query_tracking')
+        get_registry().add_collector(queue_metrics)
@@ -0,0 +1,342 @@
+"""
+Retention: moving idle threads out of the `Message` table into compressed, append-only archive segments.
+
+Every inbox, thread and search query works on the hot tables, whose size would otherwise only grow with history
+nobody reads. `archive_idle_threads` (run by `manage.py archive_threads`) moves the threads whose last activity is
+older than `MESSAGING_ARCHIVE_AFTER_DAYS` into segment files under `MESSAGING_ARCHIVE_DIR`:
+
+- Segments are per user (the participant with the lower id), `<user id>/<number>.jsonl.gz`, and only ever appended to.
+  A new segment is started once the current one exceeds `MESSAGING_ARCHIVE_SEGMENT_BYTES`.
+- Each archived thread is one gzip member holding one JSON line per message (`MESSAGE_FIELDS`), in thread order.
+  Concatenated gzip members are still a valid gzip file, so a whole segment can be read with `zcat`.
+- An `ArchivedThread` row is the offset index of a thread: its segment, offset and length. Reading a thread seeks to
+  its member and decompresses only that, so `read_thread` costs the same however large the segment grows.
+
+A batch of threads is written and fsynced before any of them is deleted. Each thread is then checked for replies
+sent in the meantime, indexed and deleted in batches of `DELETE_BATCH_SIZE` messages in one transaction, so a thread
+is either hot or archived, never both. A thread that got a reply, or a crash before the commit, only leaves unused
+bytes in the segment. Archived threads are read-only: they leave the inbox and search, and can no longer be replied to.
+
+Two lock files in `MESSAGING_ARCHIVE_DIR` serialize the processes touching the archive:
+
+- `ARCHIVER_LOCK` is held by `archive_idle_threads` for its whole run, so a second archiver fails with
+  `ArchiveLocked` instead of writing the same threads again.
+- `SEGMENTS_LOCK` is held while segments are written or rewritten: by the archiver for each batch, and by
+  `purge_user`.
+
+Deleting a user (`messaging.deletion.delete_user`) calls `purge_user`, which leaves none of their messages on disk.
+A segment owned by the user only holds threads they take part in, and is removed. A segment of another user is
+compacted: the members of the remaining threads are copied into a new segment, their index rows are moved to it, and
+the old segment is removed. Only then are the user's `ArchivedThread` rows deleted, so an interrupted purge is
+completed by running it again. A reader that loses the race against a compaction reloads the index row and reads the
+thread from its new segment.
+
+Constants:
+    - `ARCHIVE_BATCH_SIZE`: Threads written per segment sync by default.
+
+Classes:
+    - `ArchiveLocked`: Raised when another process holds the archiver lock.
+
+Functions:
+    - `archive_idle_threads(older_than, batch_size, limit, progress)`: Archives the threads idle for longer than
+      `older_than`; returns the number of archived threads.
+    - `purge_user(user_id)`: Removes the archived threads of a user from the archive; returns how many there were.
+    - `read_thread(archived)`: Yields the message rows of an `ArchivedThread`, in thread order.
+"""
+
+import json
+import os
+import shutil
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .deletion import DELETE_BATCH_SIZE, _delete_rows
+from .models import ArchivedThread, Message, Thread, _message_committed
+from .serializers import message_rows
+
+ARCHIVE_BATCH_SIZE = 100
+
+# Gzip container (header and trailer) around a deflate stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+READ_CHUNK_SIZE = 64 * 1024
+ROW_CHUNK_SIZE = 2000
+
+ARCHIVER_LOCK = 'archiver.lock'
+SEGMENTS_LOCK = 'segments.lock'
+
+
+class ArchiveLocked(Exception):
+    """Raised when another process holds the archiver lock."""
+
+
+def _archive_dir():
+    return settings.MESSAGING_ARCHIVE_DIR
+
+
+@contextmanager
+def _file_lock(name, wait=True):
+    """
+    Holds an exclusive lock on the lock file `name` of the archive directory. Without `wait`, raises `ArchiveLocked`
+    when another process holds it. The operating system releases the lock of a process that dies.
+    """
+    os.makedirs(_archive_dir(), exist_ok=True)
+    with open(os.path.join(_archive_dir(), name), 'a+b') as file:
+        try:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            raise ArchiveLocked(f'{name} is held by another process') from None
+        try:
+            yield
+        finally:
+            if fcntl is None:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _segment_numbers(user_id):
+    directory = os.path.join(_archive_dir(), str(user_id))
+    os.makedirs(directory, exist_ok=True)
+    return directory, sorted(int(name.split('.')[0]) for name in os.listdir(directory))
+
+
+def _segment_name(user_id, number):
+    return f'{user_id}/{number:06d}.jsonl.gz'
+
+
+class _SegmentWriter:
+    """
+    Appends gzip members to the current segment of each user, and syncs them all to disk on `close`.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def write(self, user_id, rows):
+        """
+        Writes `rows` as one gzip member of `user_id`'s current segment. Returns `(segment, offset, length)`.
+        """
+        segment, file = self._open(user_id)
+        offset = file.tell()
+        compressor = zlib.compressobj(wbits=GZIP_WBITS)
+        for row in rows:
+            file.write(compressor.compress(json.dumps(_encode_row(row)).encode() + b'\n'))
+        file.write(compressor.flush())
+        return segment, offset, file.tell() - offset
+
+    def _open(self, user_id):
+        if user_id not in self._files:
+            _, numbers = _segment_numbers(user_id)
+            number = numbers[-1] if numbers else 1
+            current = os.path.join(_archive_dir(), _segment_name(user_id, number))
+            if numbers and os.path.getsize(current) >= settings.MESSAGING_ARCHIVE_SEGMENT_BYTES:
+                number += 1
+            segment = _segment_name(user_id, number)
+            file = open(os.path.join(_archive_dir(), segment), 'ab')
+            file.seek(0, os.SEEK_END)
+            self._files[user_id] = (segment, file)
+        return self._files[user_id]
+
+    def close(self):
+        for _, file in self._files.values():
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+        self._files.clear()
+
+
+def _commit_archived(thread, segment, offset, length):
+    """
+    Indexes an archived thread and deletes it from the hot tables, unless it got a reply since it was written.
+    Returns whether it was archived.
+    """
+    with transaction.atomic():
+        # The UPDATE takes the thread row (or, on SQLite, the database) write lock, like a reply would
+        if not Thread.objects.filter(pk=thread['pk'], last_sequence=thread['last_sequence']).update(
+                last_sequence=thread['last_sequence']):
+            return False
+
+        ArchivedThread.objects.create(
+            thread_id=thread['pk'],
+            sender_id=thread['root__sender_id'],
+            recipient_id=thread['root__recipient_id'],
+            message_count=thread['message_count'],
+            last_sequence=thread['last_sequence'],
+            last_activity_at=thread['last_activity_at'],
+            segment=segment,
+            offset=offset,
+            length=length,
+        )
+        while True:
+            rows = list(Message.objects.filter(root_id=thread['pk']).order_by('-sequence').values_list(
+                'id', 'root_id', 'sender_id', 'recipient_id')[:DELETE_BATCH_SIZE])
+            if not rows:
+                break
+            _delete_rows(rows)
+        transaction.on_commit(partial(_message_committed, thread['root__sender_id'], thread['root__recipient_id']))
+    return True
+
+
+def archive_idle_threads(older_than=None, batch_size=ARCHIVE_BATCH_SIZE, limit=None, progress=None):
+    """
+    Archives the threads whose last activity is older than `older_than` (a `timedelta`, by default
+    `MESSAGING_ARCHIVE_AFTER_DAYS` days), oldest first, at most `limit` of them. `progress(archived_threads)` is
+    called after every batch of `batch_size` threads. Returns the number of archived threads.
+
+    Raises `ArchiveLocked` when another archiver is running.
+    """
+    with _file_lock(ARCHIVER_LOCK, wait=False):
+        return _archive_idle_threads(older_than, batch_size, limit, progress)
+
+
+def _archive_idle_threads(older_than, batch_size, limit, progress):
+    if older_than is None:
+        older_than = timedelta(days=settings.MESSAGING_ARCHIVE_AFTER_DAYS)
+    cutoff = timezone.now() - older_than
+    archived = 0
+    skipped = set()
+
+    while limit is None or archived < limit:
+        size = batch_size if limit is None else min(batch_size, limit - archived)
+        threads = list(Thread.objects.filter(last_activity_at__lt=cutoff).exclude(pk__in=skipped).order_by(
+            'last_activity_at').values(
+            'pk', 'root__sender_id', 'root__recipient_id', 'message_count', 'last_sequence', 'last_activity_at'
+        )[:size])
+        if not threads:
+            break
+
+        with _file_lock(SEGMENTS_LOCK):
+            writer = _SegmentWriter()
+            try:
+                locations = [writer.write(
+                    min(thread['root__sender_id'], thread['root__recipient_id']),
+                    message_rows(Message.objects.filter(
+                        root_id=thread['pk'], sequence__lte=thread['last_sequence']
+                    ).order_by('sequence')).iterator(chunk_size=ROW_CHUNK_SIZE)
+                ) for thread in threads]
+            finally:
+                writer.close()
+
+            # Still under the lock, so a purge cannot move the segments before their index rows exist
+            for thread, location in zip(threads, locations):
+                if _commit_archived(thread, *location):
+                    archived += 1
+                else:
+                    skipped.add(thread['pk'])
+        if progress is not None:
+            progress(archived)
+
+    return archived
+
+
+def _copy(source, target, length):
+    while length:
+        chunk = source.read(min(READ_CHUNK_SIZE, length))
+        if not chunk:
+            raise EOFError(f'{source.name} ends before the end of a thread')
+        target.write(chunk)
+        length -= len(chunk)
+
+
+def _compact_segment(segment, user_id):
+    """
+    Rewrites `segment` without the threads of `user_id`: copies the members of the other threads into a new segment
+    of the same owner, moves their index rows to it and removes `segment`.
+    """
+    kept = list(ArchivedThread.objects.filter(segment=segment).exclude(
+        Q(sender_id=user_id) | Q(recipient_id=user_id)).order_by('offset'))
+    path = os.path.join(_archive_dir(), segment)
+    if kept:
+        owner = segment.split('/')[0]
+        _, numbers = _segment_numbers(owner)
+        new_segment = _segment_name(owner, numbers[-1] + 1)
+        offsets = []
+        with open(path, 'rb') as source, open(os.path.join(_archive_dir(), new_segment), 'xb') as target:
+            for archived in kept:
+                offsets.append(target.tell())
+                source.seek(archived.offset)
+                _copy(source, target, archived.length)
+            target.flush()
+            os.fsync(target.fileno())
+
+        with transaction.atomic():
+            for archived, offset in zip(kept, offsets):
+                ArchivedThread.objects.filter(pk=archived.pk).update(segment=new_segment, offset=offset)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def purge_user(user_id):
+    """
+    Removes every archived thread `user_id` took part in from the archive: their segment directory is removed, and
+    the segments they share with other users are compacted. Returns the number of purged threads.
+    """
+    threads = ArchivedThread.objects.filter(Q(sender_id=user_id) | Q(recipient_id=user_id))
+    user_directory = os.path.join(_archive_dir(), str(user_id))
+    if not threads.exists() and not os.path.isdir(user_directory):
+        return 0
+
+    with _file_lock(SEGMENTS_LOCK):
+        for segment in sorted(set(threads.values_list('segment', flat=True))):
+            _compact_segment(segment, user_id)
+        purged, _ = threads.delete()
+        # Every thread in the user's own segments involves them; this also catches segments left by a crash
+        shutil.rmtree(user_directory, ignore_errors=True)
+    return purged
+
+
+def _encode_row(row):
+    # Full isoformat: DjangoJSONEncoder would cut timestamps to milliseconds
+    return dict(row, timestamp=row['timestamp'].isoformat())
+
+
+def _decode_row(line):
+    row = json.loads(line)
+    row['timestamp'] = parse_datetime(row['timestamp'])
+    return row
+
+
+def read_thread(archived):
+    """
+    Yields the message rows (`MESSAGE_FIELDS` dicts, like `message_rows`) of an `ArchivedThread`, in thread order,
+    decompressing its gzip member a chunk at a time.
+    """
+    try:
+        file = open(os.path.join(_archive_dir(), archived.segment), 'rb')
+    except FileNotFoundError:
+        # The segment was compacted since the row was read (see `purge_user`)
+        archived.refresh_from_db()
+        file = open(os.path.join(_archive_dir(), archived.segment), 'rb')
+
+    decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+    remaining = archived.length
+    pending = b''
+    with file:
+        file.seek(archived.offset)
+        while remaining:
+            chunk = file.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError(f'Archive segment {archived.segment} ends inside thread {archived.thread_id}')
+            remaining -= len(chunk)
+            *lines, pending = (pending + decompressor.decompress(chunk)).split(b'\n')
+            for line in lines:
+                yield _decode_row(line)
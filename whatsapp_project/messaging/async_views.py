@@ -0,0 +1,193 @@
+"""
+Async (ASGI-native) variants of the busiest messaging views.
+
+Under ASGI, Django runs every sync view in a thread pool through `sync_to_async`, so a worker can only serve as many
+requests at once as it has pool threads, even though most poll requests end with a 304 Not Modified. The views here
+are coroutines instead: the session check, the version lookups and the ORM calls (`aget`, `ain_bulk`) each borrow a
+thread only for the duration of the query, and a request costs no thread while it waits. Writes that need a
+transaction (`Message.save` and its on-commit hooks) still run as one sync block.
+
+`whatsapp/urls.py` routes the endpoints below to these views when `MESSAGING_ASYNC_VIEWS` is set (the default under
+`whatsapp/asgi.py`); WSGI deployments keep the sync views of `messaging.views`. Both share the same helpers, so they
+return identical responses.
+
+Functions:
+    - `check_session_timeout(view_func)`: Async variant of the `messaging.views.check_session_timeout` decorator.
+    - `login_required(view_func)`: Async variant of the `django.contrib.auth.decorators.login_required` decorator.
+    - `latest_messages_api(request)`: Async variant of `messaging.views.latest_messages_api`.
+    - `search_users(request)`: Async variant of `messaging.views.search_users`.
+    - `send_message(request)`: Async variant of `messaging.views.send_message`.
+    - `export_messages_api(request)`: Async variant of `messaging.views.export_messages_api`.
+"""
+
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from .export import aexport_chunks
+from .instrumentation import track_serialization
+from .models import Message, User
+from .routers import read_from_replica
+from .search import search_user_ids
+from .versions import aget_directory_version, aget_versions
+from .views import (
+    _export_format_error,
+    _export_response,
+    _latest_messages_etag,
+    _latest_messages_payload,
+    _renew_cursor,
+    _reply_error,
+    _save_message,
+    _search_users_payload,
+    _send_message_form_error,
+    _session_timeout_response,
+    _tag_response,
+)
+
+
+def check_session_timeout(view_func):
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        response = await sync_to_async(_session_timeout_response)(request)
+        if response is not None:
+            return response
+
+        return await view_func(request, *args, **kwargs)
+
+    return wrapper
+
+
+def login_required(view_func):
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        # `request.user` is loaded lazily from the session, which is sync-only in this Django version
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+
+        return await view_func(request, *args, **kwargs)
+
+    return wrapper
+
+
+async def _conditional_json_response(request, etag, build_payload):
+    """
+    Async variant of `messaging.views._conditional_json_response`; `build_payload` is a coroutine function.
+    """
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        payload = await build_payload()
+        with track_serialization():
+            response = JsonResponse(payload)
+
+    return _tag_response(response, etag)
+
+
+@check_session_timeout
+@login_required
+@read_from_replica
+async def latest_messages_api(request):
+    """
+    Async variant of `messaging.views.latest_messages_api`. Unchanged inboxes are answered from the cache alone.
+    """
+    versions = await aget_versions(request.user.id)
+    response = await _conditional_json_response(
+        request,
+        _latest_messages_etag(request.user.id, versions),
+        lambda: sync_to_async(_latest_messages_payload)(request.user, request.GET.get('since'))
+    )
+    return _renew_cursor(response, request.user.id, request.GET.get('since'))
+
+
+@check_session_timeout
+@login_required
+@read_from_replica
+async def search_users(request):
+    """
+    Async variant of `messaging.views.search_users`.
+    """
+    query = request.GET.get('username', '').strip()
+    if len(query) < 2:
+        return JsonResponse({'users': []})
+
+    async def build_payload():
+        user_ids = await sync_to_async(search_user_ids)(query, exclude_user_id=request.user.id, limit=5)
+        return _search_users_payload(user_ids, await User.objects.ain_bulk(user_ids))
+
+    return await _conditional_json_response(
+        request, f"{request.user.id}-{await aget_directory_version()}", build_payload)
+
+
+@check_session_timeout
+@login_required
+async def send_message(request):
+    """
+    Async variant of `messaging.views.send_message`.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    recipient_username = request.POST.get('recipient')
+    content = request.POST.get('content')
+    reply_to = request.POST.get('reply_to')
+
+    error = _send_message_form_error(recipient_username, content)
+    if error is not None:
+        return error
+
+    try:
+        recipient = await User.objects.aget(username=recipient_username)
+    except User.DoesNotExist:
+        return JsonResponse({
+            'error': 'Recipient not found',
+            'field': 'recipient'
+        }, status=400)
+
+    parent_message = None
+    if reply_to:
+        try:
+            parent_message = await Message.objects.aget(id=reply_to)
+        except Message.DoesNotExist:
+            parent_message = None
+        except Exception:
+            return JsonResponse({
+                'error': 'An error occurred',
+                'field': 'recipient'
+            }, status=500)
+
+        error = _reply_error(parent_message, request.user, recipient)
+        if error is not None:
+            return error
+
+    try:
+        # The save, the thread summary and the on-commit hooks share one transaction, which needs a sync block
+        await sync_to_async(_save_message)(Message(
+            sender=request.user,
+            recipient=recipient,
+            content=content,
+            parent_message=parent_message
+        ))
+        return JsonResponse({'success': True})
+
+    except Exception as e:
+        return JsonResponse({
+            'error': str(e),
+            'field': 'content'
+        }, status=500)
+
+
+@check_session_timeout
+@login_required
+async def export_messages_api(request):
+    """
+    Async variant of `messaging.views.export_messages_api`. The export is streamed from an async iterator, which ASGI
+    responses consume one chunk at a time (a sync one would be read whole before the first byte is sent).
+    """
+    error = _export_format_error(request)
+    if error is not None:
+        return error
+    return _export_response(request, aexport_chunks)
@@ -0,0 +1,239 @@
+"""
+Load-testing harness for the messaging endpoints, used by the `benchmark` management command.
+
+The harness seeds a synthetic dataset, then drives the endpoints with concurrent simulated clients through the Django
+test client (full middleware stack, no network), and reports latency percentiles, throughput and query counts per
+endpoint as a JSON-serializable dict. Reports of two commits can be compared with `compare_reports`.
+
+Every simulated client logs in as a random seeded user and sends `requests_per_client` requests, each picking an
+endpoint from a weighted mix:
+    - `latest_messages`: Polls `latest_messages_api` like the messages page does, with `If-None-Match` and the sync cursor.
+    - `search_users`: Searches users with a 2 to 4 character fragment of a seeded name.
+    - `send_message`: Sends a new message or a reply to one of the user's threads.
+    - `messages_view`: Renders the messages page.
+
+Constants:
+    - `DEFAULT_MIX`: The default endpoint weights.
+
+Functions:
+    - `seed_dataset(users, threads, mean_replies, max_replies, rng)`: Creates the synthetic users and threads.
+    - `run_load(user_ids, clients, requests_per_client, mix, rng_seed)`: Runs the simulated clients and returns the
+      raw samples.
+    - `summarize(samples, wall_time)`: Aggregates samples into per-endpoint statistics.
+    - `compare_reports(baseline, current)`: Returns the relative change of every statistic between two reports.
+"""
+
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import Message, ThreadParticipant, User
+from .sync import SYNC_CURSOR_HEADER
+
+DEFAULT_MIX = {'latest_messages': 60, 'search_users': 20, 'send_message': 10, 'messages_view': 10}
+
+FIRST_NAMES = ['Ada', 'Alan', 'Grace', 'Linus', 'Barbara', 'Edsger', 'Margaret', 'Dennis', 'Frances', 'Ken']
+LAST_NAMES = ['Lovelace', 'Turing', 'Hopper', 'Torvalds', 'Liskov', 'Dijkstra', 'Hamilton', 'Ritchie', 'Allen', 'Thompson']
+
+# Statistics compared by `compare_reports`; for all of them lower is better except throughput
+COMPARED_STATS = ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries_mean')
+
+
+def seed_dataset(users=100, threads=500, mean_replies=5, max_replies=50, rng=None):
+    """
+    Creates `users` users and `threads` threads between random pairs of them. Reply counts follow an exponential
+    distribution with mean `mean_replies`, capped at `max_replies`, so most threads are short and a few are long.
+    Returns the ids of the created users.
+    """
+    rng = rng or random.Random(0)
+    offset = User.objects.count()
+
+    created = []
+    for i in range(users):
+        user = User(
+            username=f'bench_user{offset + i}',
+            first_name=FIRST_NAMES[i % len(FIRST_NAMES)],
+            last_name=f'{LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]}{i}'
+        )
+        user.set_unusable_password()
+        user.save()
+        created.append(user.id)
+
+    pairs = [tuple(rng.sample(created, 2)) for _ in range(threads)]
+    roots = Message.bulk_send([
+        Message(sender_id=sender_id, recipient_id=recipient_id, content=f'Thread {i} from the benchmark')
+        for i, (sender_id, recipient_id) in enumerate(pairs)
+    ])
+
+    replies = []
+    for root, (sender_id, recipient_id) in zip(roots, pairs):
+        for i in range(min(max_replies, int(rng.expovariate(1 / mean_replies)) if mean_replies else 0)):
+            # Participants take turns
+            author, other = (recipient_id, sender_id) if i % 2 == 0 else (sender_id, recipient_id)
+            replies.append(Message(sender_id=author, recipient_id=other, content=f'Reply {i}', parent_message=root))
+    Message.bulk_send(replies)
+
+    return created
+
+
+class _SimulatedClient:
+    """
+    One simulated user. `build_<endpoint>()` prepares a request as `(method, url, data, headers)` outside of the
+    measured section, so the queries needed to pick a recipient are not counted against the endpoint.
+    """
+    def __init__(self, user_id, rng):
+        self.user_id = user_id
+        self.username = User.objects.values_list('username', flat=True).get(pk=user_id)
+        self.rng = rng
+        self.client = Client(raise_request_exception=False)
+        self.client.force_login(User.objects.get(pk=user_id))
+        self.etag = None
+        self.cursor = None
+
+    def build_latest_messages(self):
+        headers = {'HTTP_IF_NONE_MATCH': self.etag} if self.etag else {}
+        return 'get', reverse('latest_messages_api'), {'since': self.cursor} if self.cursor else {}, headers
+
+    def build_search_users(self):
+        name = self.rng.choice(FIRST_NAMES + LAST_NAMES).lower()
+        start = self.rng.randrange(0, len(name) - 1)
+        return 'get', reverse('search_users'), {'username': name[start:start + self.rng.randint(2, 4)]}, {}
+
+    def build_send_message(self):
+        data = {'content': f'Benchmark message {self.rng.random()}'}
+        thread = ThreadParticipant.objects.filter(user_id=self.user_id).values(
+            'thread_id', 'thread__root__sender__username', 'thread__root__recipient__username'
+        ).order_by('?').first()
+
+        if thread and self.rng.random() < 0.7:
+            usernames = {thread['thread__root__sender__username'], thread['thread__root__recipient__username']}
+            data.update(reply_to=thread['thread_id'], recipient=(usernames - {self.username} or usernames).pop())
+        else:
+            data['recipient'] = User.objects.exclude(pk=self.user_id).order_by('?').values_list(
+                'username', flat=True).first()
+        return 'post', reverse('send_message'), data, {}
+
+    def build_messages_view(self):
+        return 'get', reverse('messages'), {}, {}
+
+    def observe(self, endpoint, response):
+        if endpoint == 'latest_messages' and response.status_code == 200:
+            self.etag = response['ETag']
+            self.cursor = response.json()['cursor']
+        elif endpoint == 'latest_messages' and response.status_code == 304:
+            self.cursor = response.get(SYNC_CURSOR_HEADER, self.cursor)
+
+
+def _client_session(user_id, requests_per_client, mix, rng_seed, close_connection=False):
+    rng = random.Random(rng_seed)
+    endpoints, weights = zip(*mix.items())
+    samples = []
+    try:
+        simulated = _SimulatedClient(user_id, rng)
+        for endpoint in rng.choices(endpoints, weights, k=requests_per_client):
+            method, url, data, headers = getattr(simulated, f'build_{endpoint}')()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                try:
+                    response = getattr(simulated.client, method)(url, data, **headers)
+                except Exception:
+                    response = None
+                elapsed = time.perf_counter() - start
+
+            if response is not None:
+                simulated.observe(endpoint, response)
+            samples.append({
+                'endpoint': endpoint,
+                'seconds': elapsed,
+                'status': response.status_code if response is not None else None,
+                'queries': len(queries)
+            })
+    finally:
+        # Worker threads open their own connection, which would otherwise stay open
+        if close_connection:
+            connection.close()
+    return samples
+
+
+def run_load(user_ids, clients=10, requests_per_client=50, mix=None, rng_seed=0):
+    """
+    Runs `clients` simulated clients, each as a random user of `user_ids`, and returns the samples with the wall time
+    of the run. With one client everything runs in the calling thread, which also sees uncommitted data.
+    """
+    mix = {endpoint: weight for endpoint, weight in (mix or DEFAULT_MIX).items() if weight > 0}
+    rng = random.Random(rng_seed)
+    jobs = [(rng.choice(user_ids), requests_per_client, mix, rng_seed + i) for i in range(clients)]
+
+    start = time.perf_counter()
+    if clients == 1:
+        results = [_client_session(*jobs[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            results = list(executor.map(lambda job: _client_session(*job, close_connection=True), jobs))
+    wall_time = time.perf_counter() - start
+
+    return [sample for samples in results for sample in samples], wall_time
+
+
+def _percentile(sorted_values, percent):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(samples, wall_time):
+    endpoints = {}
+    for sample in samples:
+        endpoints.setdefault(sample['endpoint'], []).append(sample)
+
+    stats = {}
+    for endpoint, endpoint_samples in sorted(endpoints.items()):
+        latencies = sorted(sample['seconds'] * 1000 for sample in endpoint_samples)
+        queries = [sample['queries'] for sample in endpoint_samples]
+        statuses = {}
+        for sample in endpoint_samples:
+            statuses[str(sample['status'])] = statuses.get(str(sample['status']), 0) + 1
+
+        stats[endpoint] = {
+            'requests': len(endpoint_samples),
+            'errors': sum(1 for sample in endpoint_samples if sample['status'] is None or sample['status'] >= 500),
+            'statuses': statuses,
+            'p50_ms': round(_percentile(latencies, 50), 3),
+            'p95_ms': round(_percentile(latencies, 95), 3),
+            'p99_ms': round(_percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'throughput_rps': round(len(endpoint_samples) / wall_time, 2) if wall_time else None,
+            'queries_mean': round(sum(queries) / len(queries), 2),
+            'queries_max': max(queries),
+        }
+
+    return {
+        'wall_time_s': round(wall_time, 3),
+        'requests': len(samples),
+        'throughput_rps': round(len(samples) / wall_time, 2) if wall_time else None,
+        'endpoints': stats,
+    }
+
+
+def compare_reports(baseline, current):
+    """
+    Returns `{endpoint: {stat: relative_change}}` for the endpoints present in both reports, where 0.1 means the
+    statistic grew by 10%.
+    """
+    changes = {}
+    for endpoint, stats in current['results']['endpoints'].items():
+        base = baseline.get('results', {}).get('endpoints', {}).get(endpoint)
+        if not base:
+            continue
+        changes[endpoint] = {
+            stat: round((stats[stat] - base[stat]) / base[stat], 4)
+            for stat in COMPARED_STATS if base.get(stat) and stats.get(stat) is not None
+        }
+    return changes
@@ -0,0 +1,111 @@
+"""
+Plain ASGI WebSocket endpoint that pushes new message events to the logged-in user.
+
+`whatsapp/asgi.py` routes `websocket` connections on `WEBSOCKET_PATH` here; every other request goes to Django.
+The connection is authenticated with the regular Django session cookie and subscribes to the user's events on the
+configured pub/sub hub (see `messaging.pubsub`). Each event is sent as one JSON text frame, for example:
+
+    {"type": "message", "thread_id": 12, "message": {"id": 15, "sender_name": "...", ...}}
+
+Connections are rejected (closed with code 4401) when the user is not logged in or the session has timed out, and
+(closed with code 4403) when the `Origin` header does not match the `Host` header. The session is checked again
+before every event is pushed, and every `SESSION_CHECK_INTERVAL` seconds while no event arrives, so a connection is
+closed with code 4401 once its user logs out or the session times out.
+
+Functions:
+    - `websocket_application(scope, receive, send)`: The ASGI application for WebSocket connections.
+"""
+
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.utils.module_loading import import_string
+
+from .activity import is_idle_expired
+from .pubsub import get_hub
+
+WEBSOCKET_PATH = '/ws/messages/'
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+
+SESSION_CHECK_INTERVAL = 60
+
+
+def _headers(scope):
+    return {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope.get('headers', [])}
+
+
+def _authenticate(session_key):
+    """
+    Loads the session and returns its user id, or None when the session is missing, anonymous or timed out.
+    """
+    from .views import SESSION_IDLE_TIMEOUT
+
+    session = import_string(settings.SESSION_ENGINE).SessionStore(session_key)
+    user = get_user(SimpleNamespace(session=session))
+    if not user.is_authenticated:
+        return None
+
+    if is_idle_expired(session, SESSION_IDLE_TIMEOUT):
+        return None
+
+    return user.id
+
+
+def _same_origin(headers):
+    origin = headers.get('origin')
+    return origin is None or urlsplit(origin).netloc == headers.get('host')
+
+
+async def websocket_application(scope, receive, send):
+    if (await receive())['type'] != 'websocket.connect':
+        return
+
+    headers = _headers(scope)
+    if not _same_origin(headers):
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+
+    cookie = SimpleCookie(headers.get('cookie', ''))
+    session_cookie = cookie.get(settings.SESSION_COOKIE_NAME)
+    user_id = await sync_to_async(_authenticate)(session_cookie.value) if session_cookie else None
+    if user_id is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    hub = get_hub()
+    subscription = hub.subscribe(user_id)
+    await send({'type': 'websocket.accept'})
+
+    async def forward_events():
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), SESSION_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                event = None
+
+            # The user may have logged out, or let the session time out, since the connection was accepted
+            if await sync_to_async(_authenticate)(session_cookie.value) != user_id:
+                await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+                return
+            if event is not None:
+                await send({'type': 'websocket.send', 'text': json.dumps(event)})
+
+    async def wait_for_disconnect():
+        # Clients never need to send anything; just wait for the disconnect
+        while (await receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(forward_events()), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(subscription)
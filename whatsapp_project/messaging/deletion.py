@@ -0,0 +1,142 @@
+"""
+Chunked deletion of users and their conversations, in constant memory.
+
+`user.delete()` hands every message of the user to Django's deletion collector, which loads them all into memory to
+apply the `on_delete` rules of every relation pointing at `Message` (replies, thread keys, thread summaries, search
+postings) before deleting anything. `delete_user` deletes the same rows with set-based SQL in batches of
+`batch_size` messages instead, each batch in its own transaction, holding no more than one batch of ids at a time:
+
+1. Threads are deleted whole (every message of a thread is between its two participants), picked from the user's
+   `ThreadParticipant` rows so that a batch holds whole small threads or part of one large thread.
+2. Within a batch, messages are taken from the highest `sequence` down, so a reply is always deleted before, or
+   together with, the messages it points at, and the root goes last with the thread summary.
+3. Each batch nulls the reply pointers and thread summaries that point into it with one UPDATE each, then deletes the
+   search postings, the thread summaries and participants, and the messages with one DELETE each.
+4. Once no message is left, their archived threads are removed from the archive files (`messaging.archive.purge_user`),
+   then the user row itself is deleted with the regular ORM (its remaining relations are small).
+
+An interrupted deletion leaves every remaining thread intact and can simply be run again. The other participants'
+inboxes are invalidated after every batch. Thread summaries left without messages are deleted when met; should the
+same threads come back without any message deleted, `delete_user` raises `RuntimeError` rather than loop forever.
+
+Constants:
+    - `DELETE_BATCH_SIZE`: Messages deleted per batch (and transaction) by default.
+
+Functions:
+    - `delete_user(user, batch_size, progress)`: Deletes `user` with all their threads; returns the deletion counts.
+"""
+
+from functools import partial
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import Message, MessageSearchToken, Thread, ThreadParticipant, User, _message_committed
+from .snapshots import invalidate_snapshots
+from .versions import bump_directory_version
+
+# Also keeps `IN (...)` lists under SQLite's default limit of 999 parameters
+DELETE_BATCH_SIZE = 500
+
+
+def _delete_in(model, field_name, ids):
+    quote = connection.ops.quote_name
+    column = model._meta.get_field(field_name).column
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {quote(model._meta.db_table)} WHERE {quote(column)} IN ({', '.join(['%s'] * len(ids))})",
+            ids
+        )
+        return cursor.rowcount
+
+
+def _next_roots(user_id, batch_size):
+    """
+    Returns the roots of the user's next threads to delete: as many whole threads as fit in `batch_size` messages,
+    or a single thread when the first one is larger.
+    """
+    roots = []
+    size = 0
+    for root_id, message_count in ThreadParticipant.objects.filter(user_id=user_id).values_list(
+            'thread_id', 'thread__message_count')[:batch_size]:
+        if roots and size + message_count > batch_size:
+            break
+        roots.append(root_id)
+        size += message_count
+    if roots:
+        return roots
+
+    # Threads without a summary row (started before summaries existed)
+    for field in ('sender_id', 'recipient_id'):
+        root_id = Message.objects.filter(**{field: user_id}).values_list('root_id', flat=True).first()
+        if root_id is not None:
+            return [root_id]
+    return []
+
+
+def _delete_rows(rows):
+    """
+    Deletes a batch of messages given as `(id, root_id, sender_id, recipient_id)` rows, with everything pointing at
+    them, and the summaries of the threads whose root is in the batch. Returns the number of deleted threads.
+    """
+    ids = [row[0] for row in rows]
+    Message.objects.filter(parent_message_id__in=ids).update(parent_message=None)
+    Thread.objects.filter(last_message_id__in=ids).update(last_message=None)
+    _delete_in(MessageSearchToken, 'message', ids)
+    thread_ids = [message_id for message_id, root_id, _, _ in rows if message_id == root_id]
+    if thread_ids:
+        _delete_in(ThreadParticipant, 'thread', thread_ids)
+        _delete_in(Thread, 'root', thread_ids)
+    _delete_in(Message, 'id', ids)
+    return len(thread_ids)
+
+
+def _delete_batch(roots, batch_size):
+    with transaction.atomic():
+        rows = list(Message.objects.filter(root_id__in=roots).order_by('-sequence').values_list(
+            'id', 'root_id', 'sender_id', 'recipient_id')[:batch_size])
+        if not rows:
+            # Summaries left behind by threads that have no message any more
+            _delete_in(ThreadParticipant, 'thread', roots)
+            _delete_in(Thread, 'root', roots)
+            return 0, 0
+
+        threads = _delete_rows(rows)
+        user_ids = {user_id for row in rows for user_id in row[2:]}
+        transaction.on_commit(partial(_message_committed, *user_ids))
+    return len(rows), threads
+
+
+def delete_user(user, batch_size=DELETE_BATCH_SIZE, progress=None):
+    """
+    Deletes `user`, every thread they take part in and everything indexed for them, in batches of `batch_size`
+    messages. `progress(deleted_messages, total_messages)` is called after every batch.
+    Returns a dict with the numbers of deleted `messages`, `threads` (archived ones included) and `batches`.
+    """
+    total = Message.objects.filter(Q(sender_id=user.pk) | Q(recipient_id=user.pk)).count()
+    counts = {'messages': 0, 'threads': 0, 'batches': 0}
+
+    stalled_roots = None
+    while True:
+        roots = _next_roots(user.pk, batch_size)
+        if not roots:
+            break
+        if roots == stalled_roots:
+            raise RuntimeError(f'Deleting user {user.pk} makes no progress on threads {roots}')
+        messages, threads = _delete_batch(roots, batch_size)
+        stalled_roots = roots if not messages else None
+        counts['messages'] += messages
+        counts['threads'] += threads
+        counts['batches'] += 1
+        if progress is not None:
+            progress(counts['messages'], max(total, counts['messages']))
+
+    # The archive imports this module
+    from .archive import purge_user
+
+    counts['threads'] += purge_user(user.pk)
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).delete()
+        transaction.on_commit(bump_directory_version)
+        transaction.on_commit(partial(invalidate_snapshots, user.pk))
+    return counts
@@ -0,0 +1,169 @@
+"""
+Streaming export of a user's full conversation history, as NDJSON or CSV, optionally gzip-compressed.
+
+An export holds no more than one chunk of threads and one output buffer at a time, whatever the size of the history,
+and its first bytes are produced as soon as the first threads are read:
+
+- Threads are walked by id in chunks of `THREAD_CHUNK_SIZE` (a keyset query per chunk, so no cursor stays open
+  between chunks), and the messages of each chunk are read with `.iterator(chunk_size=ROW_CHUNK_SIZE)`, through the
+  `(root, sequence)` index, in thread order.
+- Threads moved to the archive (see `messaging.archive`) follow, read from their archive members one at a time.
+- Encoded rows are gathered into chunks of about `FLUSH_SIZE` bytes, compressed on the fly when asked to.
+
+Used by `messaging.views.export_messages_api` (through a `StreamingHttpResponse`) and `manage.py export_messages`.
+
+Constants:
+    - `EXPORT_FORMATS`: The content type of each export format (`ndjson`, `csv`).
+    - `EXPORT_FIELDS`: The fields of every exported message, in CSV column order.
+
+Functions:
+    - `export_rows(user)`: Yields every message of the user's threads as a dict of `EXPORT_FIELDS`.
+    - `export_chunks(user, export_format, compress)`: Yields the encoded export as byte chunks.
+    - `aexport_chunks(user, export_format, compress)`: Async iterator over `export_chunks`, for ASGI responses.
+"""
+
+import csv
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from django.utils import timezone
+
+from .archive import GZIP_WBITS, read_thread
+from .models import ArchivedThread, Message, ThreadParticipant
+from .serializers import message_rows
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+EXPORT_FIELDS = (
+    'thread_id', 'id', 'parent_message_id', 'sequence', 'sender', 'recipient', 'content', 'timestamp', 'archived'
+)
+
+THREAD_CHUNK_SIZE = 500
+ROW_CHUNK_SIZE = 2000
+FLUSH_SIZE = 64 * 1024
+
+
+def _export_row(row, usernames, archived):
+    return {
+        'thread_id': row['root_id'],
+        'id': row['id'],
+        'parent_message_id': row['parent_message_id'],
+        'sequence': row['sequence'],
+        'sender': usernames.get(row['sender_id'], ''),
+        'recipient': usernames.get(row['recipient_id'], ''),
+        'content': row['content'],
+        'timestamp': timezone.localtime(row['timestamp']).isoformat(),
+        'archived': archived,
+    }
+
+
+def _hot_rows(user):
+    last_thread_id = 0
+    while True:
+        thread_ids = list(ThreadParticipant.objects.filter(user=user, thread_id__gt=last_thread_id).order_by(
+            'thread_id').values_list('thread_id', flat=True)[:THREAD_CHUNK_SIZE])
+        if not thread_ids:
+            return
+        last_thread_id = thread_ids[-1]
+
+        usernames = dict(ThreadParticipant.objects.filter(thread_id__in=thread_ids).values_list(
+            'user_id', 'user__username'))
+        for row in message_rows(Message.objects.filter(root_id__in=thread_ids).order_by(
+                'root_id', 'sequence')).iterator(chunk_size=ROW_CHUNK_SIZE):
+            yield _export_row(row, usernames, False)
+
+
+def _archived_rows(user):
+    last_thread_id = 0
+    while True:
+        threads = list(ArchivedThread.objects.filter(
+            Q(sender=user) | Q(recipient=user), thread_id__gt=last_thread_id
+        ).select_related('sender', 'recipient').order_by('thread_id')[:THREAD_CHUNK_SIZE])
+        if not threads:
+            return
+        last_thread_id = threads[-1].thread_id
+
+        for archived in threads:
+            usernames = {participant.id: participant.username for participant in (archived.sender, archived.recipient)}
+            for row in read_thread(archived):
+                yield _export_row(row, usernames, True)
+
+
+def export_rows(user):
+    """
+    Yields every message of the threads `user` takes part in, thread by thread in thread order: hot threads first,
+    then archived ones.
+    """
+    yield from _hot_rows(user)
+    yield from _archived_rows(user)
+
+
+def _encode_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+class _Echo:
+    # File-like object handing back what is written, so `csv.writer` encodes one row at a time
+    def write(self, value):
+        return value
+
+
+def _encode_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow([row[field] for field in EXPORT_FIELDS])
+
+
+_ENCODERS = {
+    'ndjson': _encode_ndjson,
+    'csv': _encode_csv,
+}
+
+
+def export_chunks(user, export_format='ndjson', compress=False):
+    """
+    Yields the export of `user`'s history in `export_format` as byte chunks of about `FLUSH_SIZE` bytes (before
+    compression), gzip-compressed when `compress` is true.
+    """
+    compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+    buffer = []
+    size = 0
+
+    def flush():
+        data = ''.join(buffer).encode()
+        buffer.clear()
+        return compressor.compress(data) if compressor else data
+
+    for text in _ENCODERS[export_format](export_rows(user)):
+        buffer.append(text)
+        size += len(text)
+        if size >= FLUSH_SIZE:
+            size = 0
+            data = flush()
+            if data:
+                yield data
+
+    data = flush() + (compressor.flush() if compressor else b'')
+    if data:
+        yield data
+
+
+async def aexport_chunks(user, export_format='ndjson', compress=False):
+    """
+    Async variant of `export_chunks`. Every chunk is produced in the same sync thread, which keeps the database
+    connection of the export.
+    """
+    chunks = export_chunks(user, export_format, compress)
+    next_chunk = sync_to_async(next)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,276 @@
+"""
+Per-request latency and query instrumentation, exported in the Prometheus text format.
+
+`RequestMetricsMiddleware` times every request and attributes it to the URL name of the view that served it. While a
+request runs, its `RequestStats` are held in a context variable, so code running for it in any thread (including the
+`sync_to_async` threads of async views) adds to the same stats:
+    - **DB queries**: An execute wrapper installed on every database connection (see `install_query_tracking`) counts
+      the queries and their time, and keeps their SQL for the slow-request log.
+    - **Serialization**: `track_serialization()` blocks around message serialization, JSON encoding and template
+      rendering (for views returning a `TemplateResponse`).
+
+Totals are aggregated per (view, method, status) in a process-wide registry and served by `metrics_view` (the
+`/metrics/` URL) to staff users and `INTERNAL_IPS` (empty by default; behind a reverse proxy on the same host, listing
+127.0.0.1 would open the metrics to everyone). Each worker process exports its own totals, so scrape every worker or
+add them up in the monitoring system.
+
+Requests slower than `MESSAGING_SLOW_REQUEST_THRESHOLD` seconds (a setting, 0.5 by default) are logged as warnings to
+the `messaging.slow_requests` logger, together with their slowest SQL statements.
+
+Classes:
+1. **RequestStats**
+    - Query count, DB time, serialization time and the slowest queries of one request.
+
+2. **MetricsRegistry**
+    - Thread-safe counters, sums and a latency histogram per (view, method, status).
+    - `observe(view, method, status, duration, stats)`: Records one finished request.
+    - `add_collector(collector)`: Adds a callable returning more metric lines (e.g. gauges read at scrape time).
+    - `render()`: Returns the metrics in the Prometheus text exposition format.
+
+3. **RequestMetricsMiddleware**
+    - Sync and async capable middleware recording every request in the registry. Place it first in `MIDDLEWARE`.
+
+Functions:
+    - `install_query_tracking(sender, connection, **kwargs)`: `connection_created` receiver adding the execute wrapper.
+    - `track_serialization()`: Context manager adding the time spent in its block to the current request.
+    - `get_registry()`: Returns the process-wide `MetricsRegistry`.
+    - `metrics_view(request)`: Serves the metrics.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+slow_request_logger = logging.getLogger('messaging.slow_requests')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Queries kept per request for the slow-request log, and how many of them are logged
+SLOW_QUERY_CANDIDATES = 20
+SLOW_QUERIES_LOGGED = 5
+
+_current_stats = ContextVar('messaging_request_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.slowest_queries = []
+
+    def add_query(self, sql, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        self.slowest_queries.append((seconds, sql))
+        if len(self.slowest_queries) > SLOW_QUERY_CANDIDATES:
+            self.slowest_queries.sort(key=lambda query: query[0], reverse=True)
+            del self.slowest_queries[SLOW_QUERY_CANDIDATES:]
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_tracking(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+@contextmanager
+def track_serialization():
+    stats = _current_stats.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.serialization_seconds += time.perf_counter() - start
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._collectors = []
+
+    def add_collector(self, collector):
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def observe(self, view, method, status, duration, stats):
+        with self._lock:
+            series = self._series.setdefault((view, method, str(status)), {
+                'count': 0, 'seconds': 0.0, 'queries': 0, 'db_seconds': 0.0, 'serialization_seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+            })
+            series['count'] += 1
+            series['seconds'] += duration
+            series['queries'] += stats.queries
+            series['db_seconds'] += stats.db_seconds
+            series['serialization_seconds'] += stats.serialization_seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    series['buckets'][i] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._series.items())
+            series = [(key, dict(values, buckets=list(values['buckets']))) for key, values in series]
+
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+
+        def labels(view, method, status=None, **extra):
+            pairs = {'view': view, 'method': method, **({'status': status} if status else {}), **extra}
+            return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in pairs.items()) + '}'
+
+        family('whatsapp_http_requests_total', 'counter', 'Requests served, by view, method and status.', [
+            f'whatsapp_http_requests_total{labels(*key)} {values["count"]}' for key, values in series
+        ])
+
+        # The histogram is per view and method; statuses are added up
+        histograms = {}
+        for (view, method, _), values in series:
+            histogram = histograms.setdefault((view, method), {
+                'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'seconds': 0.0})
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], values['buckets'])]
+            histogram['count'] += values['count']
+            histogram['seconds'] += values['seconds']
+
+        samples = []
+        for (view, method), histogram in sorted(histograms.items()):
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                samples.append(f'whatsapp_http_request_duration_seconds_bucket{labels(view, method, le=bound)} {count}')
+            samples.append(
+                f'whatsapp_http_request_duration_seconds_bucket{labels(view, method, le="+Inf")} {histogram["count"]}')
+            samples.append(f'whatsapp_http_request_duration_seconds_sum{labels(view, method)} {histogram["seconds"]:.6f}')
+            samples.append(f'whatsapp_http_request_duration_seconds_count{labels(view, method)} {histogram["count"]}')
+        family('whatsapp_http_request_duration_seconds', 'histogram', 'Wall time of requests, by view.', samples)
+
+        for name, field, help_text in (
+            ('whatsapp_db_queries_total', 'queries', 'Database queries run by requests.'),
+            ('whatsapp_db_query_duration_seconds_total', 'db_seconds', 'Time requests spent in database queries.'),
+            ('whatsapp_serialization_duration_seconds_total', 'serialization_seconds',
+             'Time requests spent serializing messages, encoding JSON and rendering templates.'),
+        ):
+            family(name, 'counter', help_text, [
+                f'{name}{labels(*key)} {_format_value(values[field])}' for key, values in series
+            ])
+
+        for collector in self._collectors:
+            lines.extend(collector())
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return f'{value:.6f}' if isinstance(value, float) else str(value)
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats, token, start = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        self._finish(request, response, stats, start)
+        return response
+
+    async def __acall__(self, request):
+        stats, token, start = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        self._finish(request, response, stats, start)
+        return response
+
+    def _start(self):
+        stats = RequestStats()
+        return stats, _current_stats.set(stats), time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # Template responses are rendered after the view returns; time the rendering as serialization
+        render = response.render
+
+        def timed_render():
+            with track_serialization():
+                return render()
+
+        response.render = timed_render
+        return response
+
+    def _finish(self, request, response, stats, start):
+        duration = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name if match else None) or 'unresolved'
+        get_registry().observe(view, request.method, response.status_code, duration, stats)
+
+        threshold = getattr(settings, 'MESSAGING_SLOW_REQUEST_THRESHOLD', 0.5)
+        if threshold is not None and duration > threshold:
+            slowest = sorted(stats.slowest_queries, key=lambda query: query[0], reverse=True)[:SLOW_QUERIES_LOGGED]
+            slow_request_logger.warning(
+                'Slow request: %s %s (%s) took %.3fs, %d queries in %.3fs, serialization %.3fs%s',
+                request.method, request.path, view, duration, stats.queries, stats.db_seconds,
+                stats.serialization_seconds,
+                ''.join(f'\n  {seconds:.3f}s {sql}' for seconds, sql in slowest)
+            )
+
+
+def metrics_view(request):
+    """
+    Serves the request metrics in the Prometheus text format, to staff users and clients in `INTERNAL_IPS`.
+    """
+    user = getattr(request, 'user', None)
+    is_staff = user is not None and user.is_authenticated and user.is_staff
+    if not is_staff and request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden()
+
+    return HttpResponse(get_registry().render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,259 @@
+"""
+Database-backed background job queue, for side work that does not need to finish before a request returns.
+
+Tasks are plain functions registered under a name with the `task` decorator (see `messaging.tasks`). A request
+enqueues a task by name with a JSON payload, usually with `enqueue_on_commit` so the job only exists once the data it
+works on is committed; `manage.py worker` processes (one or more, on any host sharing the database) claim and run
+due jobs:
+
+    python manage.py worker --processes 4
+
+- **Claiming**: A worker claims a job with a conditional UPDATE (`pending` -> `running`), so two workers never run
+  the same job, on SQLite as well as on server databases. A job still `running` after `MESSAGING_JOB_LEASE_SECONDS`
+  belongs to a worker that died and is claimed again.
+- **Retries**: A task that raises is retried with exponential backoff until it ran `max_attempts` times, then the job
+  is `failed` and keeps its last traceback. Since a job may run more than once, tasks must be idempotent.
+- **Idempotency keys**: Enqueuing with the key of an existing job returns that job instead of adding another, so a
+  retried request does not duplicate its side work.
+- **Metrics**: The queue depth per queue and status, and the age of the oldest due job, are exported on `/metrics/`.
+
+A job enqueued after its transaction committed is lost if the process dies in between; tasks whose work can be
+recomputed (like the search index) are fine with that. With `MESSAGING_JOBS_EAGER` set, the default unless
+`WHATSAPP_JOBS_EAGER=0` says a worker runs, tasks run inline when enqueued instead (still only once the transaction
+commits with `enqueue_on_commit`, and a failure is logged without undoing the committed work), so a deployment without
+a worker never leaves jobs waiting forever. `manage.py worker` warns when it is started while jobs run inline.
+
+Classes:
+1. **Worker**
+    - Claims and runs jobs of its queues until stopped, sleeping `poll_interval` seconds whenever no job is due.
+    - `run(burst)`: Runs jobs; with `burst`, returns once no job is due instead of waiting for more.
+    - `stop()`: Asks the worker to return after the current job (e.g. from a SIGTERM handler).
+
+Functions:
+    - `task(name, max_attempts, queue)`: Decorator registering a task function under `name`.
+    - `enqueue(name, payload, idempotency_key, queue, delay)`: Adds a job, or returns the job with the same key.
+    - `enqueue_on_commit(name, payload, idempotency_key, queue)`: Enqueues once the current transaction commits.
+    - `run_pending(queues, limit, worker_id)`: Runs the due jobs in the calling process; returns how many ran.
+    - `purge_finished(older_than)`: Deletes jobs that finished more than `older_than` seconds ago.
+    - `queue_metrics()`: Returns the queue depth metrics in the Prometheus text format.
+"""
+
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+logger = logging.getLogger('messaging.jobs')
+
+DEFAULT_QUEUE = 'default'
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Retry delays grow as RETRY_BASE_DELAY * 2 ** (attempt - 1) seconds, up to RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 600
+
+# Due jobs a worker looks at per claim
+CLAIM_BATCH_SIZE = 10
+
+_tasks = {}
+
+
+def task(name, max_attempts=DEFAULT_MAX_ATTEMPTS, queue=DEFAULT_QUEUE):
+    def register(func):
+        _tasks[name] = (func, max_attempts, queue)
+        return func
+
+    return register
+
+
+def _get_task(name):
+    try:
+        return _tasks[name]
+    except KeyError:
+        raise LookupError(f'No task is registered as {name!r}') from None
+
+
+def enqueue(name, payload=None, idempotency_key=None, queue=None, delay=0):
+    """
+    Adds a job running task `name` with `payload` as keyword arguments, after `delay` seconds. Returns the job, or the
+    existing job with the same `idempotency_key`. In eager mode, runs the task at once and returns None.
+    """
+    from .models import Job
+
+    func, max_attempts, default_queue = _get_task(name)
+    payload = payload or {}
+    if getattr(settings, 'MESSAGING_JOBS_EAGER', False):
+        func(**payload)
+        return None
+
+    fields = {
+        'queue': queue or default_queue,
+        'task': name,
+        'payload': payload,
+        'max_attempts': max_attempts,
+        'run_at': timezone.now() + timedelta(seconds=delay),
+    }
+    if idempotency_key is None:
+        return Job.objects.create(**fields)
+    return Job.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)[0]
+
+
+def _run_eager(name, payload):
+    # The transaction that enqueued the task already committed, so a failure is logged rather than raised
+    try:
+        enqueue(name, payload)
+    except Exception:
+        logger.exception('Task %s failed inline', name)
+
+
+def enqueue_on_commit(name, payload=None, idempotency_key=None, queue=None):
+    _get_task(name)
+    if getattr(settings, 'MESSAGING_JOBS_EAGER', False):
+        transaction.on_commit(partial(_run_eager, name, payload))
+    else:
+        transaction.on_commit(partial(enqueue, name, payload, idempotency_key, queue))
+
+
+def _lease_seconds():
+    return getattr(settings, 'MESSAGING_JOB_LEASE_SECONDS', 300)
+
+
+def _claim(worker_id, queues, limit):
+    from .models import Job
+
+    now = timezone.now()
+    due = Q(status=Job.PENDING, run_at__lte=now) | Q(
+        status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=_lease_seconds()))
+    candidates = Job.objects.filter(due)
+    if queues:
+        candidates = candidates.filter(queue__in=queues)
+
+    claimed = []
+    for job in candidates.order_by('run_at', 'id')[:limit]:
+        # Only one worker's UPDATE still matches the state it read
+        updated = Job.objects.filter(pk=job.pk, status=job.status, attempts=job.attempts).update(
+            status=Job.RUNNING, locked_by=worker_id, locked_at=now, attempts=job.attempts + 1)
+        if updated:
+            job.status, job.locked_by, job.locked_at, job.attempts = Job.RUNNING, worker_id, now, job.attempts + 1
+            claimed.append(job)
+    return claimed
+
+
+def _run(job):
+    from .models import Job
+
+    try:
+        func = _get_task(job.task)[0]
+        func(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            logger.error('Job %s (%s) failed after %d attempts:\n%s', job.pk, job.task, job.attempts, error)
+            Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+                status=Job.FAILED, last_error=error, finished_at=timezone.now())
+        else:
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (job.attempts - 1))
+            delay += random.uniform(0, delay / 10)
+            logger.warning('Job %s (%s) attempt %d failed, retrying in %.0fs', job.pk, job.task, job.attempts, delay)
+            Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+                status=Job.PENDING, last_error=error, run_at=timezone.now() + timedelta(seconds=delay))
+        return False
+
+    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(status=Job.DONE, finished_at=timezone.now())
+    return True
+
+
+def _release(jobs):
+    # Hands back jobs claimed but not started, without counting an attempt
+    from .models import Job
+
+    for job in jobs:
+        Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+            status=Job.PENDING, attempts=job.attempts - 1, locked_by='', locked_at=None)
+
+
+def _default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def run_pending(queues=None, limit=None, worker_id=None):
+    worker_id = worker_id or _default_worker_id()
+    ran = 0
+    while limit is None or ran < limit:
+        batch = CLAIM_BATCH_SIZE if limit is None else min(CLAIM_BATCH_SIZE, limit - ran)
+        jobs = _claim(worker_id, queues, batch)
+        if not jobs:
+            break
+        for job in jobs:
+            _run(job)
+            ran += 1
+    return ran
+
+
+def purge_finished(older_than=86400):
+    from .models import Job
+
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return Job.objects.filter(status=Job.DONE, finished_at__lt=cutoff).delete()[0]
+
+
+class Worker:
+    def __init__(self, queues=None, poll_interval=1.0, worker_id=None):
+        self.queues = queues
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or _default_worker_id()
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self, burst=False):
+        logger.info('Worker %s started on queues %s', self.worker_id, ', '.join(self.queues or ['*']))
+        while not self._stopping.is_set():
+            # Like a request, every round starts with usable connections
+            close_old_connections()
+            jobs = _claim(self.worker_id, self.queues, CLAIM_BATCH_SIZE)
+            for i, job in enumerate(jobs):
+                if self._stopping.is_set():
+                    _release(jobs[i:])
+                    break
+                _run(job)
+            if not jobs:
+                if burst:
+                    break
+                self._stopping.wait(self.poll_interval)
+        logger.info('Worker %s stopped', self.worker_id)
+
+
+def queue_metrics():
+    from .models import Job
+
+    counts = Job.objects.filter(status__in=[Job.PENDING, Job.RUNNING, Job.FAILED]).values(
+        'queue', 'status').annotate(jobs=Count('id')).order_by('queue', 'status')
+    oldest = Job.objects.filter(status=Job.PENDING, run_at__lte=timezone.now()).values('queue').annotate(
+        run_at=Min('run_at')).order_by('queue')
+
+    now = timezone.now()
+    lines = [
+        '# HELP whatsapp_job_queue_depth Jobs in the background queue, by queue and status.',
+        '# TYPE whatsapp_job_queue_depth gauge',
+    ]
+    lines.extend(
+        f'whatsapp_job_queue_depth{{queue="{row["queue"]}",status="{row["status"]}"}} {row["jobs"]}' for row in counts)
+    lines.extend([
+        '# HELP whatsapp_job_queue_oldest_due_seconds Time the oldest due job has been waiting, by queue.',
+        '# TYPE whatsapp_job_queue_oldest_due_seconds gauge',
+    ])
+    lines.extend(
+        f'whatsapp_job_queue_oldest_due_seconds{{queue="{row["queue"]}"}} {(now - row["run_at"]).total_seconds():.3f}'
+        for row in oldest)
+    return lines
@@ -0,0 +1,211 @@
+"""
+Non-blocking logging pipeline: request threads only put records on an in-memory queue, and a background listener
+thread formats them and writes them to the real handlers in batches.
+
+Django calls `configure_logging(LOGGING)` (see `LOGGING_CONFIG` in settings). It applies the regular `dictConfig`,
+then, when `LOGGING` has a `queue` section, moves the handlers of every configured logger behind a `QueueHandler`:
+
+    LOGGING = {
+        ...
+        'queue': {
+            'maxsize': 10000,                        # records waiting to be written; more are dropped, not blocked on
+            'batch_size': 500,                       # records written between two flushes of the handlers
+            'debug_sample_rates': {'asyncio': 0.0},  # share of DEBUG records kept, by logger name prefix
+        },
+    }
+
+Without a `queue` section (e.g. `WHATSAPP_LOG_MODE=sync`), handlers are called synchronously as usual.
+
+Classes:
+1. **JsonFormatter** (extends `logging.Formatter`)
+    - Formats records as one JSON object per line: time, level, logger, module, message, exception and any `extra` fields.
+
+2. **SizeAndTimeRotatingFileHandler** (extends `RotatingFileHandler`)
+    - Rotates when the file reaches `maxBytes` or when `interval` seconds have passed since it was opened.
+    - Does not flush after every record; the listener flushes once per batch.
+
+3. **DebugSamplingFilter** (extends `logging.Filter`)
+    - Keeps only a share of the DEBUG records of the configured loggers (longest prefix match); other levels pass.
+
+4. **NonBlockingQueueHandler** (extends `QueueHandler`)
+    - Enqueues records without waiting; when the queue is full the record is dropped and counted in `dropped`.
+
+5. **BatchingQueueListener** (extends `QueueListener`)
+    - Drains up to `batch_size` records at a time, hands them to the handlers and flushes the handlers once per batch.
+
+Functions:
+    - `configure_logging(config)`: `LOGGING_CONFIG` callable applying `config` and starting the listeners.
+    - `stop_listeners()`: Writes every queued record and stops the listeners (also registered with `atexit`).
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.config
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Attributes every `LogRecord` has; anything else on a record came from `extra=` and is added to the JSON output
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listeners = []
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    def __init__(self, filename, interval=None, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+    def emit(self, record):
+        # Same as `RotatingFileHandler.emit`, minus the flush after every record
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class DebugSamplingFilter(logging.Filter):
+    def __init__(self, rates=None):
+        super().__init__()
+        # Longest prefixes first, so 'django.db' wins over 'django'
+        self.rates = sorted((rates or {}).items(), key=lambda item: len(item[0]), reverse=True)
+
+    def rate_for(self, logger_name):
+        for prefix, rate in self.rates:
+            if logger_name == prefix or logger_name.startswith(prefix + '.') or prefix == '':
+                return rate
+        return 1.0
+
+    def filter(self, record):
+        return record.levelno != logging.DEBUG or random.random() < self.rate_for(record.name)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Leave formatting to the listener's handlers; only make the record safe to hand to another thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class BatchingQueueListener(QueueListener):
+    def __init__(self, log_queue, *handlers, batch_size=500):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                    continue
+                self.handle(record)
+
+            for handler in self.handlers:
+                handler.flush()
+            for _ in batch:
+                q.task_done()
+            if stop:
+                return
+
+
+def configure_logging(config):
+    config = copy.deepcopy(config)
+    queue_options = config.pop('queue', None)
+    stop_listeners()
+    logging.config.dictConfig(config)
+    if queue_options is None:
+        return
+
+    sampling = DebugSamplingFilter(queue_options.get('debug_sample_rates'))
+    queue_handlers = {}
+    loggers = [logging.getLogger(name) for name in config.get('loggers', {})]
+    if 'root' in config:
+        loggers.append(logging.getLogger())
+
+    # dict.fromkeys: '' in `loggers` and the `root` section are the same logger
+    for logger in dict.fromkeys(loggers):
+        if not logger.handlers:
+            continue
+
+        # Loggers sharing the same handlers share one queue and one listener
+        handlers = tuple(logger.handlers)
+        if handlers not in queue_handlers:
+            log_queue = queue.Queue(queue_options.get('maxsize', 10000))
+            handler = NonBlockingQueueHandler(log_queue)
+            handler.addFilter(sampling)
+            listener = BatchingQueueListener(log_queue, *handlers, batch_size=queue_options.get('batch_size', 500))
+            listener.start()
+            _listeners.append(listener)
+            queue_handlers[handlers] = handler
+
+        logger.handlers = [queue_handlers[handlers]]
+
+
+def stop_listeners():
+    while _listeners:
+        _listeners.pop().stop()
+
+
+atexit.register(stop_listeners)
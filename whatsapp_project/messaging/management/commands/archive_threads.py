@@ -0,0 +1,42 @@
+"""
+Management command that moves idle threads out of the `Message` table into archive segments (see `messaging.archive`):
+
+    python manage.py archive_threads                         # threads idle for MESSAGING_ARCHIVE_AFTER_DAYS days
+    python manage.py archive_threads --older-than-days 90 --limit 10000
+
+Meant to run on a schedule (e.g. nightly from cron). A run started while another one is still going exits with an
+error instead.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.archive import ARCHIVE_BATCH_SIZE, ArchiveLocked, archive_idle_threads
+
+
+class Command(BaseCommand):
+    help = 'Archives threads idle for longer than the retention period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.MESSAGING_ARCHIVE_AFTER_DAYS,
+                            help='Archive threads without activity for this many days.')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                            help='Threads written per archive sync.')
+        parser.add_argument('--limit', type=int, help='Archive at most this many threads.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        try:
+            archived = archive_idle_threads(
+                older_than=timedelta(days=options['older_than_days']),
+                batch_size=options['batch_size'],
+                limit=options['limit'],
+                progress=lambda count: self.stdout.write(f'{count} threads archived'),
+            )
+        except ArchiveLocked:
+            raise CommandError('Another archiver is running.')
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} threads.'))
@@ -0,0 +1,119 @@
+"""
+Management command that load-tests the messaging endpoints (see `messaging.benchmark`).
+
+The benchmark runs against a throwaway test database, created and seeded for the run and destroyed afterwards, so it
+never touches real data. The report is printed (or written to `--output`) as JSON:
+
+    python manage.py benchmark --users 200 --threads 1000 --clients 20 --output bench.json
+    python manage.py benchmark --compare bench.json
+
+With `--compare`, the report also holds the relative change of every statistic against the given baseline report.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from messaging.benchmark import DEFAULT_MIX, compare_reports, run_load, seed_dataset, summarize
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_mix(value):
+    try:
+        mix = {name: int(weight) for name, weight in (item.split('=') for item in value.split(','))}
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected weights like latest_messages=60,search_users=20')
+
+    unknown = mix.keys() - DEFAULT_MIX.keys()
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic dataset in a test database and load-tests the messaging endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Number of synthetic users.')
+        parser.add_argument('--threads', type=int, default=500, help='Number of synthetic threads.')
+        parser.add_argument('--mean-replies', type=float, default=5, help='Mean replies per thread.')
+        parser.add_argument('--max-replies', type=int, default=50, help='Most replies in one thread.')
+        parser.add_argument('--clients', type=int, default=10, help='Concurrent simulated clients.')
+        parser.add_argument('--requests', type=int, default=50, help='Requests sent by each client.')
+        parser.add_argument('--mix', type=_parse_mix, default=DEFAULT_MIX,
+                            help='Endpoint weights, e.g. latest_messages=60,search_users=20,send_message=10.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for repeatable runs.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+        parser.add_argument('--compare', help='Baseline JSON report to compare against.')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2')
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Worker threads need a database they can all open; in-memory SQLite test databases lock on writes
+            if connection.vendor == 'sqlite':
+                connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                # Sessions and versions must not leak into (or come from) the real cache
+                with override_settings(
+                    ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                    CACHES={'default': {
+                        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'messaging-benchmark'
+                    }}
+                ):
+                    report = self._run(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if baseline is not None:
+            report['comparison'] = {'baseline_commit': baseline.get('commit'), 'changes': compare_reports(baseline, report)}
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def _run(self, options):
+        rng = random.Random(options['seed'])
+        self.stderr.write(f"Seeding {options['users']} users and {options['threads']} threads...")
+        user_ids = seed_dataset(
+            options['users'], options['threads'], options['mean_replies'], options['max_replies'], rng)
+
+        self.stderr.write(f"Running {options['clients']} clients x {options['requests']} requests...")
+        samples, wall_time = run_load(
+            user_ids, options['clients'], options['requests'], options['mix'], options['seed'])
+
+        return {
+            'commit': _git_commit(),
+            'config': {key: options[key] for key in (
+                'users', 'threads', 'mean_replies', 'max_replies', 'clients', 'requests', 'mix', 'seed')},
+            'database': connection.vendor,
+            'results': summarize(samples, wall_time),
+        }
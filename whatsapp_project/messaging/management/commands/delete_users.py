@@ -0,0 +1,48 @@
+"""
+Management command that deletes users with all their threads in fixed-size batches (see `messaging.deletion`):
+
+    python manage.py delete_users alice bob
+    python manage.py delete_users alice --batch-size 200 --noinput
+
+Progress is reported after every batch. An interrupted run can be started again and continues with the threads left.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.deletion import DELETE_BATCH_SIZE, delete_user
+from messaging.models import User
+
+
+class Command(BaseCommand):
+    help = 'Deletes users and every thread they take part in, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='+', help='Usernames of the users to delete.')
+        parser.add_argument('--batch-size', type=int, default=DELETE_BATCH_SIZE,
+                            help='Messages deleted per batch, each in its own transaction.')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Do not ask for confirmation.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        users = list(User.objects.filter(username__in=options['usernames']))
+        missing = set(options['usernames']) - {user.username for user in users}
+        if missing:
+            raise CommandError(f"Unknown users: {', '.join(sorted(missing))}")
+
+        if options['interactive']:
+            answer = input(f"This deletes {', '.join(user.username for user in users)} and all their messages. "
+                           "Type 'yes' to continue: ")
+            if answer != 'yes':
+                raise CommandError('Deletion cancelled.')
+
+        for user in users:
+            def progress(deleted, total, username=user.username):
+                self.stdout.write(f'{username}: {deleted}/{total} messages deleted')
+
+            counts = delete_user(user, batch_size=options['batch_size'], progress=progress)
+            self.stdout.write(self.style.SUCCESS(
+                f"Deleted {user.username} with {counts['messages']} messages in {counts['threads']} threads "
+                f"({counts['batches']} batches)."))
@@ -0,0 +1,42 @@
+"""
+Management command that writes a user's full conversation history to a file (see `messaging.export`):
+
+    python manage.py export_messages alice                          # NDJSON on stdout
+    python manage.py export_messages alice --format csv --gzip --output alice.csv.gz
+
+Rows are written as they are read, so memory use does not grow with the history.
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.export import EXPORT_FORMATS, export_chunks
+from messaging.models import User
+
+
+class Command(BaseCommand):
+    help = "Exports a user's conversation history as NDJSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='Username of the user to export.')
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson', help='Export format.')
+        parser.add_argument('--gzip', action='store_true', help='Compress the export with gzip.')
+        parser.add_argument('--output', default='-', help='File to write to; stdout by default.')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f"Unknown user: {options['username']}")
+
+        chunks = export_chunks(user, options['format'], options['gzip'])
+        if options['output'] == '-':
+            self._write(sys.stdout.buffer, chunks)
+        else:
+            with open(options['output'], 'wb') as output:
+                self._write(output, chunks)
+
+    def _write(self, output, chunks):
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
@@ -0,0 +1,86 @@
+"""
+Management command that runs background job workers (see `messaging.jobs`):
+
+    python manage.py worker                      # one worker, all queues, until stopped
+    python manage.py worker --processes 4        # four worker processes, to use more cores
+    python manage.py worker --queue default --burst
+
+SIGTERM and SIGINT stop the workers after their current job. Finished jobs older than `--retention` seconds are
+purged when the command starts. Jobs only reach the workers once the web processes run with `WHATSAPP_JOBS_EAGER=0`;
+the command warns otherwise.
+"""
+
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from messaging.jobs import Worker, purge_finished
+from messaging.log_pipeline import stop_listeners
+
+
+def _run_worker(queues, poll_interval, burst):
+    worker = Worker(queues=queues, poll_interval=poll_interval)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: worker.stop())
+    worker.run(burst=burst)
+
+
+def _run_worker_process(queues, poll_interval, burst):
+    # Under the spawn start method the child process starts without Django set up
+    import django
+
+    django.setup()
+    try:
+        _run_worker(queues, poll_interval, burst)
+    finally:
+        # Child processes exit without running `atexit` handlers, which would drop the queued log records
+        stop_listeners()
+
+
+class Command(BaseCommand):
+    help = 'Runs background job workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', action='append', dest='queues',
+                            help='Queue to take jobs from (repeatable); all queues by default.')
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to run.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before looking for jobs again when none is due.')
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due.')
+        parser.add_argument('--retention', type=int, default=86400,
+                            help='Seconds finished jobs are kept before being purged.')
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError('--processes must be at least 1')
+        if settings.MESSAGING_JOBS_EAGER:
+            self.stderr.write(self.style.WARNING(
+                'Jobs run inline when enqueued (MESSAGING_JOBS_EAGER); set WHATSAPP_JOBS_EAGER=0 for the web '
+                'processes to hand them to the workers.'))
+
+        purged = purge_finished(options['retention'])
+        if purged:
+            self.stdout.write(f'Purged {purged} finished jobs.')
+
+        worker_args = (options['queues'], options['poll_interval'], options['burst'])
+        if options['processes'] == 1:
+            _run_worker(*worker_args)
+            return
+
+        # Forked children must not share the parent's database connections
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_run_worker_process, args=worker_args, name=f'worker-{i}')
+            for i in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+
+        # Children receive the terminal's SIGINT themselves; forward SIGTERM to them
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *args: [process.terminate() for process in processes])
+        for process in processes:
+            process.join()
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_threads(apps, schema_editor):
+    Message = apps.get_model('messaging', 'Message')
+    Thread = apps.get_model('messaging', 'Thread')
+    ThreadParticipant = apps.get_model('messaging', 'ThreadParticipant')
+
+    stats = {
+        row['parent_message_id']: row
+        for row in Message.objects.exclude(parent_message=None).values('parent_message_id').annotate(
+            last_id=models.Max('id'), last_at=models.Max('timestamp'), replies=models.Count('id'))
+    }
+
+    for root in Message.objects.filter(parent_message=None).values('id', 'sender_id', 'recipient_id', 'timestamp').iterator():
+        replies = stats.get(root['id'])
+        last_activity_at = max(root['timestamp'], replies['last_at']) if replies else root['timestamp']
+        thread = Thread.objects.create(
+            root_id=root['id'],
+            last_message_id=replies['last_id'] if replies else root['id'],
+            last_activity_at=last_activity_at,
+            message_count=(replies['replies'] if replies else 0) + 1,
+        )
+        ThreadParticipant.objects.bulk_create([
+            ThreadParticipant(thread=thread, user_id=user_id, last_activity_at=last_activity_at)
+            for user_id in {root['sender_id'], root['recipient_id']}
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0009_alter_messagereadstatus_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thread',
+            fields=[
+                ('root', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='thread', serialize=False, to='messaging.message')),
+                ('last_activity_at', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaging.message')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThreadParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity_at', models.DateTimeField()),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='messaging.thread')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thread_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.DeleteModel(
+            name='MessageReadStatus',
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='participants',
+            field=models.ManyToManyField(related_name='threads', through='messaging.ThreadParticipant', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='threadparticipant',
+            index=models.Index(fields=['user', '-last_activity_at'], name='participant_activity_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='threadparticipant',
+            unique_together={('thread', 'user')},
+        ),
+        migrations.RunPython(backfill_threads, migrations.RunPython.noop),
+    ]
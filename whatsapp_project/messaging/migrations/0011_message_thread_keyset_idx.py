@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0010_thread'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['parent_message', 'timestamp', 'id'], name='message_thread_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_existing_users(apps, schema_editor):
+    User = apps.get_model('messaging', 'User')
+    UserSearchTerm = apps.get_model('messaging', 'UserSearchTerm')
+    UserSearchGram = apps.get_model('messaging', 'UserSearchGram')
+
+    for user in User.objects.only('id', 'username', 'first_name', 'last_name').iterator():
+        terms = [(0, user.username.lower()), (1, (user.first_name or '').lower()), (1, (user.last_name or '').lower())]
+        terms = [(kind, term) for kind, term in terms if term]
+        grams = {term[i:i + size] for _, term in terms for size in (2, 3) for i in range(len(term) - size + 1)}
+
+        UserSearchTerm.objects.bulk_create([UserSearchTerm(user_id=user.id, kind=kind, term=term) for kind, term in terms])
+        UserSearchGram.objects.bulk_create([UserSearchGram(user_id=user.id, gram=gram) for gram in grams])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0011_message_thread_keyset_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(0, 'Username'), (1, 'Name')])),
+                ('term', models.CharField(max_length=150)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term'], name='search_term_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserSearchGram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_grams', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('gram', 'user')},
+            },
+        ),
+        migrations.RunPython(index_existing_users, migrations.RunPython.noop),
+    ]
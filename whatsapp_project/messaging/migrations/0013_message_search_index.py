@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+
+def index_existing_messages(apps, schema_editor):
+    Message = apps.get_model('messaging', 'Message')
+    MessageSearchToken = apps.get_model('messaging', 'MessageSearchToken')
+
+    batch = []
+    for message in Message.objects.values('id', 'sender_id', 'recipient_id', 'content').iterator():
+        tokens = {word[:64] for word in re.findall(r'\w+', message['content'].lower())}
+        batch.extend(
+            MessageSearchToken(user_id=user_id, token=token, message_id=message['id'])
+            for user_id in {message['sender_id'], message['recipient_id']}
+            for token in tokens
+        )
+        if len(batch) >= 5000:
+            MessageSearchToken.objects.bulk_create(batch)
+            batch = []
+    MessageSearchToken.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0012_user_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='messaging.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'token', 'message')},
+            },
+        ),
+        migrations.RunPython(index_existing_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:26
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def mark_history_read(apps, schema_editor):
+    # Existing threads have no read state; treat everything sent so far as read instead of flooding every inbox
+    Thread = apps.get_model('messaging', 'Thread')
+    ThreadParticipant = apps.get_model('messaging', 'ThreadParticipant')
+
+    last_message = Thread.objects.filter(pk=OuterRef('thread_id')).values('last_message_id')[:1]
+    ThreadParticipant.objects.update(last_read_message_id=Coalesce(Subquery(last_message), 0), unread_count=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0013_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='threadparticipant',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='threadparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_history_read, migrations.RunPython.noop),
+    ]
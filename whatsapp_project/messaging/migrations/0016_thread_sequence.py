@@ -0,0 +1,89 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:58
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def backfill_thread_keys(apps, schema_editor):
+    Message = apps.get_model('messaging', 'Message')
+    Thread = apps.get_model('messaging', 'Thread')
+    ThreadParticipant = apps.get_model('messaging', 'ThreadParticipant')
+
+    # A parent is always older than its replies, so walking messages in id order resolves every parent's root
+    # before its replies are reached, whatever the reply depth
+    roots = {}
+    last_sequences = {}
+    batch = []
+    for message_id, parent_id in Message.objects.order_by('id').values_list(
+            'id', 'parent_message_id').iterator(chunk_size=BATCH_SIZE):
+        root_id = roots.get(parent_id, message_id) if parent_id is not None else message_id
+        roots[message_id] = root_id
+        sequence = 0 if root_id == message_id else last_sequences.get(root_id, 0) + 1
+        last_sequences[root_id] = sequence
+        batch.append(Message(id=message_id, root_id=root_id, sequence=sequence))
+        if len(batch) == BATCH_SIZE:
+            Message.objects.bulk_update(batch, ['root', 'sequence'])
+            batch = []
+    Message.objects.bulk_update(batch, ['root', 'sequence'])
+
+    # Replies to replies used to start summaries of their own, keyed by the reply
+    Thread.objects.filter(root__parent_message__isnull=False).delete()
+
+    def per_thread(aggregate):
+        return Subquery(Message.objects.filter(root_id=OuterRef('pk')).order_by().values('root_id').annotate(
+            value=aggregate).values('value'))
+
+    Thread.objects.update(
+        message_count=per_thread(Count('id')),
+        last_message_id=per_thread(Max('id')),
+        last_activity_at=per_thread(Max('timestamp')),
+        last_sequence=per_thread(Max('sequence')),
+    )
+
+    unread = Message.objects.filter(
+        root_id=OuterRef('thread_id'),
+        recipient_id=OuterRef('user_id'),
+        id__gt=OuterRef('last_read_message_id'),
+    ).exclude(sender_id=OuterRef('user_id')).order_by().values('root_id').annotate(value=Count('id')).values('value')
+    ThreadParticipant.objects.update(
+        unread_count=Coalesce(Subquery(unread), 0),
+        last_activity_at=Subquery(Thread.objects.filter(pk=OuterRef('thread_id')).values('last_activity_at')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0015_job_queue'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_thread_keyset_idx',
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='root',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thread_messages', to='messaging.message'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_thread_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('root', 'sequence'), name='message_thread_sequence_uniq'),
+        ),
+    ]
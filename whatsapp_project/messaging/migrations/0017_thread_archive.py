@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0016_thread_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedThread',
+            fields=[
+                ('thread_id', models.PositiveBigIntegerField(primary_key=True, serialize=False)),
+                ('message_count', models.PositiveIntegerField()),
+                ('last_sequence', models.PositiveIntegerField()),
+                ('last_activity_at', models.DateTimeField()),
+                ('segment', models.CharField(max_length=255)),
+                ('offset', models.PositiveBigIntegerField()),
+                ('length', models.PositiveBigIntegerField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['last_activity_at'], name='thread_activity_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedthread',
+            name='recipient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='archivedthread',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='archivedthread',
+            index=models.Index(fields=['sender', '-last_activity_at'], name='archived_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedthread',
+            index=models.Index(fields=['recipient', '-last_activity_at'], name='archived_recipient_idx'),
+        ),
+    ]
@@ -6,6 +6,7 @@ The `User` model extends Django's `AbstractUser` to customize the user model wit
 Models:
 1. **User**
     - Extends `AbstractUser` to provide custom validation for the `username` and `password` fields.
+    - Saving a user whose names may have changed re-indexes them for search (see `messaging.search`) and bumps the directory version (see `messaging.versions`).
     - Fields:
         - `username`: A `CharField` (max length 150) that is unique and validated to start with a letter and allow only letters, numbers, and underscores.
         - `first_name`: A `CharField` (max length 30) representing the user's first name.
@@ -22,15 +23,90 @@ Models:
         - `content`: A `TextField` containing the content of the message (max length 1024).
         - `timestamp`: A `DateTimeField` automatically set when the message is created.
         - `parent_message`: A `ForeignKey` to the `Message` model, allowing replies to be linked to the original message. Set to `null` and `blank` to allow non-reply messages.
+        - `root`: A `ForeignKey` to the root message of the thread, at any reply depth (a root points at itself). Set when the message is inserted, so a whole thread is one `root_id` equality lookup.
+        - `sequence`: The position of the message in its thread: 0 for the root, then 1, 2, ... in sending order. Numbers are never reused, even after deletions.
+    - Constraints:
+        - `message_thread_sequence_uniq` on `(root, sequence)`, also used to page through a thread in order.
 
     Methods:
+        - `save(self, *args, **kwargs)`: Saves the message and, for newly created messages, sets its `root` and `sequence` and updates the denormalized `Thread` row in the same transaction. Once it commits, bumps the inbox version of both participants, invalidates their cached inbox snapshots and enqueues the search indexing job.
+        - `bulk_send(cls, messages)`: Same as `save` for many new messages at once, with a fixed number of statements for new threads (used by the broadcast API).
         - `__str__(self)`: Returns a string representation of the message in the format:
           "Message from {sender.username} to {recipient.username} at {timestamp}"
+
+3. **Thread**
+    - Denormalized summary of a conversation, keyed by its root message (so `thread.pk` equals the root message id used as `thread_id` by the API).
+    - Fields:
+        - `root`: A `OneToOneField` to the root `Message` of the thread, used as the primary key.
+        - `participants`: A `ManyToManyField` to `User` through `ThreadParticipant`.
+        - `last_message`: A `ForeignKey` to the newest `Message` in the thread.
+        - `last_activity_at`: A `DateTimeField` holding the timestamp of the newest message (root or reply).
+        - `message_count`: A `PositiveIntegerField` counting the messages in the thread, root included.
+        - `last_sequence`: The highest `Message.sequence` handed out in the thread.
+    - Indexes:
+        - `thread_activity_idx` on `last_activity_at`, used to find idle threads to archive.
+
+    Methods:
+        - `allocate_sequences(cls, root_id, count)`: Reserves the next `count` sequence numbers of a thread and returns the first. The thread row stays locked until the transaction ends, so concurrent replies are numbered one after the other.
+        - `record_message(cls, message)`: Creates or updates the thread summary for a newly saved message.
+        - `record_messages(cls, messages)`: Bulk variant of `record_message`.
+        - `rebuild(cls, root_id)`: Recomputes the thread summary for `root_id` from the `Message` table.
+
+4. **ThreadParticipant**
+    - One row per (thread, user). Holds a copy of `last_activity_at` so the inbox of a user is a single range scan over the `(user, -last_activity_at)` index instead of an `OR` over sender and recipient.
+    - Read state is a high-water mark: `last_read_message_id` is the newest message the user has read in the thread, and `unread_count` counts the messages they received after it. The count is kept up to date on every write, so unread badges are read from the same rows as the inbox.
+
+    Methods:
+        - `mark_read(self, message_id)`: Moves the high-water mark forward to `message_id` and recounts unread messages.
+        - `refresh_unread_count(self)`: Recounts unread messages from the `Message` table and saves the read state.
+
+5. **UserSearchTerm**
+    - One row per searchable term of a user: the lowercased username (`kind` USERNAME) and first and last names (`kind` NAME). Indexed on `term` for exact and prefix lookups.
+
+6. **UserSearchGram**
+    - One row per distinct bigram and trigram of a user's terms. Indexed on `(gram, user)` for substring lookups.
+
+7. **MessageSearchToken**
+    - Inverted index of message content: one row per (participant, word, message), written by a background job once the message is committed. Indexed on `(user, token, message)`, so a search only reads the requesting user's postings.
+
+8. **Job**
+    - One unit of background work of the job queue (see `messaging.jobs`): a registered task name, its JSON payload, and its state.
+    - Fields:
+        - `queue`: The name of the queue the job is taken from by workers.
+        - `task`: The registered name of the task to run.
+        - `payload`: A `JSONField` of keyword arguments for the task.
+        - `idempotency_key`: Optional unique key; enqueuing a job with the key of an existing job returns the existing job.
+        - `status`: `pending`, `running`, `done` or `failed` (attempts exhausted).
+        - `attempts` and `max_attempts`: Runs so far, and the most runs before the job fails.
+        - `run_at`: The job is not run before this time (used to back off retries).
+        - `locked_by` and `locked_at`: The worker running the job and when it claimed it; jobs claimed longer than the lease ago are claimed again.
+        - `last_error`: The traceback of the last failed attempt.
+        - `created_at` and `finished_at`: When the job was enqueued and when it finished or failed.
+    - Indexes:
+        - `job_claim_idx` on `(queue, status, run_at)`, used by workers to find due jobs.
+
+9. **ArchivedThread**
+    - Index entry of a thread moved out of the `Message` table into an archive segment file (see `messaging.archive`). Keyed by the id of its root message, so archived threads keep their `thread_id`.
+    - Fields:
+        - `sender` and `recipient`: The participants of the thread (the sender and recipient of its root message).
+        - `message_count`, `last_sequence` and `last_activity_at`: The thread summary at the time it was archived.
+        - `segment`: The path of the segment file holding the thread, relative to `MESSAGING_ARCHIVE_DIR`.
+        - `offset` and `length`: Where the thread's gzip member starts in the segment and its size in bytes.
+        - `archived_at`: When the thread was archived.
+    - Indexes:
+        - `archived_sender_idx` and `archived_recipient_idx` on `(sender, -last_activity_at)` and `(recipient, -last_activity_at)`, used to list a user's archived threads.
 """
 
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Max, Q, Value, When
+from functools import partial
+
+from .jobs import enqueue_on_commit
+from .search import INDEX_BATCH_SIZE, index_user
+from .snapshots import invalidate_snapshots
+from .versions import bump_directory_version, bump_inbox_version
 
 class User(AbstractUser):
     username = models.CharField(
@@ -71,12 +147,345 @@ class User(AbstractUser):
         help_text='Specific permissions for this user.',
         verbose_name='user permissions',
     )
+
+    def save(self, *args, **kwargs):
+        # Names appear in search results and message payloads; logins (last_login only) don't change them
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'username', 'first_name', 'last_name'} & set(update_fields):
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            index_user(self)
+            transaction.on_commit(bump_directory_version)
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField(max_length=1024)
     timestamp = models.DateTimeField(auto_now_add=True)
     parent_message = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
+    root = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='thread_messages')
+    sequence = models.PositiveIntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            if self.parent_message_id is not None:
+                self.root_id = _root_ids([self])[self.parent_message_id]
+                self.sequence = Thread.allocate_sequences(self.root_id)
+            super().save(*args, **kwargs)
+            if self.root_id is None:
+                # A root's id is only known once inserted
+                self.root_id = self.id
+                Message.objects.filter(pk=self.pk).update(root_id=self.id)
+            Thread.record_message(self)
+            transaction.on_commit(partial(_message_committed, self.sender_id, self.recipient_id))
+            _enqueue_indexing([self.id])
+
+    @classmethod
+    def bulk_send(cls, messages):
+        """
+        Saves unsaved `messages` with one INSERT and records their threads and read state in bulk, all in one
+        transaction. Returns the saved messages, with their ids set.
+        """
+        with transaction.atomic():
+            root_ids = _root_ids(messages)
+            replies = {}
+            for message in messages:
+                if message.parent_message_id is not None:
+                    message.root_id = root_ids[message.parent_message_id]
+                    replies.setdefault(message.root_id, []).append(message)
+            for root_id, thread_replies in replies.items():
+                first = Thread.allocate_sequences(root_id, len(thread_replies))
+                for i, message in enumerate(thread_replies):
+                    message.sequence = first + i
+
+            messages = cls.objects.bulk_create(messages)
+            roots = [message for message in messages if message.root_id is None]
+            if roots:
+                cls.objects.filter(pk__in=[message.id for message in roots]).update(root_id=F('id'))
+                for message in roots:
+                    message.root_id = message.id
+            Thread.record_messages(messages)
+            user_ids = {user_id for message in messages for user_id in (message.sender_id, message.recipient_id)}
+            transaction.on_commit(partial(_message_committed, *user_ids))
+            for start in range(0, len(messages), INDEX_BATCH_SIZE):
+                _enqueue_indexing([message.id for message in messages[start:start + INDEX_BATCH_SIZE]])
+        return messages
+
+    class Meta:
+        constraints = [
+            # Loading a thread, and keyset pagination through it, are range scans of this index
+            models.UniqueConstraint(fields=['root', 'sequence'], name='message_thread_sequence_uniq'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.username} to {self.recipient.username} at {self.timestamp}"
+
+
+def _root_ids(messages):
+    """
+    Returns `{parent_message_id: root_id}` for the replies among unsaved `messages`, with one query for the parents
+    that are not loaded yet.
+    """
+    root_ids = {}
+    for message in messages:
+        if message.parent_message_id is not None and Message.parent_message.is_cached(message):
+            root_ids[message.parent_message_id] = message.parent_message.root_id
+    missing = {message.parent_message_id for message in messages if message.parent_message_id is not None} - root_ids.keys()
+    if missing:
+        root_ids.update(Message.objects.filter(pk__in=missing).values_list('id', 'root_id'))
+    return root_ids
+
+
+def _message_committed(*user_ids):
+    # Write-through invalidation of everything cached for the participants' inboxes
+    bump_inbox_version(*user_ids)
+    invalidate_snapshots(*user_ids)
+
+
+def _enqueue_indexing(message_ids):
+    # Search results may trail the send by a moment; the inbox and its versions may not, so threads stay inline
+    enqueue_on_commit(
+        'messaging.index_messages',
+        {'message_ids': message_ids},
+        idempotency_key=f'index-messages:{message_ids[0]}-{message_ids[-1]}'
+    )
+
+
+class Thread(models.Model):
+    root = models.OneToOneField(Message, on_delete=models.CASCADE, primary_key=True, related_name='thread')
+    participants = models.ManyToManyField(User, through='ThreadParticipant', related_name='threads')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_activity_at = models.DateTimeField()
+    message_count = models.PositiveIntegerField(default=0)
+    last_sequence = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_activity_at'], name='thread_activity_idx'),
+        ]
+
+    @classmethod
+    def allocate_sequences(cls, root_id, count=1):
+        # The UPDATE takes the row (or, on SQLite, the database) write lock before the counter is read back
+        if not cls.objects.filter(pk=root_id).update(last_sequence=F('last_sequence') + count):
+            # Threads started before the summary table existed are built on their first reply
+            cls.rebuild(root_id)
+            cls.objects.filter(pk=root_id).update(last_sequence=F('last_sequence') + count)
+        return cls.objects.values_list('last_sequence', flat=True).get(pk=root_id) - count + 1
+
+    @classmethod
+    def record_message(cls, message):
+        root_id = message.root_id
+
+        if message.parent_message_id is None:
+            thread = cls.objects.create(
+                root_id=root_id,
+                last_message=message,
+                last_activity_at=message.timestamp,
+                message_count=1
+            )
+            ThreadParticipant.objects.bulk_create([
+                ThreadParticipant(
+                    thread=thread,
+                    user_id=user_id,
+                    last_activity_at=message.timestamp,
+                    last_read_message_id=message.id if user_id == message.sender_id else 0,
+                    unread_count=0 if user_id == message.sender_id else 1
+                )
+                for user_id in {message.sender_id, message.recipient_id}
+            ])
+            return
+
+        # The thread row exists: `allocate_sequences` built it if needed
+        cls.objects.filter(pk=root_id).update(
+            last_message=message,
+            last_activity_at=message.timestamp,
+            message_count=F('message_count') + 1
+        )
+        # Sending a message marks the thread as read for the sender and unread for everyone else
+        is_sender = Q(user_id=message.sender_id)
+        ThreadParticipant.objects.filter(thread_id=root_id).update(
+            last_activity_at=message.timestamp,
+            last_read_message_id=Case(
+                When(is_sender, then=Value(message.id)),
+                default=F('last_read_message_id'),
+                output_field=models.PositiveBigIntegerField()
+            ),
+            unread_count=Case(
+                When(is_sender, then=Value(0)),
+                default=F('unread_count') + 1,
+                output_field=models.PositiveIntegerField()
+            )
+        )
+
+    @classmethod
+    def record_messages(cls, messages):
+        """
+        Bulk variant of `record_message`: every new root creates its thread and participants with two INSERTs in
+        total; replies are recorded one by one.
+        """
+        roots = [message for message in messages if message.parent_message_id is None]
+        cls.objects.bulk_create([
+            cls(root_id=message.id, last_message=message, last_activity_at=message.timestamp, message_count=1)
+            for message in roots
+        ])
+        ThreadParticipant.objects.bulk_create([
+            ThreadParticipant(
+                thread_id=message.id,
+                user_id=user_id,
+                last_activity_at=message.timestamp,
+                last_read_message_id=message.id if user_id == message.sender_id else 0,
+                unread_count=0 if user_id == message.sender_id else 1
+            )
+            for message in roots
+            for user_id in {message.sender_id, message.recipient_id}
+        ])
+
+        for message in messages:
+            if message.parent_message_id is not None:
+                cls.record_message(message)
+
+    @classmethod
+    def rebuild(cls, root_id):
+        root = Message.objects.filter(pk=root_id).values('sender_id', 'recipient_id', 'timestamp').first()
+        if root is None:
+            return None
+
+        stats = Message.objects.filter(root_id=root_id).exclude(pk=root_id).aggregate(
+            last_id=Max('id'), last_at=Max('timestamp'), replies=Count('id'), last_sequence=Max('sequence'))
+        last_activity_at = max(root['timestamp'], stats['last_at'] or root['timestamp'])
+
+        thread, _ = cls.objects.update_or_create(root_id=root_id, defaults={
+            'last_message_id': stats['last_id'] or root_id,
+            'last_activity_at': last_activity_at,
+            'message_count': stats['replies'] + 1,
+            'last_sequence': stats['last_sequence'] or 0,
+        })
+        for user_id in {root['sender_id'], root['recipient_id']}:
+            participant, _ = ThreadParticipant.objects.update_or_create(
+                thread=thread, user_id=user_id, defaults={'last_activity_at': last_activity_at})
+            participant.refresh_unread_count()
+        return thread
+
+    def __str__(self):
+        return f"Thread {self.pk} ({self.message_count} messages, last activity {self.last_activity_at})"
+
+
+class ThreadParticipant(models.Model):
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='thread_memberships')
+    last_activity_at = models.DateTimeField()
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    def mark_read(self, message_id):
+        """
+        Moves the read high-water mark forward to `message_id` (it never moves back) and recounts unread messages.
+        """
+        if message_id > self.last_read_message_id:
+            self.last_read_message_id = message_id
+            self.refresh_unread_count()
+
+    def refresh_unread_count(self):
+        self.unread_count = Message.objects.filter(
+            root_id=self.thread_id,
+            recipient_id=self.user_id,
+            id__gt=self.last_read_message_id
+        ).exclude(sender_id=self.user_id).count()
+        ThreadParticipant.objects.filter(pk=self.pk).update(
+            last_read_message_id=self.last_read_message_id, unread_count=self.unread_count)
+
+    class Meta:
+        unique_together = ('thread', 'user')
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], name='participant_activity_idx'),
+        ]
+
+
+class UserSearchTerm(models.Model):
+    USERNAME = 0
+    NAME = 1
+    KIND_CHOICES = [(USERNAME, 'Username'), (NAME, 'Name')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='search_terms')
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    term = models.CharField(max_length=150)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term'], name='search_term_idx'),
+        ]
+
+
+class UserSearchGram(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='search_grams')
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        unique_together = ('gram', 'user')
+
+
+class MessageSearchToken(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    token = models.CharField(max_length=64)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='search_tokens')
+
+    class Meta:
+        unique_together = ('user', 'token', 'message')
+
+
+class Job(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    queue = models.CharField(max_length=50, default='default')
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField()
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['queue', 'status', 'run_at'], name='job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} job {self.pk} ({self.status})"
+
+
+class ArchivedThread(models.Model):
+    thread_id = models.PositiveBigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    message_count = models.PositiveIntegerField()
+    last_sequence = models.PositiveIntegerField()
+    last_activity_at = models.DateTimeField()
+    segment = models.CharField(max_length=255)
+    offset = models.PositiveBigIntegerField()
+    length = models.PositiveBigIntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', '-last_activity_at'], name='archived_sender_idx'),
+            models.Index(fields=['recipient', '-last_activity_at'], name='archived_recipient_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived thread {self.thread_id} ({self.message_count} messages)"
@@ -0,0 +1,79 @@
+"""
+Keyset pagination helpers for the inbox list and per-thread history APIs.
+
+Offsets get slower the deeper a client scrolls; keyset pagination instead remembers the sort key of the last row
+sent and asks for the rows strictly before it, which is a bounded index range scan on every page. The key is handed
+to clients as an opaque `before` token: `(last_activity_at, thread_id)` for the inbox list, and the message's
+`sequence` within its thread for thread histories.
+
+Constants:
+    - `INBOX_PAGE_SIZE`: Threads per page of the inbox list.
+    - `THREAD_PAGE_SIZE`: Messages per page of a thread's history (also the number of messages per thread in the
+      inbox snapshot of `latest_messages_api`).
+
+Functions:
+    - `encode_keyset(timestamp, pk)`: Returns the `before` token for a row.
+    - `decode_keyset(token)`: Returns `(timestamp, pk)`, or raises `InvalidPageToken`. Tokens are client input, so
+      their numbers must be ASCII digits that fit in a 64-bit column and their timestamps must carry a time zone.
+    - `keyset_before(timestamp_field, pk_field, token)`: Returns a `Q` selecting rows sorted strictly before `token`
+      in `(timestamp, pk)` descending order.
+    - `encode_sequence(sequence)`: Returns the `before` token for a message of a thread history.
+    - `decode_sequence(token)`: Returns the sequence number, or raises `InvalidPageToken`.
+"""
+
+import re
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils.encoding import force_str
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+INBOX_PAGE_SIZE = 20
+THREAD_PAGE_SIZE = 30
+
+# Numbers in tokens: ASCII digits that fit in a 64-bit integer, like the ids of `messaging.views.ID_RE`
+NUMBER_RE = re.compile(r'[0-9]{1,18}')
+
+
+class InvalidPageToken(Exception):
+    """Raised when a `before` token cannot be decoded."""
+
+
+def _decode_number(value):
+    if not NUMBER_RE.fullmatch(value):
+        raise ValueError(value)
+    return int(value)
+
+
+def encode_keyset(timestamp, pk):
+    return urlsafe_base64_encode(f"{timestamp.isoformat()}|{pk}".encode())
+
+
+def decode_keyset(token):
+    try:
+        timestamp, pk = force_str(urlsafe_base64_decode(token)).split('|')
+        timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is None:
+            raise ValueError(timestamp)
+        return timestamp, _decode_number(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidPageToken(f"Invalid page token: {token!r}")
+
+
+def keyset_before(timestamp_field, pk_field, token):
+    timestamp, pk = decode_keyset(token)
+    return Q(**{f'{timestamp_field}__lt': timestamp}) | Q(**{timestamp_field: timestamp, f'{pk_field}__lt': pk})
+
+
+def encode_sequence(sequence):
+    return urlsafe_base64_encode(f"seq|{sequence}".encode())
+
+
+def decode_sequence(token):
+    try:
+        prefix, sequence = force_str(urlsafe_base64_decode(token)).split('|')
+        if prefix != 'seq':
+            raise ValueError(prefix)
+        return _decode_number(sequence)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidPageToken(f"Invalid page token: {token!r}")
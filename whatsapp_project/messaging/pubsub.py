@@ -0,0 +1,182 @@
+"""
+Publish/subscribe hub used to push message events to connected clients.
+
+Views publish events for a user id; WebSocket connections (see `messaging.consumers`) subscribe to the events of the
+logged-in user. The hub class is selected with the `MESSAGING_PUBSUB_HUB` setting (a dotted path), so the default
+in-process implementation can be swapped for a broker-backed one without touching the views or the consumers.
+
+Classes:
+1. **BaseHub**
+    - Interface every hub implements.
+    - `publish(user_id, event)`: Delivers `event` (a JSON-serializable dict) to every subscriber of `user_id`. Safe to call from sync code running in any thread.
+    - `subscribe(user_id)`: Returns a `Subscription` whose `get()` coroutine yields the events of `user_id`.
+    - `unsubscribe(subscription)`: Stops delivery to `subscription`.
+
+2. **InProcessHub** (extends `BaseHub`)
+    - Keeps one bounded `asyncio.Queue` per subscription, in memory. Publishers in worker threads hand events to the subscriber's event loop with `call_soon_threadsafe`.
+    - Only connections served by the same process receive events; run a single ASGI worker or use `RedisHub`.
+    - Slow subscribers whose queue is full miss events; clients recover them through the delta sync of the latest messages API.
+
+3. **RedisHub** (extends `InProcessHub`)
+    - Publishes events to Redis pub/sub channels (`CHANNEL_PREFIX` + user id) on `MESSAGING_PUBSUB_URL`, so every process serving WebSockets receives them. Needs the `redis` package.
+    - Each process runs one listener thread, started with the first subscription, that takes every event from Redis and hands those of its own subscribers to the in-process delivery.
+    - Events published while the listener reconnects to Redis are missed; clients recover them like the events dropped by full queues.
+
+Functions:
+    - `get_hub()`: Returns the process-wide hub instance configured in settings.
+    - `publish_message(message)`: Publishes a `message` event to the sender and the recipient of a saved `Message`.
+    - `publish_messages(messages)`: Same as `publish_message` for many messages, resolving every name with one query.
+
+Publishing is best effort: when the hub fails (e.g. Redis is down) the error is logged and the messages stay sent;
+clients pick them up through the delta sync of the latest messages API.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .serializers import MESSAGE_FIELDS, UserNameCache, serialize_rows
+
+logger = logging.getLogger('messaging.pubsub')
+
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+CHANNEL_PREFIX = 'messaging:events:'
+
+# Seconds the Redis listener waits before reconnecting after losing its connection
+RECONNECT_DELAY = 1
+
+
+class Subscription:
+    def __init__(self, user_id, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+
+class BaseHub:
+    def publish(self, user_id, event):
+        raise NotImplementedError
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+
+class InProcessHub(BaseHub):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:  # The subscriber's event loop is already closed
+                self.unsubscribe(subscription)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+
+class RedisHub(InProcessHub):
+    def __init__(self, url=None):
+        super().__init__()
+        import redis
+
+        self._redis = redis.Redis.from_url(url or settings.MESSAGING_PUBSUB_URL)
+        self._errors = (redis.ConnectionError, redis.TimeoutError)
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def publish(self, user_id, event):
+        self._redis.publish(f'{CHANNEL_PREFIX}{user_id}', json.dumps(event))
+
+    def subscribe(self, user_id):
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='messaging-pubsub', daemon=True)
+                self._listener.start()
+        return super().subscribe(user_id)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+                for item in pubsub.listen():
+                    if item['type'] == 'pmessage':
+                        user_id = int(item['channel'][len(CHANNEL_PREFIX):])
+                        super().publish(user_id, json.loads(item['data']))
+            except self._errors:
+                logger.warning('Lost the connection to the pub/sub server, reconnecting', exc_info=True)
+                time.sleep(RECONNECT_DELAY)
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                _hub = import_string(getattr(settings, 'MESSAGING_PUBSUB_HUB', 'messaging.pubsub.InProcessHub'))()
+    return _hub
+
+
+def publish_message(message):
+    """
+    Publishes a compact `message` event to both participants. `is_sender` is computed per receiving user.
+    """
+    publish_messages([message])
+
+
+def publish_messages(messages):
+    hub = get_hub()
+    rows = [{field: getattr(message, field) for field in MESSAGE_FIELDS} for message in messages]
+    names = UserNameCache()
+    names.load({row['sender_id'] for row in rows} | {row['recipient_id'] for row in rows})
+
+    # Runs after the messages committed: a failing hub must not fail the request, or retries would send them again
+    try:
+        for row in rows:
+            for user_id in {row['sender_id'], row['recipient_id']}:
+                hub.publish(user_id, {
+                    'type': 'message',
+                    'thread_id': row['root_id'],
+                    'message': serialize_rows([row], user_id, names)[0]
+                })
+    except Exception:
+        logger.warning('Could not publish %d message event(s)', len(rows), exc_info=True)
@@ -0,0 +1,140 @@
+"""
+Read-replica routing for the polling and search endpoints.
+
+Views decorated with `read_from_replica` run their reads against one of the `MESSAGING_READ_REPLICAS` database
+aliases (a setting, listing the replica aliases of `DATABASES`); every other view, and every write, uses the primary
+(`default`). The replica chosen for a request is kept in a context variable, so ORM calls made for the request from
+any thread (including the `sync_to_async` threads of async views) read from the same replica.
+
+Replicas lag behind the primary, and the polling endpoints tag their responses with versions bumped right after a
+write commits (see `messaging.versions`): a replica answering with older data would then cache that data under the
+new version. So every version bump also pins its readers to the primary for `MESSAGING_REPLICA_PIN_SECONDS`, which
+should exceed the replication lag:
+    - An **inbox** bump pins the users whose inbox changed, so senders and recipients see their new messages at once.
+    - A **directory** bump pins every reader of user names, so new or renamed users show up in search at once.
+
+The replica of a request is only chosen on its first database read, not when the view starts. The decorated views read
+their version tokens from the cache before any query, and bumps set the pins before the new version, so a view that
+sees a new version always sees its pins too: a bump landing between the start of the view and its version lookup
+cannot get replica data tagged with the new version.
+
+Pins are kept in the Django cache, which must be shared by every process (see `whatsapp/caches.py`): a pin set by
+the process that wrote would otherwise be invisible to the others. Without replicas nothing is pinned and every read
+goes to the primary.
+
+Classes:
+1. **ReadReplicaRouter**
+    - Database router (see `DATABASE_ROUTERS`) sending the reads of `read_from_replica` views to the request's
+      replica and all writes, migrations aside, to the primary.
+
+Functions:
+    - `read_from_replica(view_func)`: Decorator for sync and async views whose reads may be served by a replica. Only
+      decorate read-only views: reads made inside their transactions would not see the transaction's writes.
+    - `pin_users_to_primary(*user_ids)`: Sends the replica reads of these users to the primary for a while.
+    - `pin_directory_to_primary()`: Sends all replica reads to the primary for a while.
+"""
+
+import random
+import threading
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+USER_PIN_KEY = 'messaging:replica-pin:user:{}'
+DIRECTORY_PIN_KEY = 'messaging:replica-pin:directory'
+
+_current_replica = ContextVar('messaging_read_replica', default=None)
+
+
+def _replicas():
+    return getattr(settings, 'MESSAGING_READ_REPLICAS', [])
+
+
+def _pin(keys):
+    if _replicas():
+        cache.set_many(dict.fromkeys(keys, True), getattr(settings, 'MESSAGING_REPLICA_PIN_SECONDS', 10))
+
+
+def pin_users_to_primary(*user_ids):
+    _pin([USER_PIN_KEY.format(user_id) for user_id in user_ids])
+
+
+def pin_directory_to_primary():
+    _pin([DIRECTORY_PIN_KEY])
+
+
+def _choose_replica(user):
+    replicas = _replicas()
+    if not replicas:
+        return None
+
+    keys = [DIRECTORY_PIN_KEY]
+    if user is not None and user.is_authenticated:
+        keys.append(USER_PIN_KEY.format(user.id))
+    return None if cache.get_many(keys) else random.choice(replicas)
+
+
+class _ReplicaChoice:
+    """
+    The database alias of one request, chosen (pins checked) on its first read, then kept for the whole request.
+    """
+
+    def __init__(self, user):
+        self._user = user
+        self._alias = None
+        self._lock = threading.Lock()
+
+    @property
+    def alias(self):
+        with self._lock:
+            if self._alias is None:
+                self._alias = _choose_replica(self._user) or DEFAULT_DB_ALIAS
+            return self._alias
+
+
+def read_from_replica(view_func):
+    # Applied below `login_required`, so the session and the user are loaded from the primary
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            token = _current_replica.set(_ReplicaChoice(getattr(request, 'user', None)))
+            try:
+                return await view_func(request, *args, **kwargs)
+            finally:
+                _current_replica.reset(token)
+
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        token = _current_replica.set(_ReplicaChoice(getattr(request, 'user', None)))
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            _current_replica.reset(token)
+
+    return wrapper
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        choice = _current_replica.get()
+        return choice.alias if choice is not None else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Explicit, or instances read from a replica would be saved back to it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold copies of the primary's rows
+        databases = {DEFAULT_DB_ALIAS, *_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
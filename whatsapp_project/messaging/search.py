@@ -0,0 +1,197 @@
+"""
+Indexed search: users for the recipient autocomplete of the new message page, and message content.
+
+**Users**
+
+`search_users` used to OR three `icontains` filters together, which is a full scan of the user table with
+`LIKE '%q%'` on every keystroke. Instead, every user is indexed in two small tables (see `UserSearchTerm` and
+`UserSearchGram` in `messaging.models`) whenever their username or names change, and searches run as index lookups:
+
+1. **Exact**: The username equals the query (case-insensitive).
+2. **Prefix**: The username, first name or last name starts with the query, an index range scan over the terms.
+3. **Substring**: The username, first name or last name contains the query. Candidates are the users whose terms
+   contain every n-gram of the query (bigrams for 2-character queries, trigrams otherwise); they are then verified
+   against the real terms, since sharing every n-gram does not guarantee a substring match. The postings of the
+   rarest n-gram are walked in user id order, `GRAM_CHUNK_SIZE` at a time; each chunk is intersected with the other
+   n-grams through the (gram, user) index and verified, until `limit` users matched or the postings run out. No
+   candidate is dropped before verification, and no n-gram's postings are read further than the rarest one's.
+
+Results are returned in that order, each stage only running while fewer than `limit` users were found.
+
+**Messages**
+
+Message content is tokenized into lowercased words and stored in an inverted index (`MessageSearchToken`), with one
+posting per (participant, word, message). Searching is then an index scan over the requesting user's postings for
+the query words, so only messages in threads the user takes part in are ever considered, and the rest of the
+`Message` table is never read. Every word of the query must appear in a result; results are newest first.
+
+The tables are plain Django models, so the same index works on SQLite and on server databases.
+
+Functions:
+    - `index_user(user)`: (Re)builds the index rows of `user`.
+    - `search_user_ids(query, exclude_user_id, limit)`: Returns the ranked ids of the users matching `query`.
+    - `index_message(message)`: Adds the postings of a newly created `message`.
+    - `index_messages(messages)`: Adds the postings of many newly created messages with batched INSERTs. Postings that
+      already exist are skipped, so indexing is safe to retry (it runs in the `messaging.index_messages` job).
+    - `search_message_ids(user_id, query, before, limit)`: Returns the ids of the user's messages matching `query`,
+      newest first, older than message id `before`.
+    - `highlight(content, query, width)`: Returns an HTML-escaped snippet of `content` with the query words in `<mark>`.
+"""
+
+import re
+
+from django.db.models import Count
+from django.utils.html import escape
+
+# Candidate users per round trip of the substring stage
+GRAM_CHUNK_SIZE = 500
+
+# Postings counted per n-gram when looking for the rarest one; grams at least this common count as equally common
+GRAM_COUNT_CAP = 5000
+
+# Longest indexed word; longer words are truncated, both when indexing and when searching
+MAX_TOKEN_LENGTH = 64
+
+WORD_RE = re.compile(r'\w+')
+
+# Postings per INSERT when indexing many messages at once
+INDEX_BATCH_SIZE = 1000
+
+
+def user_terms(user):
+    """
+    Returns the lowercased searchable terms of `user` as (kind, term) pairs.
+    """
+    from .models import UserSearchTerm
+
+    return [
+        (UserSearchTerm.USERNAME, user.username.lower()),
+        (UserSearchTerm.NAME, (user.first_name or '').lower()),
+        (UserSearchTerm.NAME, (user.last_name or '').lower()),
+    ]
+
+
+def term_grams(term):
+    """
+    Returns every bigram and trigram of `term`.
+    """
+    return {term[i:i + size] for size in (2, 3) for i in range(len(term) - size + 1)}
+
+
+def index_user(user):
+    from .models import UserSearchGram, UserSearchTerm
+
+    terms = [(kind, term) for kind, term in user_terms(user) if term]
+    grams = set().union(*(term_grams(term) for _, term in terms))
+
+    UserSearchTerm.objects.filter(user=user).delete()
+    UserSearchGram.objects.filter(user=user).delete()
+    UserSearchTerm.objects.bulk_create([UserSearchTerm(user=user, kind=kind, term=term) for kind, term in terms])
+    UserSearchGram.objects.bulk_create([UserSearchGram(user=user, gram=gram) for gram in grams])
+
+
+def search_user_ids(query, exclude_user_id=None, limit=5):
+    from .models import UserSearchGram, UserSearchTerm
+
+    query = query.lower()
+    found = []
+
+    def collect(user_ids):
+        for user_id in user_ids:
+            if len(found) >= limit:
+                return
+            if user_id != exclude_user_id and user_id not in found:
+                found.append(user_id)
+
+    collect(UserSearchTerm.objects.filter(kind=UserSearchTerm.USERNAME, term=query).values_list('user_id', flat=True))
+    if len(found) >= limit:
+        return found
+
+    # A user has up to three terms, so fetch enough rows to fill the page after de-duplication
+    collect(UserSearchTerm.objects.filter(
+        term__gte=query, term__lt=query + '\U0010ffff'
+    ).order_by('term', 'user_id').values_list('user_id', flat=True)[:(limit + 1) * 3])
+    if len(found) >= limit:
+        return found
+
+    grams = {query[i:i + 3] for i in range(len(query) - 2)} if len(query) >= 3 else {query}
+    sizes = {gram: UserSearchGram.objects.filter(gram=gram)[:GRAM_COUNT_CAP].count() for gram in grams}
+    rarest = min(sorted(grams), key=sizes.get)
+    others = grams - {rarest}
+
+    last_user_id = 0
+    while len(found) < limit:
+        chunk = list(UserSearchGram.objects.filter(gram=rarest, user_id__gt=last_user_id).order_by(
+            'user_id').values_list('user_id', flat=True)[:GRAM_CHUNK_SIZE])
+        if not chunk:
+            break
+        last_user_id = chunk[-1]
+
+        candidates = chunk
+        if others:
+            candidates = UserSearchGram.objects.filter(gram__in=others, user_id__in=chunk).values('user_id').annotate(
+                matched=Count('gram')
+            ).filter(matched=len(others)).values('user_id')
+        matches = UserSearchTerm.objects.filter(user_id__in=candidates, term__contains=query)
+        collect(sorted(set(matches.values_list('user_id', flat=True))))
+    return found
+
+
+def message_tokens(text):
+    """
+    Returns the distinct lowercased words of `text`, truncated to `MAX_TOKEN_LENGTH`.
+    """
+    return {word[:MAX_TOKEN_LENGTH] for word in WORD_RE.findall(text.lower())}
+
+
+def index_message(message):
+    index_messages([message])
+
+
+def index_messages(messages):
+    from .models import MessageSearchToken
+
+    MessageSearchToken.objects.bulk_create([
+        MessageSearchToken(user_id=user_id, token=token, message_id=message.id)
+        for message in messages
+        for user_id in {message.sender_id, message.recipient_id}
+        for token in message_tokens(message.content)
+    ], batch_size=INDEX_BATCH_SIZE, ignore_conflicts=True)
+
+
+def search_message_ids(user_id, query, before=None, limit=20):
+    from .models import MessageSearchToken
+
+    tokens = message_tokens(query)
+    if not tokens:
+        return []
+
+    postings = MessageSearchToken.objects.filter(user_id=user_id, token__in=tokens)
+    if before is not None:
+        postings = postings.filter(message_id__lt=before)
+
+    return list(postings.values('message_id').annotate(
+        matched=Count('token')
+    ).filter(matched=len(tokens)).order_by('-message_id').values_list('message_id', flat=True)[:limit])
+
+
+def highlight(content, query, width=80):
+    words = sorted(message_tokens(query), key=len, reverse=True)
+    if not words:
+        return escape(content[:width])
+
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(word) for word in words) + r')\b', re.IGNORECASE)
+    first = pattern.search(content)
+    start = max(0, first.start() - width // 2) if first else 0
+    end = min(len(content), start + width)
+    excerpt = content[start:end]
+
+    parts = []
+    position = 0
+    for match in pattern.finditer(excerpt):
+        parts.append(escape(excerpt[position:match.start()]))
+        parts.append(f'<mark>{escape(match.group())}</mark>')
+        position = match.end()
+    parts.append(escape(excerpt[position:]))
+
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(content) else '')
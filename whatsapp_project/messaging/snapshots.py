@@ -0,0 +1,193 @@
+"""
+Per-user inbox snapshot cache.
+
+The inbox of a user (the thread list of `messages_view` and the full snapshot of `latest_messages_api`) only changes
+when one of their messages is written, yet it is rebuilt from the database on every read. The stores here keep the
+last built value per user and kind, so read-heavy polling is served from memory.
+
+Entries are tagged with the inbox and directory versions (see `messaging.versions`) that were current when the value
+was built; a lookup only hits when the tags still match. On top of that, `Message.save` invalidates the entries of
+both participants once the write commits (write-through invalidation), which keeps the stores small.
+
+The store is configured with the `MESSAGING_SNAPSHOT_STORE` setting:
+
+    MESSAGING_SNAPSHOT_STORE = {
+        'BACKEND': 'messaging.snapshots.LocMemSnapshotStore',
+        'OPTIONS': {'max_entries': 10000},
+    }
+
+Classes:
+1. **BaseSnapshotStore**
+    - Backend-agnostic interface: `get(key)`, `set(key, value)` and `delete_many(keys)`.
+
+2. **LocMemSnapshotStore** (extends `BaseSnapshotStore`)
+    - Process-local `OrderedDict` bounded to `max_entries`, evicting the least recently used entry. Thread-safe.
+
+3. **FileSnapshotStore** (extends `BaseSnapshotStore`)
+    - One pickle file per entry in `directory`, shared by every process on the host. Bounded to `max_entries`;
+      reads refresh the file's mtime and the least recently used files are evicted.
+
+4. **CacheSnapshotStore** (extends `BaseSnapshotStore`)
+    - Delegates to a Django cache alias (`CACHES[alias]`), e.g. a memcached or Redis server shared by every worker.
+      Size and eviction are handled by the cache server.
+
+Functions:
+    - `get_snapshot_store()`: Returns the process-wide store configured in settings.
+    - `get_snapshot(kind, user_id, versions, build)`: Returns the cached value or calls `build()` and caches it.
+    - `invalidate_snapshots(*user_ids)`: Drops every cached kind for `user_ids`.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+SNAPSHOT_KINDS = ('inbox', 'latest')
+
+
+class BaseSnapshotStore:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        raise NotImplementedError
+
+
+class LocMemSnapshotStore(BaseSnapshotStore):
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class FileSnapshotStore(BaseSnapshotStore):
+    def __init__(self, directory, max_entries=10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.md5(key.encode()).hexdigest() + '.snapshot')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        # Write to a temporary file and rename, so readers in other processes never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._cull()
+
+    def delete_many(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _cull(self):
+        with os.scandir(self.directory) as entries:
+            files = [entry for entry in entries if entry.name.endswith('.snapshot')]
+        if len(files) <= self.max_entries:
+            return
+
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class CacheSnapshotStore(BaseSnapshotStore):
+    def __init__(self, alias='default', key_prefix='messaging:snapshot:'):
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    @property
+    def _cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self._cache.get(self.key_prefix + key)
+
+    def set(self, key, value):
+        self._cache.set(self.key_prefix + key, value, None)
+
+    def delete_many(self, keys):
+        self._cache.delete_many([self.key_prefix + key for key in keys])
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, 'MESSAGING_SNAPSHOT_STORE', {})
+                backend = import_string(config.get('BACKEND', 'messaging.snapshots.LocMemSnapshotStore'))
+                _store = backend(**config.get('OPTIONS', {}))
+    return _store
+
+
+def _key(kind, user_id):
+    return f'{kind}:{user_id}'
+
+
+def get_snapshot(kind, user_id, versions, build):
+    """
+    Returns the value cached for (`kind`, `user_id`) if it was built at `versions`, otherwise `build()`'s result,
+    which is cached for the next reader. `versions` must be read before building.
+    """
+    store = get_snapshot_store()
+    entry = store.get(_key(kind, user_id))
+    if entry is not None and entry[0] == versions:
+        return entry[1]
+
+    value = build()
+    store.set(_key(kind, user_id), (versions, value))
+    return value
+
+
+def invalidate_snapshots(*user_ids):
+    get_snapshot_store().delete_many([_key(kind, user_id) for user_id in user_ids for kind in SNAPSHOT_KINDS])
@@ -0,0 +1,84 @@
+"""
+Cursor helpers for the incremental (delta) sync mode of the latest messages API.
+
+Polling clients receive an opaque `cursor` with every response from `latest_messages_api`. Sending it back as
+`?since=<cursor>` asks the server for only the messages that arrived after the previous response instead of the
+full inbox snapshot.
+
+A cursor is a signed, timestamped token containing:
+    - `u`: The id of the user the cursor was issued to (a cursor cannot be replayed by another user).
+    - `m`: The watermark: every message up to this id was seen by the client, or will never commit.
+    - `r`: The ids of the messages above the watermark the client has already seen.
+
+Message ids are handed out when a row is inserted, not when it commits, so on a server database a message can become
+visible after messages with higher ids. A bare "highest id seen" watermark would skip it for good. Instead the
+watermark only moves past messages older than `SYNC_SETTLE_SECONDS`, by which time any message with a lower id has
+committed; newer messages are re-read by the next delta, and the ones listed in `r` are left out of it. Should `r`
+outgrow `SYNC_MAX_DELTA_MESSAGES`, only the newest ids are kept: the others are sent again, and clients drop
+messages they already have, so a message can be repeated but never missed.
+
+Responses answered with 304 Not Modified carry the `since` cursor re-issued with a new timestamp in the
+`SYNC_CURSOR_HEADER` header, so clients that keep polling an unchanged inbox never fall back to a full snapshot.
+
+Constants:
+    - `SYNC_CURSOR_MAX_AGE`: Cursors older than this (in seconds) are rejected and the client gets a full snapshot.
+    - `SYNC_MAX_DELTA_MESSAGES`: When more messages than this arrived since the cursor, a full snapshot is cheaper
+      for both sides, so the server falls back to one.
+    - `SYNC_SETTLE_SECONDS`: Messages newer than this (in seconds) may still be joined by messages with lower ids.
+    - `SYNC_CURSOR_HEADER`: Response header re-issuing the cursor of a 304 Not Modified.
+
+Functions:
+    - `encode_cursor(user_id, last_message_id, recent_ids)`: Returns an opaque cursor string.
+    - `decode_cursor(token, user_id)`: Returns the `(watermark, recent_ids)` stored in the cursor, or raises
+      `InvalidCursor`.
+    - `advance_cursor(since_message_id, rows)`: Returns the `(watermark, recent_ids)` of the cursor following a
+      response.
+"""
+
+from datetime import timedelta
+
+from django.core import signing
+from django.utils import timezone
+
+SYNC_CURSOR_SALT = 'messaging.sync.cursor'
+SYNC_CURSOR_MAX_AGE = 300
+SYNC_MAX_DELTA_MESSAGES = 200
+SYNC_SETTLE_SECONDS = 30
+SYNC_CURSOR_HEADER = 'X-Sync-Cursor'
+
+
+class InvalidCursor(Exception):
+    """Raised when a sync cursor is malformed, tampered with, expired or issued to another user."""
+
+
+def encode_cursor(user_id, last_message_id, recent_ids=()):
+    return signing.dumps(
+        {'u': user_id, 'm': last_message_id or 0, 'r': sorted(recent_ids)[-SYNC_MAX_DELTA_MESSAGES:]},
+        salt=SYNC_CURSOR_SALT, compress=True
+    )
+
+
+def decode_cursor(token, user_id):
+    try:
+        payload = signing.loads(token, salt=SYNC_CURSOR_SALT, max_age=SYNC_CURSOR_MAX_AGE)
+    except signing.BadSignature as e:  # SignatureExpired is a subclass of BadSignature
+        raise InvalidCursor(str(e))
+
+    if not isinstance(payload, dict) or payload.get('u') != user_id or not isinstance(payload.get('m'), int):
+        raise InvalidCursor('Cursor does not belong to this user')
+    recent_ids = payload.get('r', [])
+    if not isinstance(recent_ids, list) or not all(isinstance(message_id, int) for message_id in recent_ids):
+        raise InvalidCursor('Malformed cursor')
+
+    return payload['m'], frozenset(recent_ids)
+
+
+def advance_cursor(since_message_id, rows):
+    """
+    Returns the `(watermark, recent_ids)` of the cursor that follows a response, where `rows` are the `(id, timestamp)`
+    pairs of every message above `since_message_id` the user could see while it was built. The watermark moves up to
+    the newest of them old enough to have settled; the ids above it are the recent ids.
+    """
+    settled = timezone.now() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    watermark = max((message_id for message_id, timestamp in rows if timestamp <= settled), default=since_message_id)
+    return watermark, [message_id for message_id, _ in rows if message_id > watermark]
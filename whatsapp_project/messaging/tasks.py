@@ -0,0 +1,26 @@
+"""
+Background tasks run by the job queue (see `messaging.jobs`). Tasks may run more than once, so each is idempotent.
+
+Functions:
+    - `index_messages(message_ids)`: Adds the search postings of the given messages (`messaging.index_messages`).
+    - `delete_user(user_id)`: Deletes a user with all their threads in batches (`messaging.delete_user`).
+"""
+
+from .deletion import delete_user as delete_user_in_batches
+from .jobs import task
+from .models import Message, User
+from .search import index_messages as index_message_postings
+
+
+@task('messaging.index_messages')
+def index_messages(message_ids):
+    # Messages deleted since the job was enqueued are simply skipped
+    index_message_postings(Message.objects.filter(id__in=message_ids).only('id', 'sender_id', 'recipient_id', 'content'))
+
+
+@task('messaging.delete_user')
+def delete_user(user_id):
+    # Resumes where an interrupted attempt stopped; a user already deleted is skipped
+    user = User.objects.filter(pk=user_id).first()
+    if user is not None:
+        delete_user_in_batches(user)
@@ -1,3 +1,1360 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import random
+import re
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, router, transaction
+from django.db.utils import ConnectionHandler
+from django.test import AsyncRequestFactory, Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from whatsapp.caches import cache_settings, is_shared_cache
+from whatsapp.database import database_settings
+
+from . import async_views, views
+from .archive import ARCHIVER_LOCK, _SegmentWriter, _file_lock, archive_idle_threads
+from .activity import get_last_activity, is_idle_expired, touch_activity
+from .benchmark import DEFAULT_MIX, compare_reports, run_load, seed_dataset, summarize
+from .consumers import WEBSOCKET_PATH, CLOSE_UNAUTHORIZED, websocket_application
+from .deletion import delete_user
+from .export import export_chunks
+from .instrumentation import get_registry
+from .jobs import Worker, enqueue, run_pending, task
+from .log_pipeline import (
+    BatchingQueueListener, DebugSamplingFilter, JsonFormatter, NonBlockingQueueHandler, SizeAndTimeRotatingFileHandler
+)
+from .models import ArchivedThread, Job, User, Message, MessageSearchToken, Thread, ThreadParticipant
+from .pagination import INBOX_PAGE_SIZE, THREAD_PAGE_SIZE, encode_keyset, encode_sequence
+from .pubsub import BaseHub, RedisHub, publish_message
+from .routers import read_from_replica
+from .search import index_user
+from .snapshots import FileSnapshotStore, LocMemSnapshotStore, get_snapshot_store
+from .sync import InvalidCursor, SYNC_CURSOR_HEADER, SYNC_CURSOR_MAX_AGE, SYNC_SETTLE_SECONDS, decode_cursor
+from .versions import bump_inbox_version, get_versions
+from .views import SEARCH_PAGE_SIZE
+
+
+# Background jobs run inline unless a test exercises the queue itself
+@override_settings(MESSAGING_JOBS_EAGER=True)
+class MessagingTestCase(TestCase):
+    def setUp(self):
+        # Inbox versions and snapshots live outside the database, so they survive the per-test rollback
+        cache.clear()
+        get_snapshot_store()._entries.clear()
+        super().setUp()
+
+
+class LatestMessagesDeltaSyncTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.root = Message.objects.create(sender=self.alice, recipient=self.bob, content='hello')
+        self.client.force_login(self.alice)
+
+    def test_full_snapshot_returns_cursor(self):
+        data = self.client.get(reverse('latest_messages_api')).json()
+        self.assertEqual(data['mode'], 'full')
+        self.assertTrue(data['cursor'])
+        self.assertEqual([t['thread_id'] for t in data['threads']], [self.root.id])
+
+    def test_delta_returns_only_new_messages(self):
+        cursor = self.client.get(reverse('latest_messages_api')).json()['cursor']
+        reply = Message.objects.create(sender=self.bob, recipient=self.alice, content='hi', parent_message=self.root)
+
+        data = self.client.get(reverse('latest_messages_api'), {'since': cursor}).json()
+        self.assertEqual(data['mode'], 'delta')
+        self.assertEqual(len(data['threads']), 1)
+        self.assertEqual(data['threads'][0]['root']['id'], self.root.id)
+        self.assertEqual([m['id'] for m in data['threads'][0]['messages']], [reply.id])
+
+        data = self.client.get(reverse('latest_messages_api'), {'since': data['cursor']}).json()
+        self.assertEqual(data['mode'], 'delta')
+        self.assertEqual(data['threads'], [])
+
+    def test_invalid_cursor_falls_back_to_full_snapshot(self):
+        data = self.client.get(reverse('latest_messages_api'), {'since': 'garbage'}).json()
+        self.assertEqual(data['mode'], 'full')
+
+    def test_not_modified_renews_the_cursor(self):
+        with mock.patch('django.core.signing.time') as clock:
+            clock.time.return_value = time.time() - SYNC_CURSOR_MAX_AGE + 50
+            response = self.client.get(reverse('latest_messages_api'))
+        cursor = response.json()['cursor']
+
+        response = self.client.get(reverse('latest_messages_api'), {'since': cursor},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        renewed = response[SYNC_CURSOR_HEADER]
+        expected = decode_cursor(cursor, self.alice.id)
+
+        with mock.patch('django.core.signing.time') as clock:
+            clock.time.return_value = time.time() + 100
+            self.assertRaises(InvalidCursor, decode_cursor, cursor, self.alice.id)
+            self.assertEqual(decode_cursor(renewed, self.alice.id), expected)
+
+    def test_message_committed_behind_a_higher_id_is_not_skipped(self):
+        cursor = self.client.get(reverse('latest_messages_api')).json()['cursor']
+        later = Message.objects.create(id=self.root.id + 100, sender=self.bob, recipient=self.alice, content='later',
+                                       parent_message=self.root)
+        data = self.client.get(reverse('latest_messages_api'), {'since': cursor}).json()
+        self.assertEqual([m['id'] for m in data['threads'][0]['messages']], [later.id])
+
+        # A message given a lower id by a transaction that commits last
+        earlier = Message.objects.create(id=self.root.id + 50, sender=self.bob, recipient=self.alice, content='earlier',
+                                         parent_message=self.root)
+        data = self.client.get(reverse('latest_messages_api'), {'since': data['cursor']}).json()
+        self.assertEqual(data['mode'], 'delta')
+        self.assertEqual([m['id'] for m in data['threads'][0]['messages']], [earlier.id])
+
+        data = self.client.get(reverse('latest_messages_api'), {'since': data['cursor']}).json()
+        self.assertEqual(data['threads'], [])
+
+    def test_watermark_moves_past_settled_messages(self):
+        Message.objects.update(timestamp=timezone.now() - timedelta(seconds=SYNC_SETTLE_SECONDS + 1))
+        reply = Message.objects.create(sender=self.bob, recipient=self.alice, content='hi', parent_message=self.root)
+        cursor = self.client.get(reverse('latest_messages_api')).json()['cursor']
+        self.assertEqual(decode_cursor(cursor, self.alice.id), (self.root.id, {reply.id}))
+
+
+class ThreadSerializationQueryCountTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.client.force_login(self.alice)
+
+    def _add_thread(self, username, replies):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = User.objects.create_user(username=username, password='pw', first_name=username, last_name='X')
+            root = Message.objects.create(sender=self.alice, recipient=other, content='root')
+            for i in range(replies):
+                sender, recipient = (other, self.alice) if i % 2 else (self.alice, other)
+                Message.objects.create(sender=sender, recipient=recipient, content=f'reply {i}', parent_message=root)
+
+    def _count_queries(self, url, **params):
+        # Warm up first, so session side effects of the first request are not counted, but build the inbox again
+        self.client.get(url, params)
+        get_snapshot_store()._entries.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, params).status_code, 200)
+        return len(queries)
+
+    def test_latest_messages_query_count_is_independent_of_thread_size(self):
+        self._add_thread('bob', 1)
+        small = self._count_queries(reverse('latest_messages_api'))
+
+        self._add_thread('carol', 50)
+        self._add_thread('dave', 50)
+        self.assertEqual(self._count_queries(reverse('latest_messages_api')), small)
+
+    def test_messages_view_query_count_is_independent_of_inbox_size(self):
+        self._add_thread('bob', 0)
+        small = self._count_queries(reverse('messages'))
+
+        for i in range(20):
+            self._add_thread(f'user{i}', 0)
+        self.assertEqual(self._count_queries(reverse('messages')), small)
+
+
+class ThreadSummaryTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.alice)
+
+    def test_reply_moves_thread_to_top_of_inbox(self):
+        old = Message.objects.create(sender=self.alice, recipient=self.bob, content='old')
+        new = Message.objects.create(sender=self.bob, recipient=self.alice, content='new')
+        reply = Message.objects.create(sender=self.bob, recipient=self.alice, content='re', parent_message=old)
+
+        thread = Thread.objects.get(pk=old.id)
+        self.assertEqual(thread.message_count, 2)
+        self.assertEqual(thread.last_message_id, reply.id)
+        self.assertEqual(set(thread.participants.all()), {self.alice, self.bob})
+
+        data = self.client.get(reverse('latest_messages_api')).json()
+        self.assertEqual([t['thread_id'] for t in data['threads']], [old.id, new.id])
+
+    def test_rebuild_matches_incremental_summary(self):
+        root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='re', parent_message=root)
+        expected = Thread.objects.values('last_message_id', 'last_activity_at', 'message_count').get(pk=root.id)
+
+        Thread.objects.all().delete()
+        Thread.rebuild(root.id)
+        self.assertEqual(
+            Thread.objects.values('last_message_id', 'last_activity_at', 'message_count').get(pk=root.id), expected)
+        self.assertEqual(ThreadParticipant.objects.filter(thread_id=root.id).count(), 2)
+
+    def test_replies_to_replies_stay_in_the_thread_in_sequence(self):
+        root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+        reply = Message.objects.create(sender=self.bob, recipient=self.alice, content='re', parent_message=root)
+        self.client.post(reverse('send_message'), {'recipient': 'bob', 'content': 're re', 'reply_to': reply.id})
+        [nested] = Message.bulk_send([Message(
+            sender=self.bob, recipient=self.alice, content='re re re', parent_message_id=Message.objects.latest('id').id)])
+
+        self.assertEqual(list(Message.objects.filter(root_id=root.id).order_by('sequence').values_list(
+            'content', 'sequence')), [('root', 0), ('re', 1), ('re re', 2), ('re re re', 3)])
+        self.assertEqual(nested.root_id, root.id)
+        self.assertEqual(list(Thread.objects.values_list('pk', 'message_count', 'last_sequence')), [(root.id, 4, 3)])
+
+        thread = self.client.get(reverse('thread_detail_api', args=[root.id])).json()
+        self.assertEqual([m['content'] for m in thread['messages']], ['root', 're', 're re', 're re re'])
+
+
+class WebSocketPushTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.bob)
+
+    async def _connect(self, cookie):
+        inbox, outbox = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': WEBSOCKET_PATH, 'headers': [(b'cookie', cookie.encode())]}
+        await inbox.put({'type': 'websocket.connect'})
+        task = asyncio.ensure_future(websocket_application(scope, inbox.get, outbox.put))
+        return inbox, outbox, task
+
+    def _alice_sends(self):
+        # Alice's own browser: logging her in on Bob's client would end his session
+        client = Client()
+        client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(reverse('send_message'), {'recipient': 'bob', 'content': 'ping'})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_new_message_is_pushed_to_recipient(self):
+        inbox, outbox, task = await self._connect(f'sessionid={self.client.cookies["sessionid"].value}')
+        self.assertEqual((await asyncio.wait_for(outbox.get(), 1))['type'], 'websocket.accept')
+
+        await sync_to_async(self._alice_sends)()
+        event = json.loads((await asyncio.wait_for(outbox.get(), 1))['text'])
+        self.assertEqual(event['type'], 'message')
+        self.assertEqual(event['message']['content'], 'ping')
+        self.assertFalse(event['message']['is_sender'])
+
+        await inbox.put({'type': 'websocket.disconnect'})
+        await asyncio.wait_for(task, 1)
+
+    def test_failing_hub_does_not_fail_the_send(self):
+        class FailingHub(BaseHub):
+            def publish(self, user_id, event):
+                raise ConnectionError('pub/sub server is down')
+
+        with mock.patch('messaging.pubsub.get_hub', return_value=FailingHub()), \
+                self.assertLogs('messaging.pubsub', 'WARNING'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('send_message'), {'recipient': 'alice', 'content': 'ping'})
+        self.assertEqual(response.json(), {'success': True})
+        self.assertEqual(Message.objects.filter(content='ping').count(), 1)
+
+    async def test_anonymous_connection_is_rejected(self):
+        _, outbox, task = await self._connect('')
+        self.assertEqual(await asyncio.wait_for(outbox.get(), 1),
+                         {'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        await asyncio.wait_for(task, 1)
+
+    async def test_connection_is_closed_on_the_next_push_after_logout(self):
+        _, outbox, task = await self._connect(f'sessionid={self.client.cookies["sessionid"].value}')
+        self.assertEqual((await asyncio.wait_for(outbox.get(), 1))['type'], 'websocket.accept')
+
+        await sync_to_async(self.client.logout)()
+        await sync_to_async(self._alice_sends)()
+        self.assertEqual(await asyncio.wait_for(outbox.get(), 1),
+                         {'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        await asyncio.wait_for(task, 1)
+
+    async def test_idle_connection_is_closed_once_the_session_ends(self):
+        with mock.patch('messaging.consumers.SESSION_CHECK_INTERVAL', 0.05):
+            _, outbox, task = await self._connect(f'sessionid={self.client.cookies["sessionid"].value}')
+            self.assertEqual((await asyncio.wait_for(outbox.get(), 1))['type'], 'websocket.accept')
+            await asyncio.sleep(0.1)
+            self.assertTrue(outbox.empty())
+
+            await sync_to_async(self.client.logout)()
+            self.assertEqual(await asyncio.wait_for(outbox.get(), 1),
+                             {'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+            await asyncio.wait_for(task, 1)
+
+
+@unittest.skipUnless(os.environ.get('WHATSAPP_TEST_REDIS_URL'), 'needs a Redis server in WHATSAPP_TEST_REDIS_URL')
+class RedisHubTests(MessagingTestCase):
+    async def test_events_published_by_another_process_reach_local_subscribers(self):
+        url = os.environ['WHATSAPP_TEST_REDIS_URL']
+        subscriber, publisher = RedisHub(url), RedisHub(url)  # as in two processes
+        subscription = subscriber.subscribe(7)
+        other = subscriber.subscribe(8)
+        await asyncio.sleep(0.2)  # let the listener subscribe
+
+        await sync_to_async(publisher.publish)(7, {'type': 'message', 'thread_id': 1})
+        self.assertEqual(await asyncio.wait_for(subscription.get(), 2), {'type': 'message', 'thread_id': 1})
+        self.assertTrue(other.queue.empty())
+        subscriber.unsubscribe(subscription)
+        subscriber.unsubscribe(other)
+
+
+class LongPollTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.async_client.force_login(self.bob)
+
+    async def _cursor(self):
+        response = await self.async_client.get(reverse('wait_messages_api'))
+        self.assertEqual(response.json()['mode'], 'full')
+        return response.json()['cursor']
+
+    async def test_idle_wait_times_out_with_empty_delta(self):
+        cursor = await self._cursor()
+        with mock.patch('messaging.views.LONG_POLL_TIMEOUT', 0.05):
+            data = (await self.async_client.get(reverse('wait_messages_api'), {'since': cursor})).json()
+        self.assertEqual((data['mode'], data['threads']), ('delta', []))
+
+    async def test_wait_returns_as_soon_as_a_message_is_published(self):
+        cursor = await self._cursor()
+        waiter = asyncio.ensure_future(self.async_client.get(reverse('wait_messages_api'), {'since': cursor}))
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiter.done())
+
+        def send():
+            publish_message(Message.objects.create(sender=self.alice, recipient=self.bob, content='ping'))
+
+        await sync_to_async(send)()
+        data = (await asyncio.wait_for(waiter, 2)).json()
+        self.assertEqual(data['mode'], 'delta')
+        self.assertEqual(data['threads'][0]['messages'][0]['content'], 'ping')
+
+
+class KeysetPaginationTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.alice)
+
+    def test_thread_history_pages_cover_every_message_once(self):
+        root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+        for i in range(THREAD_PAGE_SIZE + 5):
+            Message.objects.create(sender=self.bob, recipient=self.alice, content=str(i), parent_message=root)
+
+        url = reverse('thread_messages_api', args=[root.id])
+        first = self.client.get(url).json()
+        self.assertEqual(len(first['messages']), THREAD_PAGE_SIZE)
+        second = self.client.get(url, {'before': first['before']}).json()
+        self.assertIsNone(second['before'])
+
+        ids = [m['id'] for m in second['messages'] + first['messages']]
+        self.assertEqual(ids, list(Message.objects.order_by('timestamp', 'id').values_list('id', flat=True)))
+
+        snapshot = self.client.get(reverse('latest_messages_api')).json()['threads'][0]
+        self.assertEqual(snapshot['messages'], first['messages'])
+        self.assertEqual(snapshot['before'], first['before'])
+
+    def test_inbox_pages_cover_every_thread_once(self):
+        roots = [Message.objects.create(sender=self.bob, recipient=self.alice, content=str(i))
+                 for i in range(INBOX_PAGE_SIZE + 3)]
+
+        first = self.client.get(reverse('inbox_api')).json()
+        second = self.client.get(reverse('inbox_api'), {'before': first['before']}).json()
+        self.assertIsNone(second['before'])
+        self.assertEqual([t['thread_id'] for t in first['threads'] + second['threads']],
+                         [root.id for root in reversed(roots)])
+
+    def test_thread_history_requires_participant(self):
+        carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+        root = Message.objects.create(sender=self.bob, recipient=carol, content='private')
+        self.assertEqual(self.client.get(reverse('thread_messages_api', args=[root.id])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('inbox_api'), {'before': '!'}).status_code, 400)
+
+    def test_out_of_range_and_naive_tokens_are_rejected(self):
+        root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+        now = timezone.now()
+        for token in (encode_keyset(now, 10 ** 30), encode_keyset(now.replace(tzinfo=None), root.id),
+                      encode_keyset(now, -1)):
+            self.assertEqual(self.client.get(reverse('inbox_api'), {'before': token}).status_code, 400)
+        for token in (encode_sequence(10 ** 30), encode_sequence('²')):
+            response = self.client.get(reverse('thread_messages_api', args=[root.id]), {'before': token})
+            self.assertEqual(response.status_code, 400)
+
+
+class ThreadDetailTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+        self.client.force_login(self.alice)
+
+    def test_unchanged_thread_returns_not_modified(self):
+        url = reverse('thread_detail_api', args=[self.root.id])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['root']['id'], self.root.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertFalse([q for q in queries if 'FROM "messaging_message"' in q['sql']])
+
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='re', parent_message=self.root)
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(len(changed.json()['messages']), 2)
+
+    def test_non_participant_gets_not_found(self):
+        carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+        self.client.force_login(carol)
+        self.assertEqual(self.client.get(reverse('thread_detail_api', args=[self.root.id])).status_code, 404)
+
+    def test_oversized_path_ids_are_not_found(self):
+        thread_id = '9' * 19
+        self.assertEqual(self.client.get(f'/api/threads/{thread_id}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/threads/{thread_id}/messages/').status_code, 404)
+        self.assertEqual(self.client.post(f'/api/threads/{thread_id}/read/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/threads/{"9" * 18}/').status_code, 404)
+
+
+class ConditionalPollingTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.alice)
+
+    def test_latest_messages_not_modified_until_a_message_is_written(self):
+        url = reverse('latest_messages_api')
+        etag = self.client.get(url)['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertFalse([q for q in queries if 'messaging_message' in q['sql']])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(sender=self.bob, recipient=self.alice, content='hi')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_search_not_modified_until_a_user_changes(self):
+        url = reverse('search_users')
+        etag = self.client.get(url, {'username': 'bo'})['ETag']
+        self.assertEqual(self.client.get(url, {'username': 'bo'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.create_user(username='bonnie', password='pw', first_name='Bonnie', last_name='C')
+        response = self.client.get(url, {'username': 'bo'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()['users']), 2)
+
+
+class InboxSnapshotCacheTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.alice)
+
+    def test_snapshot_is_served_from_cache_until_a_message_is_sent(self):
+        url = reverse('latest_messages_api')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([q for q in queries if 'messaging_message' in q['sql']])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('send_message'), {'recipient': 'bob', 'content': 'hi'})
+        self.assertEqual(len(self.client.get(url).json()['threads']), 1)
+
+    def test_stores_evict_least_recently_used_entries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for store in (LocMemSnapshotStore(max_entries=2), FileSnapshotStore(directory, max_entries=2)):
+                store.set('a', 1)
+                store.set('b', 2)
+                time.sleep(0.01)
+                store.get('a')
+                store.set('c', 3)
+                self.assertEqual((store.get('a'), store.get('b'), store.get('c')), (1, None, 3))
+                store.delete_many(['a'])
+                self.assertIsNone(store.get('a'))
+
+
+class UserSearchTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.me = User.objects.create_user(username='searcher', password='pw', first_name='Me', last_name='Myself')
+        for username, first_name, last_name in [('dan', 'Zed', 'Zed'), ('danny', 'Zed', 'Zed'),
+                                                ('jordan', 'Zed', 'Zed'), ('zoe', 'Dana', 'Scully'),
+                                                ('bob', 'Bob', 'Builder')]:
+            User.objects.create_user(username=username, password='pw', first_name=first_name, last_name=last_name)
+        self.client.force_login(self.me)
+
+    def _search(self, query):
+        return [u['username'] for u in self.client.get(reverse('search_users'), {'username': query}).json()['users']]
+
+    def test_results_are_ranked_exact_then_prefix_then_substring(self):
+        self.assertEqual(self._search('DAN'), ['dan', 'zoe', 'danny', 'jordan'])
+
+    def test_index_follows_renames_and_excludes_requesting_user(self):
+        bob = User.objects.get(username='bob')
+        bob.last_name = 'Marley'
+        bob.save()
+        self.assertEqual(self._search('arle'), ['bob'])
+        self.assertEqual(self._search('uilder'), [])
+        self.assertEqual(self._search('myself'), [])
+
+    def test_substring_matches_are_not_dropped_behind_common_grams(self):
+        # Every decoy holds each trigram of the query without containing it, and precedes the match in id order
+        decoys = User.objects.bulk_create([User(username=f'zannanab{i}', first_name='Zed', last_name='Zed')
+                                           for i in range(300)])
+        for user in decoys + [User.objects.create_user(username='zzannabz', password='pw')]:
+            index_user(user)
+        self.assertEqual(self._search('annab'), ['zzannabz'])
+
+
+class MessageSearchTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+        self.client.force_login(self.alice)
+
+    def _search(self, **params):
+        return self.client.get(reverse('search_messages_api'), params).json()
+
+    def test_search_is_scoped_to_own_threads_and_requires_every_word(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            mine = Message.objects.create(sender=self.bob, recipient=self.alice, content='Lunch at <noon> tomorrow?')
+            Message.objects.create(sender=self.alice, recipient=self.bob, content='lunch sounds good')
+            Message.objects.create(sender=self.bob, recipient=self.carol, content='lunch tomorrow too?')
+
+        results = self._search(q='LUNCH tomorrow')['results']
+        self.assertEqual([r['message']['id'] for r in results], [mine.id])
+        self.assertEqual(results[0]['snippet'], '<mark>Lunch</mark> at &lt;noon&gt; <mark>tomorrow</mark>?')
+
+    def test_search_pages_with_before(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ids = [Message.objects.create(sender=self.bob, recipient=self.alice, content=f'note {i}').id
+                   for i in range(SEARCH_PAGE_SIZE + 2)]
+        first = self._search(q='note')
+        second = self._search(q='note', before=first['before'])
+        self.assertIsNone(second['before'])
+        self.assertEqual([r['message']['id'] for r in first['results'] + second['results']], ids[::-1])
+
+    def test_invalid_before_is_rejected(self):
+        for before in ('', 'abc', '²', '9' * 30):
+            response = self.client.get(reverse('search_messages_api'), {'q': 'note', 'before': before})
+            self.assertEqual((response.status_code, response.json()['field']), (400, 'before'))
+
+
+class SessionActivityTests(MessagingTestCase):
+    def test_activity_writes_are_coalesced(self):
+        session = {}
+        self.assertTrue(touch_activity(session, now=1000))
+        self.assertFalse(touch_activity(session, now=1030))
+        self.assertTrue(touch_activity(session, now=1061))
+        self.assertEqual(session['last_activity'], 1061)
+
+    def test_idle_timeout_accepts_legacy_iso_timestamps(self):
+        session = {'last_activity': '2025-01-01T00:00:00+00:00'}
+        start = get_last_activity(session)
+        self.assertFalse(is_idle_expired(session, 1800, now=start + 1800))
+        self.assertTrue(is_idle_expired(session, 1800, now=start + 1801))
+
+
+class ReadStateTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+        self.replies = [
+            Message.objects.create(sender=self.alice, recipient=self.bob, content=f'reply {i}', parent_message=self.root)
+            for i in range(3)
+        ]
+
+    def _unread(self, user):
+        return ThreadParticipant.objects.get(thread_id=self.root.id, user=user).unread_count
+
+    def test_unread_counts_follow_sends_and_mark_read(self):
+        self.assertEqual(self._unread(self.bob), 4)
+        self.assertEqual(self._unread(self.alice), 0)
+
+        self.client.force_login(self.bob)
+        url = reverse('mark_thread_read_api', args=[self.root.id])
+        response = self.client.post(url, {'message_id': self.replies[0].id})
+        self.assertEqual(response.json()['unread_count'], 2)
+
+        # Replying marks the whole thread as read for the sender
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='re', parent_message=self.root)
+        self.assertEqual(self._unread(self.bob), 0)
+        self.assertEqual(self._unread(self.alice), 1)
+        self.assertEqual(self.client.get(reverse('inbox_api')).json()['threads'][0]['unread_count'], 0)
+
+    def test_read_position_never_moves_back(self):
+        self.client.force_login(self.bob)
+        url = reverse('mark_thread_read_api', args=[self.root.id])
+        self.assertEqual(self.client.post(url).json()['unread_count'], 0)
+        response = self.client.post(url, {'message_id': self.root.id})
+        self.assertEqual(response.json()['last_read_message_id'], self.replies[-1].id)
+
+        carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+        self.client.force_login(carol)
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+    def test_invalid_message_ids_are_rejected(self):
+        self.client.force_login(self.bob)
+        url = reverse('mark_thread_read_api', args=[self.root.id])
+        for message_id in ('', 'abc', '-1', '²', '١٢', '9' * 30):
+            response = self.client.post(url, {'message_id': message_id})
+            self.assertEqual((response.status_code, response.json()['field']), (400, 'message_id'))
+        self.assertEqual(self._unread(self.bob), 4)
+
+
+class BroadcastTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.users = [
+            User.objects.create_user(username=f'user{i}', password='pw', first_name='User', last_name=str(i))
+            for i in range(30)
+        ]
+        self.client.force_login(self.alice)
+
+    def _broadcast(self, body):
+        return self.client.post(reverse('broadcast_messages_api'), json.dumps(body), content_type='application/json')
+
+    def test_broadcast_query_count_is_independent_of_recipient_count(self):
+        def count_queries(recipients):
+            with CaptureQueriesContext(connection) as queries:
+                response = self._broadcast({'recipients': recipients, 'content': 'hello everyone'})
+            self.assertEqual(response.json()['sent'], len(recipients))
+            return len(queries)
+
+        self.assertEqual(count_queries(['user0', 'user1']), count_queries([user.username for user in self.users]))
+        self.assertEqual(ThreadParticipant.objects.filter(user=self.users[5], unread_count=1).count(), 1)
+        self.assertEqual(Message.objects.filter(sender=self.alice).count(), 32)
+
+    def test_invalid_items_are_reported_without_blocking_the_others(self):
+        root = Message.objects.create(sender=self.users[0], recipient=self.alice, content='root')
+        response = self._broadcast({'messages': [
+            {'recipient': 'user0', 'content': 'reply', 'reply_to': root.id},
+            {'recipient': 'nobody', 'content': 'lost'},
+            {'recipient': 'user1', 'content': 'wrong thread', 'reply_to': root.id},
+            {'recipient': 'user2', 'content': ''},
+        ]})
+
+        results = response.json()['results']
+        self.assertEqual([result['success'] for result in results], [True, False, False, False])
+        self.assertEqual(results[0]['thread_id'], root.id)
+        self.assertEqual([result.get('field') for result in results[1:]], ['recipient', 'recipient', 'content'])
+        self.assertEqual(Thread.objects.get(pk=root.id).message_count, 2)
+
+    def test_reply_to_is_validated_per_item(self):
+        root = Message.objects.create(sender=self.users[0], recipient=self.alice, content='root')
+        response = self._broadcast({'messages': [
+            {'recipient': 'user0', 'content': 'as string', 'reply_to': str(root.id)},
+            {'recipient': 'user0', 'content': 'superscript', 'reply_to': '²'},
+            {'recipient': 'user0', 'content': 'negative', 'reply_to': -root.id},
+            {'recipient': 'user0', 'content': 'huge', 'reply_to': 10 ** 30},
+            {'recipient': 'user0', 'content': 'boolean', 'reply_to': True},
+            {'recipient': 'user0', 'content': 'list', 'reply_to': [root.id]},
+            {'recipient': 'user0', 'content': 'no reply', 'reply_to': None},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['success'] for result in results], [True, False, False, False, False, False, True])
+        self.assertEqual({result['field'] for result in results[1:-1]}, {'reply_to'})
+        self.assertEqual(results[0]['thread_id'], root.id)
+        self.assertNotEqual(results[-1]['thread_id'], root.id)
+
+
+class AsyncViewTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.alice)
+        self.session = self.client.session
+
+    def _request(self, factory, method, path, data=None, **extra):
+        request = getattr(factory, method)(path, data or {}, **extra)
+        request.session = self.session
+        request.user = self.alice
+        return request
+
+    async def _call_both(self, name, method, path, data=None, **extra):
+        sync_response = await sync_to_async(getattr(views, name))(
+            self._request(RequestFactory(), method, path, data, **extra))
+        async_response = await getattr(async_views, name)(self._request(AsyncRequestFactory(), method, path, data, **extra))
+        return sync_response, async_response
+
+    async def test_async_views_match_sync_views(self):
+        sync_response, async_response = await self._call_both('search_users', 'get', '/api/users/search/', {'username': 'bo'})
+        self.assertEqual(json.loads(sync_response.content), json.loads(async_response.content))
+        self.assertEqual(sync_response['ETag'], async_response['ETag'])
+
+        sync_response, async_response = await self._call_both(
+            'send_message', 'post', '/api/messages/send/', {'recipient': 'nobody', 'content': 'hi'})
+        self.assertEqual((sync_response.status_code, sync_response.content), (400, async_response.content))
+
+    async def test_latest_messages_not_modified_and_send(self):
+        response = await async_views.send_message(
+            self._request(AsyncRequestFactory(), 'post', '/api/messages/send/', {'recipient': 'bob', 'content': 'hi'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await Thread.objects.filter(root__content='hi').aexists())
+
+        response = await async_views.latest_messages_api(
+            self._request(AsyncRequestFactory(), 'get', '/api/messages/latest/'))
+        self.assertEqual(json.loads(response.content)['threads'][0]['messages'][0]['content'], 'hi')
+
+        not_modified = await async_views.latest_messages_api(self._request(
+            AsyncRequestFactory(), 'get', '/api/messages/latest/', headers={'If-None-Match': response['ETag']}))
+        self.assertEqual(not_modified.status_code, 304)
+
+    async def test_anonymous_requests_are_redirected_to_login(self):
+        views_by_path = {
+            '/api/messages/latest/': async_views.latest_messages_api,
+            '/api/users/search/': async_views.search_users,
+            '/api/messages/send/': async_views.send_message,
+            '/api/messages/export/': async_views.export_messages_api,
+        }
+        for path, view in views_by_path.items():
+            with self.subTest(path=path):
+                request = self._request(AsyncRequestFactory(), 'get', path, {'username': 'bo'})
+                request.user = AnonymousUser()
+                response = await view(request)
+                self.assertEqual(response.status_code, 302)
+                self.assertTrue(response['Location'].startswith('/login/'))
+
+
+class BenchmarkHarnessTests(MessagingTestCase):
+    def test_seed_and_run_report_every_endpoint(self):
+        user_ids = seed_dataset(users=5, threads=8, mean_replies=3, max_replies=4, rng=random.Random(1))
+        self.assertEqual(Thread.objects.count(), 8)
+        self.assertTrue(all(thread.message_count <= 5 for thread in Thread.objects.all()))
+
+        samples, wall_time = run_load(user_ids, clients=1, requests_per_client=40)
+        report = summarize(samples, wall_time)
+
+        self.assertEqual(report['requests'], 40)
+        self.assertEqual(set(report['endpoints']), set(DEFAULT_MIX))
+        for stats in report['endpoints'].values():
+            self.assertEqual(stats['errors'], 0)
+            self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+        baseline = {'results': report}
+        self.assertEqual(compare_reports(baseline, baseline)['latest_messages']['p50_ms'], 0)
+
+
+class InstrumentationTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        get_registry().reset()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='hello')
+        self.client.force_login(self.alice)
+
+    @override_settings(INTERNAL_IPS=['127.0.0.1'])
+    def test_requests_are_recorded_per_view_and_exported(self):
+        self.client.get(reverse('latest_messages_api'))
+        self.client.get(reverse('messages'))
+
+        metrics = self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').content.decode()
+        self.assertIn('whatsapp_http_requests_total{view="latest_messages_api",method="GET",status="200"} 1', metrics)
+        self.assertIn('whatsapp_http_request_duration_seconds_count{view="messages",method="GET"} 1', metrics)
+        queries = re.search(r'whatsapp_db_queries_total\{view="latest_messages_api".*\} (\d+)', metrics)
+        self.assertGreater(int(queries.group(1)), 0)
+        self.assertRegex(metrics, r'whatsapp_serialization_duration_seconds_total\{view="messages".*\} 0\.0*[1-9]')
+
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    def test_metrics_need_staff_without_configured_ips(self):
+        self.assertEqual(settings.INTERNAL_IPS, [])
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+        User.objects.filter(pk=self.alice.pk).update(is_staff=True)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 200)
+
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.settings(MESSAGING_SLOW_REQUEST_THRESHOLD=0):
+            with self.assertLogs('messaging.slow_requests', 'WARNING') as logs:
+                self.client.get(reverse('latest_messages_api'))
+        self.assertIn('latest_messages_api', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class LogPipelineTests(MessagingTestCase):
+    def test_records_are_written_by_the_listener_as_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/test.log'
+            file_handler = SizeAndTimeRotatingFileHandler(path, maxBytes=10 ** 6)
+            file_handler.setFormatter(JsonFormatter())
+            log_queue = queue.Queue(10)
+            handler = NonBlockingQueueHandler(log_queue)
+            handler.addFilter(DebugSamplingFilter({'noisy': 0.0}))
+            listener = BatchingQueueListener(log_queue, file_handler, batch_size=5)
+
+            logger = logging.getLogger('messaging.tests.pipeline')
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(handler)
+            noisy = logging.getLogger('noisy.child')
+            noisy.propagate = False
+            noisy.addHandler(handler)
+            try:
+                logger.info('sent %d messages', 3, extra={'user_id': 7})
+                noisy.debug('dropped by sampling')
+                noisy.warning('kept')
+                for i in range(20):
+                    logger.debug('overflow %d', i)
+                self.assertEqual(handler.dropped, 12)
+
+                listener.start()
+                listener.stop()
+            finally:
+                logger.removeHandler(handler)
+                noisy.removeHandler(handler)
+                file_handler.close()
+
+            with open(path) as f:
+                entries = [json.loads(line) for line in f]
+
+        self.assertEqual(len(entries), 10)
+        self.assertEqual(entries[0]['message'], 'sent 3 messages')
+        self.assertEqual(entries[0]['user_id'], 7)
+        self.assertEqual(entries[1]['message'], 'kept')
+
+
+class CacheSettingsTests(MessagingTestCase):
+    def test_shared_cache_from_url(self):
+        caches = cache_settings(False, {'WHATSAPP_CACHE_URL': 'redis://cache:6379/0', 'WEB_CONCURRENCY': '4'})
+        self.assertEqual(caches['default'], {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache:6379/0'})
+        self.assertTrue(is_shared_cache(caches))
+
+        caches = cache_settings(False, {'WHATSAPP_CACHE_URL': 'memcached://a:11211,b:11211'})
+        self.assertEqual(caches['default']['LOCATION'], ['a:11211', 'b:11211'])
+
+        with self.assertRaises(ImproperlyConfigured):
+            cache_settings(True, {'WHATSAPP_CACHE_URL': 'mongodb://cache'})
+
+    def test_local_memory_cache_is_refused_for_several_processes(self):
+        self.assertFalse(is_shared_cache(cache_settings(False, {})))
+        self.assertFalse(is_shared_cache(cache_settings(True, {'WEB_CONCURRENCY': '4'})))
+        with self.assertRaises(ImproperlyConfigured):
+            cache_settings(False, {'WEB_CONCURRENCY': '4'})
+
+    @unittest.skipIf('WHATSAPP_SESSION_ENGINE' in os.environ, 'session engine set explicitly')
+    def test_sessions_stay_in_the_database_without_a_shared_cache(self):
+        # A session logged out in one process must not stay valid in another process's cache
+        self.assertFalse(is_shared_cache(settings.CACHES))
+        self.assertEqual(settings.SESSION_ENGINE, 'django.contrib.sessions.backends.db')
+
+
+class DatabaseProfileTests(MessagingTestCase):
+    def test_server_profile_keeps_connections(self):
+        databases = database_settings('/srv', {
+            'WHATSAPP_DB_PROFILE': 'server', 'WHATSAPP_DB_NAME': 'whatsapp', 'WHATSAPP_DB_POOLER': 'pgbouncer'})
+        self.assertEqual(databases['default']['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual(databases['default']['CONN_MAX_AGE'], 60)
+        self.assertTrue(databases['default']['DISABLE_SERVER_SIDE_CURSORS'])
+
+        with self.assertRaises(ImproperlyConfigured):
+            database_settings('/srv', {'WHATSAPP_DB_PROFILE': 'oracle'})
+
+    def test_sqlite_profile_handles_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            connections = ConnectionHandler(database_settings(directory, {}))
+
+            def write(writer):
+                db = connections['default']
+                try:
+                    for i in range(25):
+                        with transaction.atomic(using='default'), db.cursor() as cursor:
+                            cursor.execute('INSERT INTO note (writer, n) VALUES (%s, %s)', [writer, i])
+                finally:
+                    db.close()
+
+            db = connections['default']
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute('CREATE TABLE note (writer integer, n integer)')
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'wal')
+                    cursor.execute('PRAGMA synchronous')
+                    self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    list(executor.map(write, range(8)))
+
+                with db.cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) FROM note')
+                    self.assertEqual(cursor.fetchone()[0], 8 * 25)
+            finally:
+                db.close()
+
+
+class ReadReplicaTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        # A separate SQLite file stands in for a replica that has not caught up yet
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        connections.settings['replica1'] = dict(connections['default'].settings_dict, NAME=f'{directory.name}/replica.sqlite3')
+        self.addCleanup(self._drop_replica)
+        call_command('migrate', database='replica1', verbosity=0)
+
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        User.objects.using('replica1').bulk_create(User.objects.all())
+        self.root = Message.objects.create(sender=self.alice, recipient=self.bob, content='hello')
+
+        replicas = override_settings(MESSAGING_READ_REPLICAS=['replica1'])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+
+    def _drop_replica(self):
+        connections['replica1'].close()
+        del connections['replica1']
+        del connections.settings['replica1']
+
+    def test_polling_reads_replica_until_a_write_pins_the_user(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(reverse('latest_messages_api')).json()['threads'], [])
+
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('send_message'), {
+                'recipient': 'bob', 'content': 'hi', 'reply_to': self.root.id})
+        self.assertEqual(response.json(), {'success': True})
+
+        # Both participants now read their new message from the primary
+        for user in (self.alice, self.bob):
+            self.client.force_login(user)
+            threads = self.client.get(reverse('latest_messages_api')).json()['threads']
+            self.assertEqual([t['thread_id'] for t in threads], [self.root.id])
+
+    def test_bump_before_the_first_read_pins_the_reader(self):
+        @read_from_replica
+        def view(request):
+            # A write commits after the view started but before it looked up its versions and read anything
+            bump_inbox_version(self.bob.id)
+            get_versions(self.bob.id)
+            return router.db_for_read(Message)
+
+        request = RequestFactory().get('/')
+        request.user = self.bob
+        self.assertEqual(view(request), 'default')
+
+        # Other readers keep using the replica
+        request.user = self.alice
+        self.assertEqual(read_from_replica(lambda request: router.db_for_read(Message))(request), 'replica1')
+
+    def test_writes_use_the_primary(self):
+        @read_from_replica
+        def view(request):
+            return router.db_for_read(Message), router.db_for_write(Message)
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        self.assertEqual(view(request), ('replica1', 'default'))
+        self.assertEqual(router.db_for_read(Message), 'default')
+
+        # Objects read from the replica are saved to the primary
+        replica_bob = User.objects.using('replica1').get(pk=self.bob.pk)
+        self.assertEqual(router.db_for_write(User, instance=replica_bob), 'default')
+        self.assertTrue(router.allow_relation(replica_bob, self.root))
+
+
+@task('messaging.tests.flaky', max_attempts=2)
+def _flaky_task(message):
+    raise RuntimeError(message)
+
+
+@override_settings(MESSAGING_JOBS_EAGER=False)
+class JobQueueTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.client.force_login(self.alice)
+
+    def _search(self, query):
+        return self.client.get(reverse('search_messages_api'), {'q': query}).json()['results']
+
+    def test_send_indexes_message_in_a_worker_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('send_message'), {'recipient': 'bob', 'content': 'quarterly report'})
+        self.assertEqual(response.json(), {'success': True})
+
+        job = Job.objects.get()
+        self.assertEqual((job.task, job.status), ('messaging.index_messages', Job.PENDING))
+        self.assertEqual(self._search('report'), [])
+
+        Worker(poll_interval=0).run(burst=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 1))
+        self.assertEqual([r['message']['content'] for r in self._search('report')], ['quarterly report'])
+
+    def test_failing_inline_task_does_not_undo_the_send(self):
+        with self.settings(MESSAGING_JOBS_EAGER=True), \
+                mock.patch('messaging.tasks.index_message_postings', side_effect=RuntimeError('index down')), \
+                self.assertLogs('messaging.jobs', 'ERROR') as logs, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('send_message'), {'recipient': 'bob', 'content': 'quarterly report'})
+        self.assertEqual(response.json(), {'success': True})
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['quarterly report'])
+        self.assertIn('messaging.index_messages failed inline', logs.output[0])
+
+    def test_failing_jobs_are_retried_then_failed_once(self):
+        job = enqueue('messaging.tests.flaky', {'message': 'boom'}, idempotency_key='flaky-1')
+        self.assertEqual(enqueue('messaging.tests.flaky', {'message': 'boom'}, idempotency_key='flaky-1'), job)
+
+        self.assertEqual(run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 1))
+        self.assertEqual(run_pending(), 0)  # backing off
+
+        Job.objects.filter(pk=job.pk).update(run_at=job.created_at)
+        self.assertEqual(run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIn('RuntimeError: boom', job.last_error)
+        self.assertIn('whatsapp_job_queue_depth{queue="default",status="failed"} 1', get_registry().render())
+
+    def test_worker_warns_when_jobs_run_inline(self):
+        err = io.StringIO()
+        call_command('worker', '--burst', stdout=io.StringIO(), stderr=err)
+        self.assertEqual(err.getvalue(), '')
+
+        with self.settings(MESSAGING_JOBS_EAGER=True):
+            call_command('worker', '--burst', stdout=io.StringIO(), stderr=err)
+        self.assertIn('WHATSAPP_JOBS_EAGER=0', err.getvalue())
+
+
+class UserDeletionTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            root = Message.objects.create(sender=self.alice, recipient=self.bob, content='root')
+            reply = Message.objects.create(sender=self.bob, recipient=self.alice, content='re', parent_message=root)
+            for content in ('re re', 're re re'):
+                reply = Message.objects.create(
+                    sender=self.alice, recipient=self.bob, content=content, parent_message=reply)
+            legacy = Message.objects.create(sender=self.carol, recipient=self.alice, content='hello carol')
+            Message.objects.create(sender=self.alice, recipient=self.carol, content='hi', parent_message=legacy)
+            Thread.objects.filter(pk=legacy.id).delete()  # started before thread summaries existed
+            self.kept = Message.objects.create(sender=self.bob, recipient=self.carol, content='hello bob')
+
+    def _assert_only_kept_rows_left(self):
+        self.assertFalse(User.objects.filter(username='alice').exists())
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.kept.id])
+        self.assertEqual(list(Thread.objects.values_list('pk', flat=True)), [self.kept.id])
+        self.assertEqual(set(ThreadParticipant.objects.values_list('user_id', flat=True)), {self.bob.id, self.carol.id})
+        self.assertEqual(set(MessageSearchToken.objects.values_list('message_id', flat=True)), {self.kept.id})
+
+    def test_deletes_threads_in_batches_newest_first(self):
+        progress = []
+        with self.captureOnCommitCallbacks(execute=True):
+            counts = delete_user(self.alice, batch_size=3, progress=lambda *args: progress.append(args))
+
+        self.assertEqual(counts, {'messages': 6, 'threads': 2, 'batches': 3})
+        self.assertEqual(progress, [(3, 6), (4, 6), (6, 6)])
+        self._assert_only_kept_rows_left()
+
+    def test_batches_use_set_based_statements(self):
+        with CaptureQueriesContext(connection) as queries:
+            delete_user(self.alice, batch_size=500)
+        message_deletes = [q['sql'] for q in queries if q['sql'].startswith('DELETE FROM "messaging_message"')]
+        self.assertEqual(len(message_deletes), 2)  # one per batch, never per message
+        self._assert_only_kept_rows_left()
+
+    def test_summaries_without_messages_are_deleted(self):
+        stray = Message.objects.create(sender=self.alice, recipient=self.bob, content='stray')
+        Message.objects.filter(pk=stray.id).update(root=None)  # its summary no longer matches any message
+
+        delete_user(self.alice)
+        self._assert_only_kept_rows_left()
+
+    def test_deletion_without_progress_raises(self):
+        with mock.patch('messaging.deletion._delete_batch', return_value=(0, 0)):
+            with self.assertRaisesMessage(RuntimeError, 'makes no progress'):
+                delete_user(self.alice)
+        self.assertTrue(User.objects.filter(pk=self.alice.pk).exists())
+
+    def test_management_command_reports_progress(self):
+        out = io.StringIO()
+        call_command('delete_users', 'alice', '--noinput', '--batch-size', '3', stdout=out)
+        self.assertIn('alice: 6/6 messages deleted', out.getvalue())
+        self.assertIn('Deleted alice with 6 messages in 2 threads (3 batches).', out.getvalue())
+        self._assert_only_kept_rows_left()
+
+    def test_admin_bulk_delete_uses_batched_deletion(self):
+        admin_user = User.objects.create_superuser(username='admin', password='pw', first_name='Ad', last_name='Min')
+        self.client.force_login(admin_user)
+        url = reverse('admin:messaging_user_changelist')
+
+        confirmation = self.client.post(url, {'action': 'delete_selected', '_selected_action': [self.alice.pk]})
+        self.assertContains(confirmation, 'Messages: 6')
+
+        with mock.patch('messaging.admin.delete_user', wraps=delete_user) as batched:
+            self.client.post(url, {'action': 'delete_selected', '_selected_action': [self.alice.pk], 'post': 'yes'})
+        batched.assert_called_once()
+        self._assert_only_kept_rows_left()
+
+    def test_admin_background_action_enqueues_deletion_jobs(self):
+        admin_user = User.objects.create_superuser(username='admin', password='pw', first_name='Ad', last_name='Min')
+        self.client.force_login(admin_user)
+        with self.settings(MESSAGING_JOBS_EAGER=False), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:messaging_user_changelist'),
+                             {'action': 'delete_in_background', '_selected_action': [self.alice.pk]})
+
+        self.alice.refresh_from_db()
+        self.assertFalse(self.alice.is_active)
+        self.assertEqual(list(Job.objects.values_list('task', 'payload')), [('messaging.delete_user', {'user_id': self.alice.pk})])
+        self.assertEqual(run_pending(), 1)
+        self._assert_only_kept_rows_left()
+
+    def test_admin_background_action_runs_inline_without_a_worker(self):
+        admin_user = User.objects.create_superuser(username='admin', password='pw', first_name='Ad', last_name='Min')
+        self.client.force_login(admin_user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:messaging_user_changelist'),
+                                        {'action': 'delete_in_background', '_selected_action': [self.alice.pk]},
+                                        follow=True)
+
+        self.assertFalse(Job.objects.exists())
+        self._assert_only_kept_rows_left()
+        self.assertIn('No background worker is configured', response.content.decode())
+
+
+class ThreadArchiveTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        archive_settings = override_settings(MESSAGING_ARCHIVE_DIR=self.directory)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+
+        self.old = Message.objects.create(sender=self.bob, recipient=self.alice, content='old news')
+        for i in range(4):
+            Message.objects.create(sender=self.alice, recipient=self.bob, content=f'reply {i}', parent_message=self.old)
+        self.older = Message.objects.create(sender=self.alice, recipient=self.carol, content='ancient')
+        self.fresh = Message.objects.create(sender=self.alice, recipient=self.bob, content='fresh')
+        long_ago = timezone.now() - timedelta(days=400)
+        Thread.objects.filter(pk=self.old.id).update(last_activity_at=long_ago)
+        Thread.objects.filter(pk=self.older.id).update(last_activity_at=long_ago - timedelta(days=1))
+        self.client.force_login(self.alice)
+
+    def _thread_history(self, thread_id):
+        contents = []
+        before = None
+        while True:
+            page = self.client.get(reverse('thread_messages_api', args=[thread_id]), {'before': before} if before else {}).json()
+            contents = [m['content'] for m in page['messages']] + contents
+            before = page['before']
+            if before is None:
+                return contents
+
+    def test_idle_threads_move_to_the_archive_and_load_from_it(self):
+        detail = self.client.get(reverse('thread_detail_api', args=[self.old.id])).json()
+        with mock.patch('messaging.views.THREAD_PAGE_SIZE', 2):
+            history = self._thread_history(self.old.id)
+
+        out = io.StringIO()
+        call_command('archive_threads', stdout=out)
+        self.assertIn('Archived 2 threads.', out.getvalue())
+
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.fresh.id])
+        self.assertEqual(list(Thread.objects.values_list('pk', flat=True)), [self.fresh.id])
+        self.assertEqual(list(ArchivedThread.objects.order_by('offset').values_list('thread_id', 'segment')), [
+            (self.older.id, f'{self.alice.id}/000001.jsonl.gz'), (self.old.id, f'{self.alice.id}/000001.jsonl.gz')])
+
+        # Thread members are concatenated into one readable gzip file
+        with gzip.open(f'{self.directory}/{self.alice.id}/000001.jsonl.gz', 'rt') as segment:
+            self.assertEqual([json.loads(line)['content'] for line in segment],
+                             ['ancient', 'old news', 'reply 0', 'reply 1', 'reply 2', 'reply 3'])
+
+        self.maxDiff = None
+        archived_detail = self.client.get(reverse('thread_detail_api', args=[self.old.id])).json()
+        self.assertEqual(archived_detail, dict(detail, archived=True))
+        with mock.patch('messaging.views.THREAD_PAGE_SIZE', 2):
+            self.assertEqual(self._thread_history(self.old.id), history)
+
+        inbox = self.client.get(reverse('inbox_api')).json()
+        self.assertEqual([t['thread_id'] for t in inbox['threads']], [self.fresh.id])
+        archived = self.client.get(reverse('archived_threads_api')).json()
+        self.assertEqual([(t['thread_id'], t['with_name']) for t in archived['threads']],
+                         [(self.old.id, 'B, Bob'), (self.older.id, 'C, Carol')])
+
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get(reverse('thread_detail_api', args=[self.old.id])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('thread_messages_api', args=[self.older.id])).status_code, 200)
+
+    def test_thread_replied_to_while_archiving_stays_hot(self):
+        close = _SegmentWriter.close
+
+        def reply_then_close(writer):
+            close(writer)
+            Message.objects.create(sender=self.bob, recipient=self.alice, content='still here', parent_message=self.old)
+
+        with mock.patch.object(_SegmentWriter, 'close', autospec=True, side_effect=reply_then_close):
+            self.assertEqual(archive_idle_threads(batch_size=10), 1)
+
+        self.assertEqual(list(ArchivedThread.objects.values_list('thread_id', flat=True)), [self.older.id])
+        self.assertEqual(Thread.objects.get(pk=self.old.id).message_count, 6)
+        self.assertEqual(self._thread_history(self.old.id)[-1], 'still here')
+
+    def _archived_contents(self):
+        contents = []
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.jsonl.gz'):
+                    with gzip.open(os.path.join(directory, name), 'rt') as segment:
+                        contents += [json.loads(line)['content'] for line in segment]
+        return sorted(contents)
+
+    def test_deleting_a_user_removes_their_threads_from_the_archive(self):
+        archive_idle_threads()
+        history = self._thread_history(self.old.id)
+
+        # Carol's thread is in Alice's segment, which is rewritten without it
+        delete_user(self.carol)
+        self.assertEqual(list(ArchivedThread.objects.values_list('thread_id', 'segment')),
+                         [(self.old.id, f'{self.alice.id}/000002.jsonl.gz')])
+        self.assertEqual(self._archived_contents(), sorted(history))
+        self.assertEqual(self._thread_history(self.old.id), history)
+
+        delete_user(self.alice)
+        self.assertFalse(ArchivedThread.objects.exists())
+        self.assertEqual(self._archived_contents(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, str(self.alice.id))))
+
+    def test_only_one_archiver_runs_at_a_time(self):
+        with _file_lock(ARCHIVER_LOCK, wait=False):
+            with self.assertRaisesMessage(CommandError, 'Another archiver is running.'):
+                call_command('archive_threads', stdout=io.StringIO())
+        self.assertFalse(ArchivedThread.objects.exists())
+
+        call_command('archive_threads', stdout=io.StringIO())
+        self.assertEqual(ArchivedThread.objects.count(), 2)
+
+
+class ExportTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_settings = override_settings(MESSAGING_ARCHIVE_DIR=directory.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.alice = User.objects.create_user(username='alice', password='pw', first_name='Alice', last_name='A')
+        self.bob = User.objects.create_user(username='bob', password='pw', first_name='Bob', last_name='B')
+        self.carol = User.objects.create_user(username='carol', password='pw', first_name='Carol', last_name='C')
+
+        self.archived = Message.objects.create(sender=self.carol, recipient=self.alice, content='long ago')
+        Thread.objects.filter(pk=self.archived.id).update(last_activity_at=timezone.now() - timedelta(days=400))
+        archive_idle_threads()
+        self.root = Message.objects.create(sender=self.alice, recipient=self.bob, content='hi, "bob"')
+        self.reply = Message.objects.create(sender=self.bob, recipient=self.alice, content='hi\nalice', parent_message=self.root)
+        Message.objects.create(sender=self.bob, recipient=self.carol, content='not for alice')
+        self.client.force_login(self.alice)
+
+    def _expected(self):
+        return [
+            (self.root.id, self.root.id, None, 0, 'alice', 'bob', 'hi, "bob"', False),
+            (self.root.id, self.reply.id, self.root.id, 1, 'bob', 'alice', 'hi\nalice', False),
+            (self.archived.id, self.archived.id, None, 0, 'carol', 'alice', 'long ago', True),
+        ]
+
+    def _rows(self, rows):
+        return [(r['thread_id'], r['id'], r['parent_message_id'], r['sequence'], r['sender'], r['recipient'],
+                 r['content'], r['archived']) for r in rows]
+
+    def test_ndjson_export_streams_hot_and_archived_threads(self):
+        response = self.client.get(reverse('export_messages_api'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="messages-alice.ndjson"')
+
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(self._rows(rows), self._expected())
+        self.assertEqual(rows[0]['timestamp'], timezone.localtime(self.root.timestamp).isoformat())
+
+    def test_csv_export_with_gzip(self):
+        response = self.client.get(reverse('export_messages_api'), {'format': 'csv', 'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="messages-alice.csv.gz"')
+
+        text = gzip.decompress(b''.join(response.streaming_content)).decode()
+        rows = list(csv.DictReader(io.StringIO(text)))
+        self.assertEqual(self._rows([dict(
+            row, thread_id=int(row['thread_id']), id=int(row['id']), sequence=int(row['sequence']),
+            parent_message_id=int(row['parent_message_id']) if row['parent_message_id'] else None,
+            archived=row['archived'] == 'True'
+        ) for row in rows]), self._expected())
+
+        invalid = self.client.get(reverse('export_messages_api'), {'format': 'xml'})
+        self.assertEqual((invalid.status_code, invalid.json()['field']), (400, 'format'))
+
+    def test_export_is_flushed_in_chunks_as_rows_are_read(self):
+        Message.bulk_send([
+            Message(sender=self.alice, recipient=self.bob, content='x' * 1000, parent_message_id=self.root.id)
+            for _ in range(200)])
+        chunks = export_chunks(self.alice)
+        with CaptureQueriesContext(connection) as queries:
+            first = next(chunks)
+        self.assertGreaterEqual(len(first), 64 * 1024)
+        self.assertLess(len(first), 70 * 1024)
+        self.assertEqual(len(queries), 3)  # thread ids, usernames, first rows
+        self.assertEqual(len(b''.join(chunks).splitlines()) + first.count(b'\n'), 203)
+
+    def test_management_command_writes_the_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('export_messages', 'alice', '--gzip', '--output', f'{directory}/alice.ndjson.gz')
+            with gzip.open(f'{directory}/alice.ndjson.gz', 'rt') as output:
+                self.assertEqual(self._rows(json.loads(line) for line in output), self._expected())
+
+    async def test_async_view_streams_the_same_export(self):
+        request = AsyncRequestFactory().get('/api/messages/export/', {'format': 'csv'})
+        request.session = await sync_to_async(lambda: self.client.session)()
+        request.user = self.alice
+        response = await async_views.export_messages_api(request)
+        self.assertTrue(response.is_async)
+
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        expected = await sync_to_async(lambda: b''.join(export_chunks(self.alice, 'csv')))()
+        self.assertEqual(content, expected)
@@ -0,0 +1,80 @@
+"""
+Cheap version tokens used as ETags by the polling endpoints.
+
+Instead of re-querying the `Message` table to find out whether anything changed, the polling endpoints compare the
+client's `If-None-Match` with version tokens kept in the Django cache:
+    - The **inbox version** of a user changes whenever a message they sent or received is written.
+    - The **directory version** changes whenever a user is created or updated (it covers the names shown in
+      search results and in message payloads).
+
+Versions are random tokens rather than counters, so a version evicted from the cache is simply replaced by a new one:
+clients then miss one 304 but never receive a stale one. This only holds if every process reads and bumps the same
+versions, so deployments with several processes need a shared cache (`WHATSAPP_CACHE_URL`, see `whatsapp/caches.py`):
+a process with its own cache would keep answering 304 for data another process changed. Versions are bumped after the writing transaction commits,
+so a reader can never tag old data with a new version. Bumps also pin the affected readers to the primary database
+for a while, so a lagging read replica cannot tag old data with the new version either (see `messaging.routers`).
+
+Functions:
+    - `get_versions(user_id)`: Returns `(inbox_version, directory_version)` for `user_id` in one cache lookup.
+    - `get_directory_version()`: Returns the directory version.
+    - `bump_inbox_version(*user_ids)`: Gives every user in `user_ids` a new inbox version.
+    - `bump_directory_version()`: Gives the directory a new version.
+    - `aget_versions(user_id)` and `aget_directory_version()`: Async variants of the getters, for async views.
+"""
+
+import uuid
+
+from django.core.cache import cache
+
+from .routers import pin_directory_to_primary, pin_users_to_primary
+
+INBOX_VERSION_KEY = 'messaging:inbox-version:{}'
+DIRECTORY_VERSION_KEY = 'messaging:directory-version'
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def _get_or_create(keys):
+    versions = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+async def _aget_or_create(keys):
+    versions = await cache.aget_many(keys)
+    missing = {key: _new_version() for key in keys if key not in versions}
+    if missing:
+        await cache.aset_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def get_versions(user_id):
+    return tuple(_get_or_create([INBOX_VERSION_KEY.format(user_id), DIRECTORY_VERSION_KEY]))
+
+
+def get_directory_version():
+    return _get_or_create([DIRECTORY_VERSION_KEY])[0]
+
+
+async def aget_versions(user_id):
+    return tuple(await _aget_or_create([INBOX_VERSION_KEY.format(user_id), DIRECTORY_VERSION_KEY]))
+
+
+async def aget_directory_version():
+    return (await _aget_or_create([DIRECTORY_VERSION_KEY]))[0]
+
+
+def bump_inbox_version(*user_ids):
+    pin_users_to_primary(*user_ids)
+    cache.set_many({INBOX_VERSION_KEY.format(user_id): _new_version() for user_id in user_ids}, None)
+
+
+def bump_directory_version():
+    pin_directory_to_primary()
+    cache.set(DIRECTORY_VERSION_KEY, _new_version(), None)
@@ -6,21 +6,83 @@ in a Django web application with session timeout functionality.
 from django.shortcuts import redirect
 from .models import User
 from django.contrib.auth import authenticate, login, logout
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import ensure_csrf_cookie
+import asyncio
+import json
 import logging
+import re
+from collections import deque
+from datetime import timedelta
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.shortcuts import render
+from django.template.response import TemplateResponse
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from .models import Message
+from django.contrib.auth.views import redirect_to_login
+from django.db import transaction
+from django.db.models import F, Max, Q, Window
+from django.db.models.functions import RowNumber
+from .activity import is_idle_expired, touch_activity
+from .archive import read_thread
+from .export import EXPORT_FORMATS, export_chunks
+from .instrumentation import track_serialization
+from .models import ArchivedThread, Message, Thread, ThreadParticipant
+from .pagination import (
+    INBOX_PAGE_SIZE, THREAD_PAGE_SIZE, InvalidPageToken, decode_sequence, encode_keyset, encode_sequence, keyset_before
+)
+from .pubsub import get_hub, publish_message, publish_messages
+from .routers import read_from_replica
+from .snapshots import get_snapshot, invalidate_snapshots
+from .search import highlight, search_message_ids, search_user_ids
+from .serializers import UserNameCache, message_rows, serialize_rows
+from .sync import (
+    advance_cursor, encode_cursor, decode_cursor, InvalidCursor, SYNC_CURSOR_HEADER, SYNC_MAX_DELTA_MESSAGES,
+    SYNC_SETTLE_SECONDS
+)
+from .versions import bump_inbox_version, get_directory_version, get_versions
 from django.utils import timezone
-from datetime import timedelta
-from functools import wraps
+from functools import partial, wraps
 
 # Session timeout in seconds (15 seconds for testing)
 SESSION_IDLE_TIMEOUT = 1800
 
+# Results per page of `search_messages_api`
+SEARCH_PAGE_SIZE = 20
+
+# Most messages `broadcast_messages_api` accepts in one request
+BROADCAST_MAX_MESSAGES = 1000
+
+# How long `wait_messages_api` holds a request open, in seconds (keep below proxy read timeouts)
+LONG_POLL_TIMEOUT = 25
+
+# Ids given as request parameters: ASCII digits that fit in a 64-bit integer (`str.isdigit` also accepts characters
+# such as '²', which `int` rejects)
+ID_RE = re.compile(r'[0-9]{1,18}')
+
+
+def _parse_id(value):
+    """
+    Returns the id given as the string `value`, or None when it is not a valid id.
+    """
+    return int(value) if isinstance(value, str) and ID_RE.fullmatch(value) else None
+
+
+class IdConverter:
+    """
+    Path converter for ids in URLs, registered as `<id:...>`; unlike `<int:...>` it only matches `ID_RE`, so an
+    oversized id is a 404 instead of an integer overflow in the database query.
+    """
+    regex = ID_RE.pattern
+
+    def to_python(self, value):
+        return int(value)
+
+    def to_url(self, value):
+        return str(value)
+
 
 def check_session_timeout(view_func):
     """
@@ -32,7 +94,8 @@ def check_session_timeout(view_func):
     If the request is an API call, a JSON response with a session expired
     status is returned, otherwise the user is redirected to the login page.
     If the request is a non-API, non-AJAX request, the session's 'last_activity'
-    timestamp is updated to the current time.
+    timestamp is updated to the current time, at most once per
+    `SESSION_ACTIVITY_GRANULARITY` seconds.
 
     Args:
         view_func (function): The view function to be decorated.
@@ -52,82 +115,603 @@ def check_session_timeout(view_func):
 
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
-        if request.user.is_authenticated:
-            current_time = timezone.now()
-            last_activity = request.session.get('last_activity')
+        response = _session_timeout_response(request)
+        if response is not None:
+            return response
 
-            # Check if this is an API call or a regular request
-            is_api_call = request.path.startswith('/api/')
-            is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        return view_func(request, *args, **kwargs)
 
-            if last_activity:
-                last_activity = timezone.datetime.fromisoformat(last_activity)
-                if current_time - last_activity > timedelta(seconds=SESSION_IDLE_TIMEOUT):
-                    logout(request)
-                    messages.warning(request, "Your session has expired. Please log in again.")
-                    return JsonResponse({'session_expired': True}, status=440) if is_api_call else redirect('login')
+    return wrapper
 
-            # Only update last_activity for non-API, non-AJAX requests
-            if not is_api_call and not is_ajax:
-                request.session['last_activity'] = current_time.isoformat()
+def _session_timeout_response(request):
+    """
+    Runs the session timeout check of `check_session_timeout`.
 
-        return view_func(request, *args, **kwargs)
+    Returns the response to send when the session has expired, or None to let the request through.
+    """
+    if request.user.is_authenticated:
+        # Check if this is an API call or a regular request
+        is_api_call = request.path.startswith('/api/')
+        is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
-    return wrapper
+        if is_idle_expired(request.session, SESSION_IDLE_TIMEOUT):
+            logout(request)
+            messages.warning(request, "Your session has expired. Please log in again.")
+            return JsonResponse({'session_expired': True}, status=440) if is_api_call else redirect('login')
+
+        # Only update last_activity for non-API, non-AJAX requests (coalesced, see `messaging.activity`)
+        if not is_api_call and not is_ajax:
+            touch_activity(request.session)
+
+    return None
 
 @check_session_timeout
 @login_required
 def messages_view(request):
     """
-    Renders the "messages" page displaying a list of root messages (threads) for the logged-in user.
+    Renders the "messages" page displaying a list of root messages (threads) for the logged-in user,
+    most recently active thread first.
     """
-    messages = Message.objects.filter(
-        Q(sender=request.user) | Q(recipient=request.user),
-        parent_message=None
-    ).order_by('-timestamp')
+    def build_inbox():
+        rows = ThreadParticipant.objects.filter(user=request.user).order_by('-last_activity_at').values(
+            'thread_id', 'last_activity_at', 'unread_count', 'thread__root__content', 'thread__last_message__content',
+            'thread__root__sender__first_name', 'thread__root__sender__last_name')
 
-    return render(request, "messages.html", {'messages': messages})
+        # Single indexed scan over the user's threads; the template only needs names and the latest content
+        return [{
+            'id': row['thread_id'],
+            'content': row['thread__last_message__content'] or row['thread__root__content'],
+            'timestamp': row['last_activity_at'],
+            'unread_count': row['unread_count'],
+            'sender': {'first_name': row['thread__root__sender__first_name'],
+                       'last_name': row['thread__root__sender__last_name']},
+        } for row in rows]
 
-@check_session_timeout
-@login_required
-def latest_messages_api(request):
+    messages = get_snapshot('inbox', request.user.id, get_versions(request.user.id), build_inbox)
+
+    # A TemplateResponse is rendered after the view returns, so the instrumentation can time the rendering
+    return TemplateResponse(request, "messages.html", {'messages': messages})
+
+def _conditional_json_response(request, etag, build_payload):
     """
-    Provides an API endpoint to fetch the latest root messages (threads) and their associated thread messages.
+    Returns 304 Not Modified when the request's `If-None-Match` matches `etag`, otherwise a JSON response built by
+    calling `build_payload()`. Either way the response carries the ETag and must be revalidated before reuse.
     """
-    root_messages = Message.objects.filter(
-        Q(sender=request.user) | Q(recipient=request.user),
-        parent_message=None
-    ).order_by('-timestamp')[:20]
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        payload = build_payload()
+        with track_serialization():
+            response = JsonResponse(payload)
 
-    thread_ids = [msg.id for msg in root_messages]
-    all_thread_messages = Message.objects.filter(
-        Q(id__in=thread_ids) |
-        Q(parent_message_id__in=thread_ids)
-    ).order_by('timestamp')
+    return _tag_response(response, etag)
 
-    threads_map = {}
-    for message in all_thread_messages:
-        thread_id = message.parent_message_id or message.id
-        if thread_id not in threads_map:
-            threads_map[thread_id] = []
-        threads_map[thread_id].append({
-            'id': message.id,
-            'sender_name': f"{message.sender.last_name}, {message.sender.first_name}",
-            'recipient_name': f"{message.recipient.last_name}, {message.recipient.first_name}",
-            'content': message.content,
-            'timestamp': timezone.localtime(message.timestamp).isoformat(),
-            'is_sender': message.sender_id == request.user.id
+def _tag_response(response, etag):
+    """
+    Sets the (quoted) `etag` on `response` and marks it as private and to be revalidated before reuse.
+    """
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def _latest_messages_snapshot(user, names):
+    """
+    Builds the full inbox snapshot: the 20 most recently active threads, each with its latest `THREAD_PAGE_SIZE`
+    messages and a `before` token for loading older ones (None when the whole thread is included).
+    """
+    unread_counts = dict(ThreadParticipant.objects.filter(user=user).order_by(
+        '-last_activity_at').values_list('thread_id', 'unread_count')[:20])
+    thread_ids = list(unread_counts)
+
+    # One query for every thread: rank messages newest first within their thread and keep one page (+1 to detect more)
+    all_thread_messages = list(message_rows(Message.objects.filter(
+        root_id__in=thread_ids
+    ).annotate(recency=Window(
+        RowNumber(),
+        partition_by=F('root_id'),
+        order_by=F('sequence').desc()
+    )).filter(recency__lte=THREAD_PAGE_SIZE + 1).order_by('root_id', 'sequence')))
+
+    rows_map = {}
+    for row in all_thread_messages:
+        rows_map.setdefault(row['root_id'], []).append(row)
+
+    # Resolve every name the snapshot needs at once
+    names.load({row['sender_id'] for row in all_thread_messages} | {row['recipient_id'] for row in all_thread_messages})
+
+    messages_data = []
+    for thread_id in thread_ids:
+        rows = rows_map.get(thread_id, [])
+        has_more = len(rows) > THREAD_PAGE_SIZE
+        rows = rows[-THREAD_PAGE_SIZE:]
+        messages_data.append({
+            'thread_id': thread_id,
+            'unread_count': unread_counts[thread_id],
+            'messages': serialize_rows(rows, user.id, names),
+            'before': encode_sequence(rows[0]['sequence']) if has_more else None
         })
 
+    return messages_data
+
+def _thread_history_page(thread_id, user, before, names):
+    """
+    Returns one page of a thread's messages, oldest first, ending just before the `before` token (or at the newest
+    message), plus the token for the next older page (None when there are no older messages).
+
+    Raises `InvalidPageToken` for malformed tokens.
+    """
+    thread_messages = Message.objects.filter(root_id=thread_id)
+    if before:
+        thread_messages = thread_messages.filter(sequence__lt=decode_sequence(before))
+
+    rows = list(message_rows(thread_messages.order_by('-sequence'))[:THREAD_PAGE_SIZE + 1])
+    has_more = len(rows) > THREAD_PAGE_SIZE
+    rows = rows[:THREAD_PAGE_SIZE][::-1]
+
+    return (
+        serialize_rows(rows, user.id, names),
+        encode_sequence(rows[0]['sequence']) if has_more else None
+    )
+
+def _archived_thread_page(archived, user, before, names):
+    """
+    Same as `_thread_history_page` for a thread moved to the archive (see `messaging.archive`). Reads the thread's
+    archive member up to the `before` token, keeping only the last page in memory.
+
+    Raises `InvalidPageToken` for malformed tokens.
+    """
+    before_sequence = decode_sequence(before) if before else None
+    page = deque(maxlen=THREAD_PAGE_SIZE + 1)
+    for row in read_thread(archived):
+        if before_sequence is not None and row['sequence'] >= before_sequence:
+            break
+        page.append(row)
+
+    has_more = len(page) > THREAD_PAGE_SIZE
+    rows = list(page)[-THREAD_PAGE_SIZE:]
+
+    return (
+        serialize_rows(rows, user.id, names),
+        encode_sequence(rows[0]['sequence']) if has_more else None
+    )
+
+def _archived_thread(thread_id, user):
+    """
+    Returns the `ArchivedThread` with id `thread_id` if `user` took part in it, None otherwise.
+    """
+    return ArchivedThread.objects.filter(Q(sender=user) | Q(recipient=user), pk=thread_id).first()
+
+def _thread_participant_ids(thread_id):
+    """
+    Returns the ids of the sender and recipient of the thread's root message, or None when there is no such thread.
+    """
+    root = Message.objects.filter(pk=thread_id, root_id=thread_id).values('sender_id', 'recipient_id').first()
+    return (root['sender_id'], root['recipient_id']) if root else None
+
+def _latest_messages_delta(user, cursor, names):
+    """
+    Builds a delta against a decoded sync cursor: only the messages the user received or sent that the cursor does not
+    cover, grouped by thread, each with its root message (the thread head) so clients can render unseen threads.
+    Returns the threads and the `(watermark, recent_ids)` of the next cursor.
+
+    Returns None when too many messages arrived since the cursor and a full snapshot should be sent instead.
+    """
+    since_message_id, seen_ids = cursor
+    rows = list(message_rows(Message.objects.filter(
+        Q(sender=user) | Q(recipient=user),
+        id__gt=since_message_id
+    ).order_by('id')[:SYNC_MAX_DELTA_MESSAGES + len(seen_ids) + 1]))
+    new_messages = [row for row in rows if row['id'] not in seen_ids]
+
+    if len(new_messages) > SYNC_MAX_DELTA_MESSAGES:
+        return None
+
+    threads_map = {}
+    for row, message in zip(new_messages, serialize_rows(new_messages, user.id, names)):
+        thread_id = row['root_id']
+        threads_map.setdefault(thread_id, []).append(message)
+
+    roots = list(message_rows(Message.objects.filter(id__in=threads_map.keys())))
+    roots_map = {root['id']: message for root, message in zip(roots, serialize_rows(roots, user.id, names))}
+    unread_counts = dict(ThreadParticipant.objects.filter(
+        user=user, thread_id__in=threads_map.keys()).values_list('thread_id', 'unread_count'))
+
     messages_data = []
-    for root_message in root_messages:
-        thread = threads_map.get(root_message.id, [])
+    for thread_id, thread in threads_map.items():
         messages_data.append({
-            'thread_id': root_message.id,
+            'thread_id': thread_id,
+            'root': roots_map.get(thread_id),
+            'unread_count': unread_counts.get(thread_id, 0),
             'messages': thread
         })
 
-    return JsonResponse({'threads': messages_data})
+    return messages_data, advance_cursor(since_message_id, [(row['id'], row['timestamp']) for row in rows])
+
+@check_session_timeout
+@login_required
+@read_from_replica
+def latest_messages_api(request):
+    """
+    Provides an API endpoint to fetch the latest root messages (threads) and their associated thread messages.
+
+    Every response carries a `cursor`. When it is sent back as `?since=<cursor>`, only the messages created after
+    it are returned (`mode` is `delta`). Missing, invalid or expired cursors, and deltas that grew too large, fall
+    back to a full snapshot (`mode` is `full`).
+
+    Responses carry an ETag derived from the user's inbox version. A client whose `If-None-Match` matches is already
+    up to date and gets a 304 Not Modified without any query on the `Message` table.
+
+    Reads may be served by a read replica, except right after the user's inbox changed (see `messaging.routers`).
+    """
+    # The versions are read before the payload is built, so a write in between only costs one extra 200
+    response = _conditional_json_response(
+        request,
+        _latest_messages_etag(request.user.id, get_versions(request.user.id)),
+        lambda: _latest_messages_payload(request.user, request.GET.get('since'))
+    )
+    return _renew_cursor(response, request.user.id, request.GET.get('since'))
+
+def _renew_cursor(response, user_id, since):
+    """
+    Re-issues the valid `since` cursor of a 304 Not Modified in the `SYNC_CURSOR_HEADER` header, so a client whose
+    inbox does not change keeps a fresh cursor (see `messaging.sync`).
+    """
+    if response.status_code == 304 and since:
+        try:
+            response[SYNC_CURSOR_HEADER] = encode_cursor(user_id, *decode_cursor(since, user_id))
+        except InvalidCursor:
+            pass
+    return response
+
+def _latest_messages_etag(user_id, versions):
+    inbox_version, directory_version = versions
+    return f"{user_id}-{inbox_version}-{directory_version}"
+
+def _latest_messages_payload(user, since):
+    """
+    Builds the response body of `latest_messages_api`: a delta against the `since` cursor when possible,
+    a full snapshot otherwise.
+    """
+    names = UserNameCache()
+    if since:
+        try:
+            delta = _latest_messages_delta(user, decode_cursor(since, user.id), names)
+        except InvalidCursor:
+            delta = None
+
+        if delta is not None:
+            messages_data, cursor = delta
+            return {
+                'mode': 'delta',
+                'cursor': encode_cursor(user.id, *cursor),
+                'threads': messages_data
+            }
+
+    def build_snapshot():
+        # Take the cursor before building the snapshot so nothing written in between is skipped by the next delta
+        user_messages = Message.objects.filter(Q(sender=user) | Q(recipient=user))
+        settled_id = user_messages.filter(
+            timestamp__lte=timezone.now() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+        ).aggregate(last_id=Max('id'))['last_id'] or 0
+        recent_ids = list(user_messages.filter(id__gt=settled_id).order_by('id').values_list(
+            'id', flat=True)[:SYNC_MAX_DELTA_MESSAGES])
+        return (settled_id, recent_ids), _latest_messages_snapshot(user, names)
+
+    cursor, messages_data = get_snapshot('latest', user.id, get_versions(user.id), build_snapshot)
+    return {
+        'mode': 'full',
+        'cursor': encode_cursor(user.id, *cursor),
+        'threads': messages_data
+    }
+
+async def wait_messages_api(request):
+    """
+    Long-polling variant of `latest_messages_api` for clients that cannot keep a WebSocket open.
+
+    Takes the same `since` cursor and returns the same payload, but when nothing is new yet the request is held
+    open until the user's pub/sub subscription receives a message or `LONG_POLL_TIMEOUT` seconds pass, in which
+    case an empty delta with a fresh cursor is returned. Idle requests wait on an `asyncio.Queue` and cost no
+    queries or threads while held open under ASGI.
+    """
+    response = await sync_to_async(_session_timeout_response)(request)
+    if response is not None:
+        return response
+
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return redirect_to_login(request.get_full_path())
+
+    hub = get_hub()
+    # Subscribe before reading so a message sent in between still wakes us up
+    subscription = hub.subscribe(user.id)
+    try:
+        payload = await sync_to_async(_latest_messages_payload)(user, request.GET.get('since'))
+        if payload['mode'] == 'delta' and not payload['threads']:
+            try:
+                await asyncio.wait_for(subscription.get(), LONG_POLL_TIMEOUT)
+            except asyncio.TimeoutError:
+                return JsonResponse(payload)
+            payload = await sync_to_async(_latest_messages_payload)(user, payload['cursor'])
+    finally:
+        hub.unsubscribe(subscription)
+
+    return JsonResponse(payload)
+
+@check_session_timeout
+@login_required
+def inbox_api(request):
+    """
+    Provides an API endpoint listing the user's threads, most recently active first, one keyset page at a time.
+
+    Each thread comes with its root and latest message and the user's unread count. Pass the returned `before`
+    token to get the next page.
+    """
+    participants = ThreadParticipant.objects.filter(user=request.user)
+    before = request.GET.get('before')
+    if before:
+        try:
+            participants = participants.filter(keyset_before('last_activity_at', 'thread_id', before))
+        except InvalidPageToken:
+            return JsonResponse({'error': 'Invalid page token', 'field': 'before'}, status=400)
+
+    page = list(participants.order_by('-last_activity_at', '-thread_id').values(
+        'thread_id', 'last_activity_at', 'unread_count', 'thread__message_count', 'thread__last_message_id'
+    )[:INBOX_PAGE_SIZE + 1])
+    has_more = len(page) > INBOX_PAGE_SIZE
+    page = page[:INBOX_PAGE_SIZE]
+
+    message_ids = {row['thread_id'] for row in page} | {row['thread__last_message_id'] for row in page}
+    rows = list(message_rows(Message.objects.filter(id__in=message_ids - {None})))
+    serialized = dict(zip((row['id'] for row in rows), serialize_rows(rows, request.user.id, UserNameCache())))
+
+    threads_data = [{
+        'thread_id': row['thread_id'],
+        'message_count': row['thread__message_count'],
+        'unread_count': row['unread_count'],
+        'root': serialized.get(row['thread_id']),
+        'last_message': serialized.get(row['thread__last_message_id'] or row['thread_id'])
+    } for row in page]
+
+    return JsonResponse({
+        'threads': threads_data,
+        'before': encode_keyset(page[-1]['last_activity_at'], page[-1]['thread_id']) if has_more else None
+    })
+
+@check_session_timeout
+@login_required
+def thread_messages_api(request, thread_id):
+    """
+    Provides an API endpoint returning one keyset page of a thread's history, oldest message first.
+
+    Without `before` the newest page is returned. Pass the returned `before` token to get the next older page.
+    Only the participants of the thread can read it. Archived threads are read from the archive.
+    """
+    participant_ids = _thread_participant_ids(thread_id)
+    archived = _archived_thread(thread_id, request.user) if participant_ids is None else None
+    if archived is None and (participant_ids is None or request.user.id not in participant_ids):
+        return JsonResponse({'error': 'Message not found'}, status=404)
+
+    try:
+        if archived is not None:
+            messages_data, before = _archived_thread_page(archived, request.user, request.GET.get('before'), UserNameCache())
+        else:
+            messages_data, before = _thread_history_page(thread_id, request.user, request.GET.get('before'), UserNameCache())
+    except InvalidPageToken:
+        return JsonResponse({'error': 'Invalid page token', 'field': 'before'}, status=400)
+
+    return JsonResponse({
+        'thread_id': thread_id,
+        'messages': messages_data,
+        'before': before
+    })
+
+@check_session_timeout
+@login_required
+def thread_detail_api(request, thread_id):
+    """
+    Provides an API endpoint returning a single thread: its root message, the newest page of its history and a
+    `before` token for older pages. Only the participants of the thread can read it.
+
+    Responses carry an ETag built from the thread summary. A request whose `If-None-Match` matches costs one
+    primary-key lookup and gets a 304 Not Modified. Archived threads are read from the archive, and never change.
+    """
+    thread = Thread.objects.filter(pk=thread_id).values(
+        'root__sender_id', 'root__recipient_id', 'last_message_id', 'message_count').first()
+    if thread is None:
+        archived = _archived_thread(thread_id, request.user)
+        if archived is None:
+            return JsonResponse({'error': 'Message not found'}, status=404)
+        return _archived_thread_detail(request, archived)
+    if request.user.id not in (thread['root__sender_id'], thread['root__recipient_id']):
+        return JsonResponse({'error': 'Message not found'}, status=404)
+
+    def build_payload():
+        names = UserNameCache()
+        messages_data, before = _thread_history_page(thread_id, request.user, None, names)
+        if before is None:
+            root = messages_data[0]
+        else:
+            root = serialize_rows(message_rows(Message.objects.filter(pk=thread_id)), request.user.id, names)[0]
+
+        return {
+            'thread_id': thread_id,
+            'message_count': thread['message_count'],
+            'root': root,
+            'messages': messages_data,
+            'before': before
+        }
+
+    # `is_sender` depends on who is asking, so the user is part of the tag
+    return _conditional_json_response(
+        request,
+        f"{request.user.id}-{thread_id}-{thread['last_message_id']}-{thread['message_count']}",
+        build_payload
+    )
+
+def _archived_thread_detail(request, archived):
+    def build_payload():
+        names = UserNameCache()
+        messages_data, before = _archived_thread_page(archived, request.user, None, names)
+        if before is None:
+            root = messages_data[0]
+        else:
+            root = serialize_rows([next(read_thread(archived))], request.user.id, names)[0]
+
+        return {
+            'thread_id': archived.thread_id,
+            'message_count': archived.message_count,
+            'archived': True,
+            'root': root,
+            'messages': messages_data,
+            'before': before
+        }
+
+    return _conditional_json_response(
+        request,
+        f"{request.user.id}-{archived.thread_id}-archived-{archived.last_sequence}",
+        build_payload
+    )
+
+@check_session_timeout
+@login_required
+def archived_threads_api(request):
+    """
+    Provides an API endpoint listing the user's archived threads, most recently active first, one keyset page at a
+    time. Each thread comes with its message count and the name of the other participant; its messages are loaded
+    from the archive by the thread endpoints. Pass the returned `before` token to get the next page.
+    """
+    archived = ArchivedThread.objects.filter(Q(sender=request.user) | Q(recipient=request.user))
+    before = request.GET.get('before')
+    if before:
+        try:
+            archived = archived.filter(keyset_before('last_activity_at', 'thread_id', before))
+        except InvalidPageToken:
+            return JsonResponse({'error': 'Invalid page token', 'field': 'before'}, status=400)
+
+    page = list(archived.order_by('-last_activity_at', '-thread_id').values(
+        'thread_id', 'sender_id', 'recipient_id', 'message_count', 'last_activity_at'
+    )[:INBOX_PAGE_SIZE + 1])
+    has_more = len(page) > INBOX_PAGE_SIZE
+    page = page[:INBOX_PAGE_SIZE]
+
+    names = UserNameCache()
+    names.load({row['sender_id'] for row in page} | {row['recipient_id'] for row in page})
+    threads_data = [{
+        'thread_id': row['thread_id'],
+        'message_count': row['message_count'],
+        'last_activity_at': timezone.localtime(row['last_activity_at']).isoformat(),
+        'with_name': names.get(row['recipient_id'] if row['sender_id'] == request.user.id else row['sender_id'])
+    } for row in page]
+
+    return JsonResponse({
+        'threads': threads_data,
+        'before': encode_keyset(page[-1]['last_activity_at'], page[-1]['thread_id']) if has_more else None
+    })
+
+@check_session_timeout
+@login_required
+def export_messages_api(request):
+    """
+    Provides an API endpoint streaming the user's full conversation history, archived threads included, as a file
+    download: NDJSON by default, CSV with `format=csv`, gzip-compressed with `gzip=1`. One row per message, thread
+    by thread (see `messaging.export`). The response starts right away and memory use does not grow with the history.
+    """
+    error = _export_format_error(request)
+    if error is not None:
+        return error
+    return _export_response(request, export_chunks)
+
+def _export_format_error(request):
+    if request.GET.get('format', 'ndjson') not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Invalid export format', 'field': 'format'}, status=400)
+    return None
+
+def _export_response(request, chunks):
+    """
+    Builds the download response of an export from `chunks(user, export_format, compress)`.
+    """
+    export_format = request.GET.get('format', 'ndjson')
+    compress = request.GET.get('gzip') == '1'
+    filename = f"messages-{request.user.username}.{export_format}{'.gz' if compress else ''}"
+
+    response = StreamingHttpResponse(
+        chunks(request.user, export_format, compress),
+        content_type='application/gzip' if compress else EXPORT_FORMATS[export_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+
+@check_session_timeout
+@login_required
+def mark_thread_read_api(request, thread_id):
+    """
+    Marks a thread as read for the logged-in user, up to the message id given as `message_id` (POST), or up to the
+    latest message when it is omitted. The read position never moves back. Returns the remaining unread count.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    message_id = request.POST.get('message_id')
+    if message_id is not None:
+        message_id = _parse_id(message_id)
+        if message_id is None:
+            return JsonResponse({'error': 'Invalid message id', 'field': 'message_id'}, status=400)
+
+    with transaction.atomic():
+        participant = ThreadParticipant.objects.select_for_update().select_related('thread').filter(
+            thread_id=thread_id, user=request.user).first()
+        if participant is None:
+            return JsonResponse({'error': 'Message not found'}, status=404)
+
+        # Ids past the end of the thread would hide future messages, so clamp them to the latest one
+        latest_id = participant.thread.last_message_id or thread_id
+        participant.mark_read(min(message_id, latest_id) if message_id is not None else latest_id)
+        transaction.on_commit(partial(_read_state_committed, request.user.id))
+
+    return JsonResponse({
+        'thread_id': thread_id,
+        'last_read_message_id': participant.last_read_message_id,
+        'unread_count': participant.unread_count
+    })
+
+def _read_state_committed(user_id):
+    # Unread counts are part of the user's inbox payloads, so they must be rebuilt
+    bump_inbox_version(user_id)
+    invalidate_snapshots(user_id)
+
+@check_session_timeout
+@login_required
+def search_messages_api(request):
+    """
+    Provides an API endpoint searching the content of the messages the user sent or received.
+
+    Every word of `q` must appear in a result. Results are newest first, each with its thread id, the serialized
+    message and an HTML-escaped `snippet` with the matching words wrapped in `<mark>`. Pass the returned `before`
+    value to get the next page.
+    """
+    query = request.GET.get('q', '').strip()
+    before = request.GET.get('before')
+    if before is not None:
+        before = _parse_id(before)
+        if before is None:
+            return JsonResponse({'error': 'Invalid page token', 'field': 'before'}, status=400)
+
+    message_ids = search_message_ids(request.user.id, query, before=before, limit=SEARCH_PAGE_SIZE + 1)
+    has_more = len(message_ids) > SEARCH_PAGE_SIZE
+    message_ids = message_ids[:SEARCH_PAGE_SIZE]
+
+    rows = list(message_rows(Message.objects.filter(id__in=message_ids).order_by('-id')))
+    results = [{
+        'thread_id': row['root_id'],
+        'message': message,
+        'snippet': highlight(row['content'], query)
+    } for row, message in zip(rows, serialize_rows(rows, request.user.id, UserNameCache()))]
+
+    return JsonResponse({
+        'results': results,
+        'before': message_ids[-1] if has_more else None
+    })
 
 def create_user(request):
     """
@@ -199,7 +783,7 @@ def login_view(request):
         if user is not None:
             login(request, user)
             # Initialize last activity timestamp
-            request.session['last_activity'] = timezone.now().isoformat()
+            touch_activity(request.session, force=True)
             return JsonResponse({
                 'success': True,
                 'redirect_url': '/messages/'
@@ -251,27 +835,37 @@ def new_message(request):
 
 @check_session_timeout
 @login_required
+@read_from_replica
 def search_users(request):
     """
-    Handles user search functionality.
+    Handles user search functionality, backed by the search index in `messaging.search`.
+
+    Responses carry an ETag derived from the user directory version, so repeating a search while no user was
+    created or renamed returns 304 Not Modified without querying the `User` table. Reads may be served by a read replica.
     """
     query = request.GET.get('username', '').strip()
     if len(query) < 2:
         return JsonResponse({'users': []})
 
-    users = User.objects.filter(
-        Q(username__icontains=query) |
-        Q(first_name__icontains=query) |
-        Q(last_name__icontains=query)
-    ).exclude(id=request.user.id)[:5]
+    def build_payload():
+        # Ranked: exact username, then prefix matches, then substring matches
+        user_ids = search_user_ids(query, exclude_user_id=request.user.id, limit=5)
+        return _search_users_payload(user_ids, User.objects.in_bulk(user_ids))
 
+    # Results exclude the requesting user, so the user is part of the tag (the query is part of the URL)
+    return _conditional_json_response(request, f"{request.user.id}-{get_directory_version()}", build_payload)
+
+def _search_users_payload(user_ids, users):
+    """
+    Builds the response body of `search_users` from the ranked `user_ids` and the matching users keyed by id.
+    """
     users_data = [{
-        'username': user.username,
-        'first_name': user.first_name,
-        'last_name': user.last_name
-    } for user in users]
+        'username': users[user_id].username,
+        'first_name': users[user_id].first_name,
+        'last_name': users[user_id].last_name
+    } for user_id in user_ids if user_id in users]
 
-    return JsonResponse({'users': users_data})
+    return {'users': users_data}
 
 @check_session_timeout
 @login_required
@@ -286,23 +880,9 @@ def send_message(request):
     content = request.POST.get('content')
     reply_to = request.POST.get('reply_to')
 
-    if not recipient_username:
-        return JsonResponse({
-            'error': 'Recipient is required',
-            'field': 'recipient'
-        }, status=400)
-
-    if not content:
-        return JsonResponse({
-            'error': 'Message content is required',
-            'field': 'content'
-        }, status=400)
-
-    if len(content) > 1024:
-        return JsonResponse({
-            'error': 'Message content exceeds maximum length of 1024 characters',
-            'field': 'content'
-        }, status=400)
+    error = _send_message_form_error(recipient_username, content)
+    if error is not None:
+        return error
 
     try:
         recipient = User.objects.get(username=recipient_username)
@@ -316,38 +896,25 @@ def send_message(request):
     if reply_to:
         try:
             parent_message = Message.objects.get(id=reply_to)
-
-            if parent_message.sender != request.user and parent_message.recipient != request.user:
-                return JsonResponse({
-                    'error': 'Message not found',
-                    'field': 'recipient'
-                }, status=404)
-
-            if recipient not in [parent_message.sender, parent_message.recipient]:
-                return JsonResponse({
-                    'error': 'Invalid recipient for this reply',
-                    'field': 'recipient'
-                }, status=400)
-
         except Message.DoesNotExist:
-            return JsonResponse({
-                'error': 'Message not found',
-                'field': 'recipient'
-            }, status=404)
+            parent_message = None
         except Exception:
             return JsonResponse({
                 'error': 'An error occurred',
                 'field': 'recipient'
             }, status=500)
 
+        error = _reply_error(parent_message, request.user, recipient)
+        if error is not None:
+            return error
+
     try:
-        message = Message(
+        _save_message(Message(
             sender=request.user,
             recipient=recipient,
             content=content,
             parent_message=parent_message
-        )
-        message.save()
+        ))
         return JsonResponse({'success': True})
 
     except Exception as e:
@@ -356,15 +923,182 @@ def send_message(request):
             'field': 'content'
         }, status=500)
 
+def _send_message_form_error(recipient_username, content):
+    """
+    Validates the form fields of `send_message`. Returns the error response, or None when they are valid.
+    """
+    if not recipient_username:
+        return JsonResponse({
+            'error': 'Recipient is required',
+            'field': 'recipient'
+        }, status=400)
+
+    if not content:
+        return JsonResponse({
+            'error': 'Message content is required',
+            'field': 'content'
+        }, status=400)
+
+    if len(content) > 1024:
+        return JsonResponse({
+            'error': 'Message content exceeds maximum length of 1024 characters',
+            'field': 'content'
+        }, status=400)
+
+    return None
+
+def _reply_error(parent_message, user, recipient):
+    """
+    Validates a reply to `parent_message` (None when it does not exist). Returns the error response, or None when
+    `user` may reply to it and `recipient` takes part in its thread.
+    """
+    if parent_message is None or user.id not in (parent_message.sender_id, parent_message.recipient_id):
+        return JsonResponse({
+            'error': 'Message not found',
+            'field': 'recipient'
+        }, status=404)
+
+    if recipient.id not in (parent_message.sender_id, parent_message.recipient_id):
+        return JsonResponse({
+            'error': 'Invalid recipient for this reply',
+            'field': 'recipient'
+        }, status=400)
+
+    return None
+
+def _save_message(message):
+    with transaction.atomic():
+        message.save()
+        # Push to connected clients only once the message is visible to their next read
+        transaction.on_commit(lambda: publish_message(message))
+
+@check_session_timeout
+@login_required
+def broadcast_messages_api(request):
+    """
+    Sends many messages in one request (POST, JSON body), either the same content to many users:
+
+        {"recipients": ["alice", "bob"], "content": "..."}
+
+    or a list of independent messages, each like the form fields of `send_message`:
+
+        {"messages": [{"recipient": "alice", "content": "...", "reply_to": 12}, ...]}
+
+    Recipients and parent messages are looked up with one query each and every valid message is written with one
+    bulk INSERT. Invalid items do not stop the others; `results` reports success or an error per item, in order.
+    A `reply_to` that is not an id is reported as an error of its item (`field` is `reply_to`).
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    try:
+        body = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+    if not isinstance(body, dict):
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+    items = body.get('messages', [])
+    if 'recipients' in body:
+        items = body['recipients']
+        if isinstance(items, list):
+            items = [{'recipient': name, 'content': body.get('content')} for name in items]
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+    if not items:
+        return JsonResponse({'error': 'At least one message is required', 'field': 'messages'}, status=400)
+
+    if len(items) > BROADCAST_MAX_MESSAGES:
+        return JsonResponse({
+            'error': f'No more than {BROADCAST_MAX_MESSAGES} messages can be sent at once',
+            'field': 'messages'
+        }, status=400)
+
+    recipients = User.objects.filter(
+        username__in={str(item.get('recipient')) for item in items}).only('id', 'username').in_bulk(field_name='username')
+    reply_tos = [_reply_to_id(item) for item in items]
+    parents = Message.objects.filter(
+        id__in={reply_to for reply_to in reply_tos if reply_to is not None}
+    ).only('id', 'root_id', 'sender_id', 'recipient_id').in_bulk()
+
+    results = []
+    messages = []
+    for index, (item, reply_to) in enumerate(zip(items, reply_tos)):
+        error = _broadcast_item_error(item, reply_to, request.user, recipients, parents)
+        if error:
+            results.append({'index': index, 'success': False, **error})
+            continue
+
+        parent = parents[reply_to] if reply_to is not None else None
+        messages.append((index, Message(
+            sender=request.user,
+            recipient=recipients[str(item['recipient'])],
+            content=item['content'],
+            parent_message=parent
+        )))
+
+    if messages:
+        saved = Message.bulk_send([message for _, message in messages])
+        transaction.on_commit(lambda: publish_messages(saved))
+        results.extend({
+            'index': index,
+            'success': True,
+            'id': message.id,
+            'thread_id': message.root_id
+        } for (index, _), message in zip(messages, saved))
+
+    results.sort(key=lambda result: result['index'])
+    return JsonResponse({'sent': len(messages), 'results': results})
+
+def _reply_to_id(item):
+    """
+    Returns the `reply_to` of a `broadcast_messages_api` item (a number or a string of digits) as an id, or None when
+    the item has none or it is not a valid id.
+    """
+    reply_to = item.get('reply_to')
+    if isinstance(reply_to, int) and not isinstance(reply_to, bool):
+        reply_to = str(reply_to)
+    return _parse_id(reply_to)
+
+def _broadcast_item_error(item, reply_to, user, recipients, parents):
+    """
+    Validates one item of `broadcast_messages_api` with the same rules as `send_message`, given its `reply_to` id
+    from `_reply_to_id`. Returns None when it is valid, otherwise a dict with `error` and `field`.
+    """
+    content = item.get('content')
+    if not item.get('recipient'):
+        return {'error': 'Recipient is required', 'field': 'recipient'}
+    if not content or not isinstance(content, str):
+        return {'error': 'Message content is required', 'field': 'content'}
+    if len(content) > 1024:
+        return {'error': 'Message content exceeds maximum length of 1024 characters', 'field': 'content'}
+
+    recipient = recipients.get(str(item['recipient']))
+    if recipient is None:
+        return {'error': 'Recipient not found', 'field': 'recipient'}
+
+    if reply_to is None and item.get('reply_to') not in (None, ''):
+        return {'error': 'Invalid message id', 'field': 'reply_to'}
+    if reply_to is not None:
+        parent = parents.get(reply_to)
+        if parent is None or user.id not in (parent.sender_id, parent.recipient_id):
+            return {'error': 'Message not found', 'field': 'recipient'}
+        if recipient.id not in (parent.sender_id, parent.recipient_id):
+            return {'error': 'Invalid recipient for this reply', 'field': 'recipient'}
 
+    return None
 
 @login_required
 def update_activity(request):
     """
     Updates the user's last activity timestamp.
-    Only responds to POST requests to prevent accidental updates.
+    Only responds to POST requests to prevent accidental updates. The session is only written when the stored
+    timestamp is older than `SESSION_ACTIVITY_GRANULARITY` seconds.
     """
     if request.method == 'POST':
-        request.session['last_activity'] = timezone.now().isoformat()
+        touch_activity(request.session)
         return JsonResponse({'success': True})
     return JsonResponse({'error': 'Method not allowed'}, status=405)
\ No newline at end of file
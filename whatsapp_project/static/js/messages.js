@@ -21,25 +21,32 @@ $(document).ready(function () {
     let currentMessageId = null;
     const UPDATE_INTERVAL = 5000;
 
+    // Delta sync state: the last cursor returned by the server and the threads seen so far
+    let syncCursor = null;
+    let inboxETag = null;
+    const threadsCache = {};
+
+    // Keyset pagination state: `before` tokens for older threads and for older messages of each thread
+    let inboxPageToken;
+    let loadingInboxPage = false;
+    const olderPageTokens = {};
+    let loadingOlderMessages = false;
+
     function fetchAndUpdateThreads() {
         $.ajax({
             url: '/api/messages/latest/',
             method: 'GET',
-            success: function(response) {
-                if (response && response.threads) {
-                    // Update all thread previews
-                    response.threads.forEach(threadData => {
-                        const thread = threadData.messages;
-                        if (thread && thread.length > 0) {
-                            updateMessagePreview(threadData.thread_id, thread);
-                            
-                            // If this is the currently open thread, update it too
-                            if (threadData.thread_id === currentMessageId) {
-                                displayMessageThread(thread);
-                            }
-                        }
-                    });
+            data: syncCursor ? { since: syncCursor } : {},
+            // Nothing changed since the last response we processed: the server answers 304 with no body
+            headers: inboxETag ? { 'If-None-Match': inboxETag } : {},
+            success: function(response, status, xhr) {
+                if (xhr.status === 304) {
+                    // The server re-issues our cursor so it does not expire while the inbox stays unchanged
+                    syncCursor = xhr.getResponseHeader('X-Sync-Cursor') || syncCursor;
+                    return;
                 }
+                inboxETag = xhr.getResponseHeader('ETag');
+                handleThreadsResponse(response);
             },
             error: function(xhr) {
                 if (xhr.status == 440) {
@@ -51,6 +58,48 @@ $(document).ready(function () {
         });
     }
 
+    function handleThreadsResponse(response) {
+        if (response && response.threads) {
+            syncCursor = response.cursor || null;
+
+            response.threads.forEach(threadData => {
+                if (response.mode !== 'delta') {
+                    olderPageTokens[threadData.thread_id] = threadData.before;
+                }
+                const thread = response.mode === 'delta' ?
+                    mergeThreadDelta(threadData) :
+                    (threadsCache[threadData.thread_id] = threadData.messages);
+
+                if (thread && thread.length > 0) {
+                    updateMessagePreview(threadData.thread_id, thread);
+                    
+                    // If this is the currently open thread, update it too
+                    if (threadData.thread_id === currentMessageId) {
+                        displayMessageThread(thread);
+                        markThreadRead(threadData.thread_id, thread);
+                    } else {
+                        setUnreadCount(threadData.thread_id, threadData.unread_count);
+                    }
+                }
+            });
+        }
+    }
+
+    function mergeThreadDelta(threadData) {
+        // Start unseen threads from their root message, then append only messages we don't have yet
+        const thread = threadsCache[threadData.thread_id] ||
+            (threadsCache[threadData.thread_id] = threadData.root ? [threadData.root] : []);
+        const knownIds = new Set(thread.map(message => message.id));
+
+        threadData.messages.forEach(message => {
+            if (!knownIds.has(message.id)) {
+                thread.push(message);
+                knownIds.add(message.id);
+            }
+        });
+        return thread;
+    }
+
     function updateMessagePreview(messageId, thread) {
         if (!thread || thread.length === 0) return;
 
@@ -73,6 +122,7 @@ $(document).ready(function () {
                     <div class="sender-info">
                         <span class="sender-name"></span>
                         <span class="message-time"></span>
+                        <span class="unread-badge" hidden></span>
                     </div>
                     <div class="message-snippet"></div>
                 </div>
@@ -89,6 +139,25 @@ $(document).ready(function () {
         sortMessagePreviews();
     }
 
+    function setUnreadCount(threadId, count) {
+        if (count === undefined) return;
+        $(`.message-preview[data-message-id="${threadId}"] .unread-badge`)
+            .text(count)
+            .prop('hidden', !count);
+    }
+
+    function markThreadRead(threadId, thread) {
+        setUnreadCount(threadId, 0);
+        if (!thread || thread.length === 0) return;
+
+        $.ajax({
+            url: `/api/threads/${threadId}/read/`,
+            method: 'POST',
+            data: { message_id: thread[thread.length - 1].id },
+            headers: { 'X-CSRFToken': getCookie('csrftoken') }
+        });
+    }
+
     function sortMessagePreviews() {
         const messagesList = $('#messagesList');
         const previews = messagesList.children('.message-preview').get();
@@ -104,7 +173,71 @@ $(document).ready(function () {
         });
     }
 
-    function displayMessageThread(thread) {
+    function loadInboxPage() {
+        if (loadingInboxPage || inboxPageToken === null) return;
+        loadingInboxPage = true;
+
+        $.ajax({
+            url: '/api/threads/',
+            method: 'GET',
+            data: inboxPageToken ? { before: inboxPageToken } : {},
+            success: function(response) {
+                inboxPageToken = response.before;
+                response.threads.forEach(threadData => {
+                    if (!threadsCache[threadData.thread_id] && threadData.root && threadData.last_message) {
+                        updateMessagePreview(threadData.thread_id, [threadData.root, threadData.last_message]);
+                        setUnreadCount(threadData.thread_id, threadData.unread_count);
+                    }
+                });
+            },
+            complete: function() {
+                loadingInboxPage = false;
+            }
+        });
+    }
+
+    function loadOlderMessages() {
+        const threadId = currentMessageId;
+        if (loadingOlderMessages || !threadId || !olderPageTokens[threadId]) return;
+        loadingOlderMessages = true;
+
+        $.ajax({
+            url: `/api/threads/${threadId}/messages/`,
+            method: 'GET',
+            data: { before: olderPageTokens[threadId] },
+            success: function(response) {
+                olderPageTokens[threadId] = response.before;
+                const thread = threadsCache[threadId];
+                if (!thread || threadId !== currentMessageId) return;
+
+                const knownIds = new Set(thread.map(message => message.id));
+                thread.unshift(...response.messages.filter(message => !knownIds.has(message.id)));
+
+                // Keep the messages the user was looking at in place while the older ones are added above
+                const messageThread = $('#messageThread');
+                const distanceFromBottom = messageThread[0].scrollHeight - messageThread.scrollTop();
+                displayMessageThread(thread, true);
+                messageThread.scrollTop(messageThread[0].scrollHeight - distanceFromBottom);
+            },
+            complete: function() {
+                loadingOlderMessages = false;
+            }
+        });
+    }
+
+    $('#messagesList').on('scroll', function () {
+        if (this.scrollTop + this.clientHeight >= this.scrollHeight - 50) {
+            loadInboxPage();
+        }
+    });
+
+    $('#messageThread').on('scroll', function () {
+        if (this.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
+
+    function displayMessageThread(thread, keepScroll) {
         const messageThread = $('#messageThread');
         messageThread.empty();
         if (thread && thread.length > 0) {
@@ -121,7 +254,9 @@ $(document).ready(function () {
                     </div>
                 `);
             });
-            scrollToBottom();
+            if (!keepScroll) {
+                scrollToBottom();
+            }
         } else {
             messageThread.append('<div class="no-message-selected">No messages to display</div>');
         }
@@ -134,9 +269,95 @@ $(document).ready(function () {
         }
     }
 
-    // Initialize and start periodic updates
-    fetchAndUpdateThreads();
-    setInterval(fetchAndUpdateThreads, UPDATE_INTERVAL);
+    // Push updates over a WebSocket when the server supports it, long-polling otherwise
+    let polling = false;
+    let pollRequest = null;
+    let reconnectDelay = 1000;
+    const MAX_RECONNECT_DELAY = 60000;
+    const LONG_POLL_TIMEOUT = 40000;
+
+    function startPolling() {
+        if (!polling) {
+            polling = true;
+            longPoll();
+        }
+    }
+
+    function stopPolling() {
+        polling = false;
+        if (pollRequest !== null) {
+            pollRequest.abort();
+            pollRequest = null;
+        }
+    }
+
+    function longPoll() {
+        if (!polling) return;
+
+        // The server holds the request until a new message arrives, so re-issue it right away
+        pollRequest = $.ajax({
+            url: '/api/messages/wait/',
+            method: 'GET',
+            data: syncCursor ? { since: syncCursor } : {},
+            timeout: LONG_POLL_TIMEOUT,
+            success: function(response) {
+                handleThreadsResponse(response);
+                longPoll();
+            },
+            error: function(xhr, status) {
+                if (xhr.status == 440) {
+                    window.location.href = '/login/';
+                } else if (status !== 'abort') {
+                    setTimeout(longPoll, UPDATE_INTERVAL);
+                }
+            }
+        });
+    }
+
+    function connectPushSocket() {
+        if (!window.WebSocket) return;
+
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const socket = new WebSocket(`${protocol}//${window.location.host}/ws/messages/`);
+
+        socket.onopen = function () {
+            reconnectDelay = 1000;
+            stopPolling();
+            // Catch up on anything sent while we were not connected
+            fetchAndUpdateThreads();
+        };
+
+        socket.onmessage = function (event) {
+            const data = JSON.parse(event.data);
+            if (data.type !== 'message') return;
+
+            if (!threadsCache[data.thread_id]) {
+                // Unknown thread: let the delta sync fetch it together with its root message
+                fetchAndUpdateThreads();
+                return;
+            }
+
+            const thread = mergeThreadDelta({ thread_id: data.thread_id, messages: [data.message] });
+            updateMessagePreview(data.thread_id, thread);
+            if (data.thread_id === currentMessageId) {
+                displayMessageThread(thread);
+                markThreadRead(data.thread_id, thread);
+            } else if (!data.message.is_sender) {
+                const badge = $(`.message-preview[data-message-id="${data.thread_id}"] .unread-badge`);
+                setUnreadCount(data.thread_id, (parseInt(badge.text()) || 0) + 1);
+            }
+        };
+
+        socket.onclose = function () {
+            startPolling();
+            setTimeout(connectPushSocket, reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, MAX_RECONNECT_DELAY);
+        };
+    }
+
+    // Initialize and start updates
+    startPolling();
+    connectPushSocket();
 
     // Event Handlers
     $(document).on('click', '.message-preview', function () {
@@ -147,14 +368,16 @@ $(document).ready(function () {
         $(this).addClass('selected');
         $('#replySection').show();
 
-        // Find the thread data in the latest response
+        // Fetch just this thread; the browser revalidates it with If-None-Match when it is unchanged
         $.ajax({
-            url: '/api/messages/latest/',
+            url: `/api/threads/${messageId}/`,
             method: 'GET',
-            success: function(response) {
-                const threadData = response.threads.find(t => t.thread_id === messageId);
-                if (threadData && threadData.messages) {
+            success: function(threadData) {
+                if (threadData && threadData.messages && messageId === currentMessageId) {
+                    threadsCache[messageId] = threadData.messages;
+                    olderPageTokens[messageId] = threadData.before;
                     displayMessageThread(threadData.messages);
+                    markThreadRead(messageId, threadData.messages);
                 }
             },
              error: function(xhr) {
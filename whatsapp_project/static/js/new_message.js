@@ -38,14 +38,11 @@ $(document).ready(function() {
     // If this is a reply, fetch the thread details and set the recipient
     if (replyTo) {
         $.ajax({
-            url: '/api/messages/latest/',
+            url: `/api/threads/${encodeURIComponent(replyTo)}/`,
             method: 'GET',
-            success: function(response) {
-                // Find the specific thread
-                const thread = response.threads.find(t => t.thread_id.toString() === replyTo);
-                
-                if (thread && thread.messages.length > 0) {
-                    const originalMessage = thread.messages[0];
+            success: function(thread) {
+                if (thread && thread.root) {
+                    const originalMessage = thread.root;
                     
                     // If is_sender is true, set recipient to original recipient
                     // If is_sender is false, set recipient to original sender
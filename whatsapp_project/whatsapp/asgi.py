@@ -3,6 +3,11 @@ ASGI config for whatsapp project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+HTTP requests are handled by Django, with the async variants of the busiest views (see ``messaging.async_views``)
+unless ``WHATSAPP_ASYNC_VIEWS`` is set to ``0``. WebSocket connections to ``messaging.consumers.WEBSOCKET_PATH``
+are handled by ``messaging.consumers.websocket_application``, which pushes new messages to the logged-in user.
+Serve it with any ASGI server, e.g. ``uvicorn whatsapp.asgi:application``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -12,5 +17,19 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatsapp.settings')
+os.environ.setdefault('WHATSAPP_ASYNC_VIEWS', '1')
+
+django_application = get_asgi_application()
+
+# Imported after Django is set up, since the consumers use the ORM
+from messaging.consumers import WEBSOCKET_PATH, websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        if scope['path'] == WEBSOCKET_PATH:
+            return await websocket_application(scope, receive, send)
+        await receive()
+        return await send({'type': 'websocket.close'})
 
-application = get_asgi_application()
+    return await django_application(scope, receive, send)
@@ -0,0 +1,69 @@
+"""
+Cache backends, selected with environment variables.
+
+The default cache holds state every process must agree on: the inbox and directory version tokens used as ETags
+(`messaging.versions`), the read replica pins (`messaging.routers`) and, when shared, the cached sessions. A
+per-process cache is only correct with a single process: a process that never saw a version bump keeps answering
+304 Not Modified for data that changed, and never sees the pins set by the process that wrote.
+
+`settings.CACHES` is built by `cache_settings()` from `WHATSAPP_CACHE_URL`:
+
+- `redis://host:port/db` (or `rediss://`, `unix://`): Django's Redis backend (needs the `redis` package).
+- `memcached://host:port`, with several comma-separated servers: Django's pymemcache backend (needs `pymemcache`).
+- Unset: a per-process local memory cache, for development and single-process deployments only. With `DEBUG` off it
+  is refused when `WEB_CONCURRENCY` (the worker count read by gunicorn and uvicorn) is above 1.
+
+Functions:
+    - `cache_settings(debug, environ)`: Returns the `CACHES` setting for the configured backend.
+    - `is_shared_cache(caches)`: Returns whether the default cache of a `CACHES` setting is shared between processes.
+"""
+
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+LOCMEM_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+def _redis_cache(url):
+    return {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': url}
+
+
+def _memcached_cache(url):
+    servers = [server.strip() for server in url[len('memcached://'):].split(',') if server.strip()]
+    return {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': servers}
+
+
+SCHEMES = {
+    'redis': _redis_cache,
+    'rediss': _redis_cache,
+    'unix': _redis_cache,
+    'memcached': _memcached_cache,
+}
+
+
+def cache_settings(debug, environ=None):
+    environ = os.environ if environ is None else environ
+    url = environ.get('WHATSAPP_CACHE_URL', '')
+    if url:
+        scheme = url.partition('://')[0]
+        if scheme not in SCHEMES:
+            raise ImproperlyConfigured(
+                f"Unknown WHATSAPP_CACHE_URL scheme {scheme!r}; expected one of {', '.join(sorted(SCHEMES))}.")
+        return {'default': SCHEMES[scheme](url)}
+
+    if not debug and int(environ.get('WEB_CONCURRENCY', 1)) > 1:
+        raise ImproperlyConfigured(
+            'Several worker processes need a shared cache for inbox versions and replica pins; '
+            'set WHATSAPP_CACHE_URL to a Redis or memcached server.')
+    return {
+        'default': {
+            'BACKEND': LOCMEM_BACKEND,
+            'LOCATION': 'whatsapp-default',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+    }
+
+
+def is_shared_cache(caches):
+    return caches['default']['BACKEND'] != LOCMEM_BACKEND
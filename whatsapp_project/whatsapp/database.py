@@ -0,0 +1,109 @@
+"""
+Database profiles, selected with environment variables.
+
+`settings.DATABASES` is built by `database_settings()` from `WHATSAPP_DB_PROFILE`:
+
+- `sqlite` (default): The local `db.sqlite3` file, tuned for concurrent requests. Every new connection switches the
+  database to WAL (readers no longer block the writer), waits up to `WHATSAPP_DB_BUSY_TIMEOUT` milliseconds for a
+  lock instead of failing with "database is locked", uses `synchronous=NORMAL` (safe with WAL, one fsync per
+  checkpoint instead of per transaction) and memory-maps the file. Connections are kept open between requests.
+- `server`: A server database (PostgreSQL by default) configured with `WHATSAPP_DB_ENGINE`, `WHATSAPP_DB_NAME`,
+  `WHATSAPP_DB_USER`, `WHATSAPP_DB_PASSWORD`, `WHATSAPP_DB_HOST` and `WHATSAPP_DB_PORT`. Connections persist for
+  `WHATSAPP_DB_CONN_MAX_AGE` seconds (60 by default) and are health-checked before reuse. Django 4.2 has no built-in
+  pool, so for pooling put PgBouncer (transaction mode) in front of the server and set `WHATSAPP_DB_POOLER=pgbouncer`,
+  which disables the server-side cursors that transaction pooling cannot support.
+
+Read replicas are listed in `WHATSAPP_DB_REPLICAS`, comma-separated: file paths for the `sqlite` profile (copies kept
+in sync by an external tool such as Litestream, or plain files for local testing), `host` or `host:port` for the
+`server` profile. They become the `replica1`, `replica2`, ... aliases, with the primary's other settings; the test
+runner mirrors them to the test database of `default`. `messaging.routers` decides which reads they serve.
+
+The SQLite pragmas are applied by `configure_sqlite_connection`, a `connection_created` receiver connected when this
+module is imported (by the settings), to every SQLite connection whose settings hold a `PRAGMAS` dict.
+
+Functions:
+    - `database_settings(base_dir, environ)`: Returns the `DATABASES` setting for the selected profile and replicas.
+    - `configure_sqlite_connection(sender, connection, **kwargs)`: Applies the `PRAGMAS` of a new SQLite connection.
+"""
+
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.signals import connection_created
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def _sqlite_profile(base_dir, environ):
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': environ.get('WHATSAPP_DB_NAME', os.path.join(base_dir, 'db.sqlite3')),
+        'CONN_MAX_AGE': int(environ.get('WHATSAPP_DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'PRAGMAS': dict(SQLITE_PRAGMAS, busy_timeout=int(environ.get('WHATSAPP_DB_BUSY_TIMEOUT', 5000))),
+    }
+
+
+def _server_profile(base_dir, environ):
+    if 'WHATSAPP_DB_NAME' not in environ:
+        raise ImproperlyConfigured('WHATSAPP_DB_NAME is required by the server database profile.')
+
+    database = {
+        'ENGINE': environ.get('WHATSAPP_DB_ENGINE', 'django.db.backends.postgresql'),
+        'NAME': environ['WHATSAPP_DB_NAME'],
+        'USER': environ.get('WHATSAPP_DB_USER', ''),
+        'PASSWORD': environ.get('WHATSAPP_DB_PASSWORD', ''),
+        'HOST': environ.get('WHATSAPP_DB_HOST', 'localhost'),
+        'PORT': environ.get('WHATSAPP_DB_PORT', ''),
+        'CONN_MAX_AGE': int(environ.get('WHATSAPP_DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+    }
+    if environ.get('WHATSAPP_DB_POOLER') == 'pgbouncer':
+        database['DISABLE_SERVER_SIDE_CURSORS'] = True
+    return database
+
+
+PROFILES = {
+    'sqlite': _sqlite_profile,
+    'server': _server_profile,
+}
+
+
+def database_settings(base_dir, environ=None):
+    environ = os.environ if environ is None else environ
+    profile = environ.get('WHATSAPP_DB_PROFILE', 'sqlite')
+    if profile not in PROFILES:
+        raise ImproperlyConfigured(
+            f"Unknown WHATSAPP_DB_PROFILE {profile!r}; expected one of {', '.join(sorted(PROFILES))}.")
+
+    primary = PROFILES[profile](base_dir, environ)
+    databases = {'default': primary}
+    replicas = [replica.strip() for replica in environ.get('WHATSAPP_DB_REPLICAS', '').split(',') if replica.strip()]
+    for i, replica in enumerate(replicas, start=1):
+        if profile == 'sqlite':
+            location = {'NAME': replica}
+        else:
+            host, _, port = replica.partition(':')
+            location = {'HOST': host, 'PORT': port or primary['PORT']}
+        databases[f'replica{i}'] = dict(primary, **location, TEST={'MIRROR': 'default'})
+
+    return databases
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if connection.vendor != 'sqlite' or not pragmas:
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+connection_created.connect(configure_sqlite_connection, dispatch_uid='whatsapp.configure_sqlite_connection')
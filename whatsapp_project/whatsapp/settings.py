@@ -22,9 +22,21 @@ Settings include:
 - `MIDDLEWARE`: A list of middleware components that are used by Django to process requests and responses.
 - `ROOT_URLCONF`: The URL configuration for the project, specifying where to find URL patterns.
 - `TEMPLATES`: A list of settings for template rendering, including the backend and template directories.
-- `DATABASES`: The configuration for the project's database, including the engine and location of the database file.
+- `DATABASES`: The configuration for the project's database, built from the profile selected with `WHATSAPP_DB_PROFILE` (a WAL-tuned SQLite file by default, or a server database with persistent connections; see `whatsapp/database.py`), plus the read replicas listed in `WHATSAPP_DB_REPLICAS`.
+- `DATABASE_ROUTERS`, `MESSAGING_READ_REPLICAS` and `MESSAGING_REPLICA_PIN_SECONDS`: Routing of polling and search reads to the read replicas, and how long readers stay on the primary after their data changed.
 - `LOGIN_URL` and `LOGOUT_REDIRECT_URL`: URLs for user login and logout.
-- `LOGGING`: Configuration for logging, including file handler and logging level.
+- `MESSAGING_PUBSUB_HUB` and `MESSAGING_PUBSUB_URL`: Dotted path of the pub/sub hub class used to push new messages to WebSocket clients, and the Redis server relaying them between processes (configurable with `WHATSAPP_PUBSUB_URL`, by default the Redis cache server).
+- `CACHES`: The cache backends, used for inbox versions and other state shared by every process: a Redis or memcached server from `WHATSAPP_CACHE_URL`, or a per-process memory cache that is refused for multi-process deployments with `DEBUG` off (see `whatsapp/caches.py`).
+- `MESSAGING_SNAPSHOT_STORE`: The backend and options of the per-user inbox snapshot cache.
+- `MESSAGING_SLOW_REQUEST_THRESHOLD`: Requests slower than this many seconds are logged with their slowest SQL.
+- `INTERNAL_IPS`: Clients allowed to scrape `/metrics/` without a staff login (configurable with `WHATSAPP_METRICS_IPS`, empty by default;
+  never list the address of a reverse proxy, since every request it forwards comes from there).
+- `MESSAGING_ASYNC_VIEWS`: Whether the busiest endpoints are served by their async variants (configurable with `WHATSAPP_ASYNC_VIEWS`, on by default under ASGI).
+- `MESSAGING_JOBS_EAGER` and `MESSAGING_JOB_LEASE_SECONDS`: Whether background jobs run inline instead of in `manage.py worker` (on unless `WHATSAPP_JOBS_EAGER=0` says a worker runs), and how long a worker may hold a job before another worker takes it over.
+- `MESSAGING_ARCHIVE_DIR`, `MESSAGING_ARCHIVE_AFTER_DAYS` and `MESSAGING_ARCHIVE_SEGMENT_BYTES`: Where idle threads are archived by `manage.py archive_threads` (configurable with `WHATSAPP_ARCHIVE_DIR`), after how many idle days (`WHATSAPP_ARCHIVE_AFTER_DAYS`), and the size at which a new archive segment is started.
+- `SESSION_ENGINE`: The session store (cache-backed when the cache is shared between processes, database-backed otherwise; configurable with `WHATSAPP_SESSION_ENGINE`).
+- `SESSION_ACTIVITY_GRANULARITY`: How stale the stored session activity timestamp may get before it is rewritten.
+- `LOGGING_CONFIG` and `LOGGING`: Configuration for logging, including file handler and logging level. Records are written by a background thread unless `WHATSAPP_LOG_MODE` is `sync`; `WHATSAPP_LOG_FORMAT=json` writes structured JSON lines.
 - `AUTH_PASSWORD_VALIDATORS`: A list of password validation rules to enforce password complexity.
 - `AUTHENTICATION_BACKENDS`: Specifies the authentication backend(s) for logging in users.
 - `LANGUAGE_CODE`: The language code for the project (en-us for English).
@@ -44,6 +56,11 @@ Notes:
 from pathlib import Path
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
+from .caches import cache_settings, is_shared_cache
+from .database import database_settings
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -71,6 +88,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it times the whole request (see messaging/instrumentation.py)
+    'messaging.instrumentation.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -104,21 +123,85 @@ WSGI_APPLICATION = 'whatsapp.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
-}
+DATABASES = database_settings(BASE_DIR)
+
+# Polling and search reads go to these aliases (see messaging/routers.py); writes always go to 'default'
+DATABASE_ROUTERS = ['messaging.routers.ReadReplicaRouter']
+MESSAGING_READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# After a write, the affected readers stay on the primary for this many seconds; keep above the replication lag
+MESSAGING_REPLICA_PIN_SECONDS = int(os.environ.get('WHATSAPP_REPLICA_PIN_SECONDS', 10))
 LOGIN_URL = '/login/'
 LOGOUT_REDIRECT_URL = 'login'
 
+# Cache for inbox versions (see messaging/versions.py) and other state shared by every process. Set
+# WHATSAPP_CACHE_URL to a Redis or memcached server whenever more than one process serves requests (see whatsapp/caches.py)
+CACHES = cache_settings(DEBUG)
+
+# Pub/sub hub used to push new messages over WebSockets (see messaging/pubsub.py). The in-process hub only reaches the
+# connections of the publishing process; a Redis server (WHATSAPP_PUBSUB_URL, by default the Redis cache server if
+# there is one) relays events between every process
+MESSAGING_PUBSUB_URL = os.environ.get('WHATSAPP_PUBSUB_URL', (
+    CACHES['default']['LOCATION'] if CACHES['default']['BACKEND'].endswith('.RedisCache') else ''))
+MESSAGING_PUBSUB_HUB = 'messaging.pubsub.RedisHub' if MESSAGING_PUBSUB_URL else 'messaging.pubsub.InProcessHub'
+
+# Replica pins set by the process that wrote must be seen by every process (see messaging/routers.py)
+if MESSAGING_READ_REPLICAS and not DEBUG and not is_shared_cache(CACHES):
+    raise ImproperlyConfigured('Read replicas need a shared cache for their pins; set WHATSAPP_CACHE_URL.')
+
+# With a shared cache, sessions are read from the cache and only written to the database when they change. A
+# per-process cache would keep serving a session another process logged out, so sessions then stay in the database.
+# Set WHATSAPP_SESSION_ENGINE to 'django.contrib.sessions.backends.signed_cookies' to keep no server-side session state
+SESSION_ENGINE = os.environ.get('WHATSAPP_SESSION_ENGINE', (
+    'django.contrib.sessions.backends.cached_db' if is_shared_cache(CACHES) else 'django.contrib.sessions.backends.db'))
+
+# The session's last activity timestamp is only rewritten once it is older than this many seconds
+SESSION_ACTIVITY_GRANULARITY = 60
+
+# Requests slower than this many seconds are logged with their slowest SQL to the 'messaging.slow_requests' logger
+MESSAGING_SLOW_REQUEST_THRESHOLD = 0.5
+
+# Clients allowed to read /metrics/ without a staff login (e.g. the Prometheus server), none by default. REMOTE_ADDR is
+# the address of the direct peer, so behind a reverse proxy on the same host every client looks like 127.0.0.1: only
+# list addresses that no proxy forwards from
+INTERNAL_IPS = [ip for ip in os.environ.get('WHATSAPP_METRICS_IPS', '').split(',') if ip]
+
+# Serve the polling, search and send endpoints with the async views of messaging/async_views.py. whatsapp/asgi.py
+# turns this on by default; WSGI deployments keep the sync views
+MESSAGING_ASYNC_VIEWS = os.environ.get('WHATSAPP_ASYNC_VIEWS', '0') == '1'
+
+# Background jobs (see messaging/jobs.py) run inline when enqueued, so nothing is left undone where no worker runs.
+# Deployments running `manage.py worker` set WHATSAPP_JOBS_EAGER=0 to hand the jobs to it
+MESSAGING_JOBS_EAGER = os.environ.get('WHATSAPP_JOBS_EAGER', '1') == '1'
+
+# A job claimed longer ago than this many seconds is assumed abandoned by a dead worker and claimed again
+MESSAGING_JOB_LEASE_SECONDS = 300
+
+# Threads idle for longer than this many days are moved out of the Message table into compressed, append-only
+# archive segments by `manage.py archive_threads` (see messaging/archive.py)
+MESSAGING_ARCHIVE_DIR = os.environ.get('WHATSAPP_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+MESSAGING_ARCHIVE_AFTER_DAYS = int(os.environ.get('WHATSAPP_ARCHIVE_AFTER_DAYS', 365))
+MESSAGING_ARCHIVE_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Per-user inbox snapshot cache (see messaging/snapshots.py). For several worker processes on one host use
+# 'messaging.snapshots.FileSnapshotStore' with OPTIONS {'directory': ...}; for several hosts use
+# 'messaging.snapshots.CacheSnapshotStore' on top of a shared CACHES alias.
+MESSAGING_SNAPSHOT_STORE = {
+    'BACKEND': 'messaging.snapshots.LocMemSnapshotStore',
+    'OPTIONS': {'max_entries': 10000},
+}
+
 import os
 
 # Make sure the logs directory exists
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')
 os.makedirs(LOGS_DIR, exist_ok=True)
 
+# Log records go through a queue drained by a background thread (see messaging/log_pipeline.py), so request threads
+# never wait for log I/O. Set WHATSAPP_LOG_MODE=sync to write from the calling thread, and WHATSAPP_LOG_FORMAT=json for
+# one JSON object per line in app.log
+LOGGING_CONFIG = 'messaging.log_pipeline.configure_logging'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -127,13 +210,19 @@ LOGGING = {
             'format': '{levelname} {asctime} {module} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'messaging.log_pipeline.JsonFormatter',
+        },
     },
     'handlers': {
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'messaging.log_pipeline.SizeAndTimeRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'app.log'),
-            'formatter': 'verbose',
+            'maxBytes': 10 * 1024 * 1024,
+            'interval': 24 * 60 * 60,
+            'backupCount': 5,
+            'formatter': 'json' if os.environ.get('WHATSAPP_LOG_FORMAT') == 'json' else 'verbose',
         },
         'console': {
             'level': 'DEBUG',
@@ -159,6 +248,14 @@ LOGGING = {
     },
 }
 
+if os.environ.get('WHATSAPP_LOG_MODE', 'queue') == 'queue':
+    LOGGING['queue'] = {
+        'maxsize': 10000,
+        'batch_size': 500,
+        # Share of DEBUG records kept, by logger name prefix (the asyncio selector messages are pure noise)
+        'debug_sample_rates': {'asyncio': 0.0},
+    }
+
 
 
 
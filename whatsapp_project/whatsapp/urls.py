@@ -25,10 +25,24 @@ URL Patterns:
 - 'messages/' is routed to the `messages_view` for displaying messages.
 - 'new_message/' is mapped to the `new_message` view for creating a new message or replying to an existing one.
 - 'api/messages/latest/' is connected to the `latest_messages_api` for retrieving the latest messages in a JSON format.
+- 'api/messages/wait/' is connected to the `wait_messages_api`, a long-polling variant of `latest_messages_api` that waits for new messages.
+- 'api/threads/' is connected to the `inbox_api` for listing the user's threads, one keyset page at a time.
+- 'api/threads/archived/' is connected to the `archived_threads_api` for listing the user's threads moved to the archive.
+- 'api/threads/<thread_id>/' is connected to the `thread_detail_api` for fetching a single thread (supports ETag / If-None-Match). Archived threads are loaded from the archive on demand.
+- 'api/threads/<thread_id>/messages/' is connected to the `thread_messages_api` for paging through the history of one thread.
+- 'api/threads/<thread_id>/read/' is connected to the `mark_thread_read_api` for marking a thread as read (POST).
+- Thread ids in paths use the `id` converter (`messaging.views.IdConverter`), so ids too large for the database are a 404.
 - 'api/users/search/' is connected to the `search_users` API for searching users by username, first name, or last name.
+- 'api/messages/search/' is connected to the `search_messages_api` for full-text search in the user's own messages.
 - 'api/messages/send/' is mapped to the `send_message` view to handle sending a message.
+- 'api/messages/export/' is connected to the `export_messages_api`, which streams the user's full history as an NDJSON or CSV download.
+- 'api/messages/broadcast/' is mapped to the `broadcast_messages_api` for sending many messages in one request with bulk inserts.
+- 'metrics/' is connected to the `metrics_view` of `messaging.instrumentation`, which serves per-view request, query and latency metrics in the Prometheus text format.
 - The 'logout/' path uses the `LogoutView` to log the user out of the application.
 
+When `MESSAGING_ASYNC_VIEWS` is set (the default under ASGI), the latest messages, user search and send message
+and export endpoints are served by the async views of `messaging.async_views` instead.
+
 Static and Media Files:
 - In development (when `DEBUG=True`), static and media files are served by Django with `static()` and `MEDIA_URL` respectively.
 
@@ -38,12 +52,18 @@ Note:
 
 
 from django.contrib import admin
-from django.urls import path
-from messaging import views
+from django.urls import path, register_converter
+from messaging import async_views, views
+from messaging.instrumentation import metrics_view
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib.auth.views import LogoutView
 
+# Under ASGI the busiest endpoints are served by coroutines instead of thread-pooled sync views
+api_views = async_views if settings.MESSAGING_ASYNC_VIEWS else views
+
+register_converter(views.IdConverter, 'id')
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.login_view, name='login'),  # Handle the root URL
@@ -51,11 +71,21 @@ urlpatterns = [
     path('registration/', views.create_user, name="registration"),
     path('messages/', views.messages_view, name='messages'),
     path('new_message/', views.new_message, name='new_message'),
-    path('api/messages/latest/', views.latest_messages_api, name='latest_messages_api'),
-    path('api/users/search/', views.search_users, name='search_users'),
-    path('api/messages/send/', views.send_message, name='send_message'),
+    path('api/messages/latest/', api_views.latest_messages_api, name='latest_messages_api'),
+    path('api/messages/wait/', views.wait_messages_api, name='wait_messages_api'),
+    path('api/threads/', views.inbox_api, name='inbox_api'),
+    path('api/threads/archived/', views.archived_threads_api, name='archived_threads_api'),
+    path('api/threads/<id:thread_id>/', views.thread_detail_api, name='thread_detail_api'),
+    path('api/threads/<id:thread_id>/messages/', views.thread_messages_api, name='thread_messages_api'),
+    path('api/threads/<id:thread_id>/read/', views.mark_thread_read_api, name='mark_thread_read_api'),
+    path('api/users/search/', api_views.search_users, name='search_users'),
+    path('api/messages/search/', views.search_messages_api, name='search_messages_api'),
+    path('api/messages/send/', api_views.send_message, name='send_message'),
+    path('api/messages/export/', api_views.export_messages_api, name='export_messages_api'),
+    path('api/messages/broadcast/', views.broadcast_messages_api, name='broadcast_messages_api'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('update-activity/', views.update_activity, name='update_activity'),
+    path('metrics/', metrics_view, name='metrics'),
 
 ]
 